@@ -0,0 +1,76 @@
+'''
+Generated switch fabrics
+
+A fabric lists switches with their port count, links as
+(src dpid, src port no, dst dpid, dst port no), one per cable, and the
+free edge ports (dpid, port no) where hosts and routers attach.
+'''
+from collections import namedtuple
+
+Fabric = namedtuple('Fabric', ['name', 'switches', 'links', 'edge_ports'])
+
+
+def leaf_spine(leaves=4, spines=2, hosts_per_leaf=8):
+    '''
+    Leaves are dpid 1..leaves, spines follow; leaf port i goes to
+    spine i, ports after the uplinks are edge ports
+    '''
+    switches = {}
+    links = []
+    edge_ports = []
+
+    for leaf in range(1, leaves + 1):
+        switches[leaf] = spines + hosts_per_leaf
+
+        for port_no in range(spines + 1, spines + hosts_per_leaf + 1):
+            edge_ports.append((leaf, port_no))
+
+    for index in range(spines):
+        spine = leaves + index + 1
+        switches[spine] = leaves
+
+        for leaf in range(1, leaves + 1):
+            links.append((leaf, index + 1, spine, leaf))
+
+    return Fabric('leaf-spine', switches, links, edge_ports)
+
+
+def fat_tree(k=4):
+    '''
+    k-ary fat tree: k pods of k/2 edge and k/2 aggregation switches,
+    (k/2)^2 core switches; every switch has k ports, the lower half
+    of an edge switch are edge ports
+    '''
+    if k < 2 or k % 2:
+        raise ValueError('k must be an even number')
+
+    half = k // 2
+    switches = {}
+    links = []
+    edge_ports = []
+    core_base = 2 * k * half  # dpids of pods come first
+
+    for core in range(half * half):
+        switches[core_base + core + 1] = k
+
+    for pod in range(k):
+        for index in range(half):
+            edge = pod * k + index + 1
+            agg = pod * k + half + index + 1
+            switches[edge] = k
+            switches[agg] = k
+
+            for port_no in range(half + 1, k + 1):
+                edge_ports.append((edge, port_no))
+
+            # full mesh between edge and aggregation switches of a pod
+            for other in range(half):
+                links.append((pod * k + other + 1, index + 1,
+                              agg, other + 1))
+
+            # aggregation switch index goes to core group index
+            for other in range(half):
+                core = core_base + index * half + other + 1
+                links.append((agg, half + other + 1, core, pod + 1))
+
+    return Fabric('fat-tree', switches, links, edge_ports)
@@ -0,0 +1,181 @@
+'''
+In-process stand-ins for switches, the topology service and the BGP
+speaker, so SDN-IP apps run without Mininet or BGP peers
+'''
+from ryu.base import app_manager
+from ryu.controller import ofp_event
+from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
+from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
+from ryu.topology import event as topo_event
+from ryu.topology.switches import Switch, Link, Port, Host
+
+
+def make_ofp_port(port_no):
+    hw_addr = '02:00:00:00:%02x:%02x' % divmod(port_no, 256)
+    return ofproto_v1_3_parser.OFPPort(
+        port_no=port_no, hw_addr=hw_addr,
+        name=('p%d' % port_no).encode('ascii'), config=0, state=0, curr=0,
+        advertised=0, supported=0, peer=0, curr_speed=0, max_speed=0)
+
+
+class EventSource(object):
+    '''
+    Deliver an event to every registered app which handles it, as
+    ofp_handler and the switches app do for their events
+    '''
+
+    def dispatch(self, ev, state=None):
+        for app in list(app_manager.SERVICE_BRICKS.values()):
+            if app.get_handlers(ev, state):
+                app._send_event(ev, state)
+
+
+class FakeDatapath(object):
+    '''
+    Switch connection which serializes and counts messages sent to it,
+    barrier requests and bundle open and commit requests are answered
+    right away
+    recorder: called with (datapath, msg) for every message
+    '''
+
+    def __init__(self, dpid, event_source, recorder=None):
+        super(FakeDatapath, self).__init__()
+        self.id = dpid
+        self.ofproto = ofproto_v1_3
+        self.ofproto_parser = ofproto_v1_3_parser
+        self.is_active = True
+        self.xid = 0
+        self.event_source = event_source
+        self.recorder = recorder
+        self.msg_counts = {}  # message class name -> count
+
+    def set_xid(self, msg):
+        self.xid = (self.xid + 1) & self.ofproto.MAX_XID
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg):
+        if msg.xid is None:
+            self.set_xid(msg)
+
+        msg.serialize()
+        name = msg.__class__.__name__
+        self.msg_counts[name] = self.msg_counts.get(name, 0) + 1
+
+        if self.recorder is not None:
+            self.recorder(self, msg)
+
+        if isinstance(msg, ofproto_v1_3_parser.OFPBarrierRequest):
+            reply = ofproto_v1_3_parser.OFPBarrierReply(self)
+            reply.xid = msg.xid
+            self.event_source.dispatch(ofp_event.EventOFPBarrierReply(reply),
+                                       MAIN_DISPATCHER)
+
+        elif isinstance(msg, ofproto_v1_3_parser.ONFBundleCtrlMsg) and\
+                msg.type in (self.ofproto.ONF_BCT_OPEN_REQUEST,
+                             self.ofproto.ONF_BCT_COMMIT_REQUEST):
+            reply = ofproto_v1_3_parser.ONFBundleCtrlMsg(
+                self, msg.bundle_id, msg.type + 1, msg.flags, [])
+            reply.xid = msg.xid
+            self.event_source.dispatch(ofp_event.EventONFBundleCtrlMsg(reply),
+                                       MAIN_DISPATCHER)
+
+        return True
+
+
+class FakeTopology(object):
+    '''
+    Topology service which raises switch, link and host events for a
+    fabric made of FakeDatapath
+    '''
+
+    def __init__(self, event_source, recorder=None):
+        super(FakeTopology, self).__init__()
+        self.event_source = event_source
+        self.recorder = recorder
+        self.datapaths = {}  # dpid -> FakeDatapath
+        self.switches = {}  # dpid -> Switch
+
+    def add_fabric(self, fabric):
+        for dpid, port_count in sorted(fabric.switches.items()):
+            self.add_switch(dpid, port_count)
+
+        for src_dpid, src_port_no, dst_dpid, dst_port_no in fabric.links:
+            self.add_link(src_dpid, src_port_no, dst_dpid, dst_port_no)
+
+    def add_switch(self, dpid, port_count):
+        dp = FakeDatapath(dpid, self.event_source, self.recorder)
+        switch = Switch(dp)
+
+        for port_no in range(1, port_count + 1):
+            switch.add_port(make_ofp_port(port_no))
+
+        self.datapaths[dpid] = dp
+        self.switches[dpid] = switch
+        features = ofproto_v1_3_parser.OFPSwitchFeatures(dp, datapath_id=dpid)
+        self.event_source.dispatch(ofp_event.EventOFPSwitchFeatures(features),
+                                   CONFIG_DISPATCHER)
+        self.event_source.dispatch(topo_event.EventSwitchEnter(switch))
+
+    def get_port(self, dpid, port_no):
+        return Port(dpid, ofproto_v1_3, make_ofp_port(port_no))
+
+    def add_link(self, src_dpid, src_port_no, dst_dpid, dst_port_no):
+        '''
+        Add both directions of a cable
+        '''
+        src = self.get_port(src_dpid, src_port_no)
+        dst = self.get_port(dst_dpid, dst_port_no)
+        self.event_source.dispatch(topo_event.EventLinkAdd(Link(src, dst)))
+        self.event_source.dispatch(topo_event.EventLinkAdd(Link(dst, src)))
+
+    def delete_link(self, src_dpid, src_port_no, dst_dpid, dst_port_no):
+        src = self.get_port(src_dpid, src_port_no)
+        dst = self.get_port(dst_dpid, dst_port_no)
+        self.event_source.dispatch(topo_event.EventLinkDelete(Link(src, dst)))
+        self.event_source.dispatch(topo_event.EventLinkDelete(Link(dst, src)))
+
+    def add_host(self, mac, dpid, port_no, ip):
+        host = Host(mac, self.get_port(dpid, port_no))
+        host.ipv4.append(ip)
+        self.event_source.dispatch(topo_event.EventHostAdd(host))
+        return host
+
+    def packet_in(self, dpid, in_port, data):
+        dp = self.datapaths[dpid]
+        ofproto = dp.ofproto
+        parser = dp.ofproto_parser
+        msg = parser.OFPPacketIn(dp,
+                                 buffer_id=ofproto.OFP_NO_BUFFER,
+                                 total_len=len(data),
+                                 reason=ofproto.OFPR_NO_MATCH,
+                                 table_id=0,
+                                 cookie=0,
+                                 match=parser.OFPMatch(in_port=in_port),
+                                 data=data)
+        self.event_source.dispatch(ofp_event.EventOFPPacketIn(msg),
+                                   MAIN_DISPATCHER)
+
+
+class FakeBGPSpeaker(object):
+    '''
+    Takes the place of BGPSpeaker, best path changes are fed to
+    best_path_change_handler by the benchmark
+    '''
+
+    def __init__(self, as_number, router_id, bgp_server_port=None,
+                 best_path_change_handler=None, peer_down_handler=None,
+                 peer_up_handler=None, **kwargs):
+        super(FakeBGPSpeaker, self).__init__()
+        self.best_path_change_handler = best_path_change_handler
+        self.neighbors = {}  # address -> remote as
+
+    def neighbor_add(self, address, remote_as, **kwargs):
+        self.neighbors[address] = remote_as
+
+    def neighbor_del(self, address):
+        self.neighbors.pop(address, None)
+
+    def shutdown(self):
+        pass
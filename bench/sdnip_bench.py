@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+'''
+Offline SDN-IP benchmark
+
+Runs SDNIP, Fwd, HopDB and ArpProxy against fake datapaths on a
+generated fabric, feeds synthetic BGP updates and packet-ins, and
+reports routes/sec, FlowMods per route, update to FlowMod latency,
+packet-in rate and RIB memory per 100k prefixes.
+
+Without --rate updates are fed as fast as possible, so the latency of
+most updates is time spent waiting in queues; it is reported as
+queueing_latency_* then and as latency_* with a bounded --rate.
+
+    python bench/sdnip_bench.py --fabric fat-tree --k 4 --prefixes 100000
+
+Unknown arguments are passed to Ryu, e.g. --sdn-ip-nexthop-table.
+'''
+from __future__ import print_function
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from ryu.lib import hub
+hub.patch(thread=False)
+
+from ryu import cfg
+from ryu.base import app_manager
+from ryu.lib.packet import packet, ethernet, arp, ipv4, ether_types
+from ryu.ofproto import ofproto_v1_3_parser
+from sdnip import sdn_ip
+from sdnip.arp_proxy import ArpProxy
+from sdnip.conf_mgr import SDNIPConfigService
+from sdnip.fwd import Fwd
+from sdnip.hop_db import HopDB
+from sdnip.host_db import HostDB
+from sdnip.ip_utils import int_to_ipv4, ipv4_to_int, parse_prefix
+from sdnip.ip_utils import prefix_len_to_mask
+from sdnip.packet_in import PacketInDispatcher
+from sdnip.sdn_ip import SDNIP
+
+import fabrics
+import fakes
+import updates
+
+CONF = cfg.CONF
+ROUTER_MAC = '02:00:00:00:00:01'
+INTERNAL_NETWORK = '192.168.0.0/16'
+GATEWAY_IP = '192.168.0.1'
+
+
+def get_rss():
+    '''
+    Current resident memory in bytes, None if unknown
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+
+        return pages * os.sysconf('SC_PAGE_SIZE')
+
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def percentile_ms(values, percent):
+    '''
+    return: percentile of seconds in milliseconds, None without values
+    '''
+    value = percentile(values, percent)
+
+    if value is None:
+        return None
+
+    return value * 1000
+
+
+def get_route_key(prefix):
+    # the ipv4_dst of a route flow, see SDNIP.get_route_flow
+    addr, prefix_len = parse_prefix(prefix)
+    return int_to_ipv4(addr), int_to_ipv4(prefix_len_to_mask(prefix_len))
+
+
+class FlowModRecorder(object):
+    '''
+    Count messages and time from a route update to the first FlowMod
+    of its prefix on any switch
+    '''
+
+    def __init__(self):
+        super(FlowModRecorder, self).__init__()
+        self.flow_mods = 0
+        self.group_mods = 0
+        self.packet_outs = 0
+        self.pending = {}  # route key -> update time
+        self.latencies = []
+
+    def expect(self, prefix):
+        self.pending[get_route_key(prefix)] = time.time()
+
+    def __call__(self, dp, msg):
+        if isinstance(msg, ofproto_v1_3_parser.ONFBundleAddMsg):
+            # --sdn-ip-flow-bundle wraps each message of a batch
+            msg = msg.message
+
+        if isinstance(msg, ofproto_v1_3_parser.OFPFlowMod):
+            self.flow_mods += 1
+
+        elif isinstance(msg, ofproto_v1_3_parser.OFPGroupMod):
+            self.group_mods += 1
+            return
+
+        elif isinstance(msg, ofproto_v1_3_parser.OFPPacketOut):
+            self.packet_outs += 1
+            return
+
+        else:
+            return
+
+        if not self.pending:
+            return
+
+        route_key = msg.match.get('ipv4_dst')
+
+        if not isinstance(route_key, tuple):
+            return
+
+        update_time = self.pending.pop(route_key, None)
+
+        if update_time is not None:
+            self.latencies.append(time.time() - update_time)
+
+
+class Bench(object):
+
+    def __init__(self, args, ryu_args):
+        super(Bench, self).__init__()
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.recorder = FlowModRecorder()
+        self.events = fakes.EventSource()
+        self.topology = fakes.FakeTopology(self.events, self.recorder)
+
+        if args.fabric == 'fat-tree':
+            self.fabric = fabrics.fat_tree(args.k)
+
+        else:
+            self.fabric = fabrics.leaf_spine(args.leaves, args.spines,
+                                             args.hosts_per_leaf)
+
+        edge_ports = list(self.fabric.edge_ports)
+        self.rng.shuffle(edge_ports)
+
+        if len(edge_ports) < args.peers + args.hosts:
+            raise ValueError('fabric has only %d edge ports' %
+                             len(edge_ports))
+
+        self.peer_ports = edge_ports[:args.peers]
+        self.host_ports = edge_ports[args.peers:args.peers + args.hosts]
+        self.peers = ['172.16.%d.%d' % divmod(index + 1, 256)
+                      for index in range(args.peers)]
+        self.hosts = ['192.168.%d.%d' % divmod(index + 2, 256)
+                      for index in range(args.hosts)]
+        self.cfg_file = self.write_config()
+        CONF(args=['--sdn-ip-cfg-file', self.cfg_file] + ryu_args,
+             project='ryu')
+        self.apps = self.start_apps()
+
+    def write_config(self):
+        dpid, port_no = self.peer_ports[0]
+        config = {
+            'local': {
+                'as_number': 65113,
+                'router_id': '172.16.0.1',
+                'listen_port': 2000,
+                'networks': [INTERNAL_NETWORK]
+            },
+            'speakers': [{
+                'dpid': '%016x' % dpid,
+                'port': port_no,
+                'speaker_ids': self.peers,
+                'mac': ROUTER_MAC
+            }]
+        }
+        cfg_fd, cfg_file = tempfile.mkstemp(suffix='.json')
+
+        with os.fdopen(cfg_fd, 'w') as cfg_out:
+            json.dump(config, cfg_out)
+
+        return cfg_file
+
+    def start_apps(self):
+        sdn_ip.BGPSpeaker = fakes.FakeBGPSpeaker
+        self.cfg_service = SDNIPConfigService()
+        self.fwd = Fwd()
+        self.hop_db = HopDB()
+        self.host_db = HostDB()
+        self.dispatcher = PacketInDispatcher()
+        self.sdnip = SDNIP(cfg_service=self.cfg_service, fwd=self.fwd,
+                           hop_db=self.hop_db, host_db=self.host_db,
+                           pkt_dispatcher=self.dispatcher)
+        self.arp_proxy = ArpProxy(cfg_service=self.cfg_service,
+                                  fwd=self.fwd, host_db=self.host_db,
+                                  pkt_dispatcher=self.dispatcher)
+        apps = [self.cfg_service, self.fwd, self.host_db, self.dispatcher,
+                self.sdnip, self.arp_proxy]
+
+        for app in apps:
+            app_manager.register_app(app)
+
+        app_manager.AppManager.get_instance()._update_bricks()
+
+        for app in apps:
+            app.start()
+
+        return apps
+
+    def is_idle(self):
+        if self.sdnip.route_updates:
+            return False
+
+        for app in self.apps:
+            if not app.events.empty():
+                return False
+
+        for queue in self.fwd.writer.queues.values():
+            if queue.msgs or queue.sent_seq < queue.enqueued_seq:
+                return False
+
+        return True
+
+    def wait_idle(self, timeout=None):
+        timeout = timeout or self.args.timeout
+        start = time.time()
+        idle_rounds = 0
+
+        # idle for a few rounds in a row, so handlers which just got
+        # an event can send what it causes
+        while idle_rounds < 10 and time.time() - start < timeout:
+            hub.sleep(0.001)
+            idle_rounds = idle_rounds + 1 if self.is_idle() else 0
+
+    def wait_recorded(self):
+        start = time.time()
+
+        while self.recorder.pending and\
+                time.time() - start < self.args.timeout:
+            hub.sleep(0.001)
+
+            if self.sdnip.fib is not None and self.is_idle():
+                self.discard_covered()
+
+        self.wait_idle()
+
+    def discard_covered(self):
+        '''
+        Stop waiting for prefixes which FIB compression gave no flow,
+        withdrawn ones included
+        '''
+        for route_key in list(self.recorder.pending):
+            ip, mask = route_key
+            prefix = '%s/%d' % (ip, bin(ipv4_to_int(mask)).count('1'))
+            nexthop = self.hop_db.get_nexthop(prefix)
+
+            if nexthop is None or\
+               self.sdnip.is_route_suppressed(prefix, nexthop):
+                del self.recorder.pending[route_key]
+
+    def get_latencies(self):
+        '''
+        return: p50 and p99 of update to FlowMod latency, labeled as
+        queueing latency when updates are not rate limited
+        '''
+        name = 'latency' if self.args.rate else 'queueing_latency'
+        latencies = self.recorder.latencies
+        return {name + '_p50_ms': percentile_ms(latencies, 50),
+                name + '_p99_ms': percentile_ms(latencies, 99)}
+
+    def feed(self, route_updates):
+        '''
+        Send route updates at --rate, return number of updates
+        '''
+        count = 0
+        start = time.time()
+
+        for ev in route_updates:
+            self.recorder.expect(ev.prefix)
+            self.sdnip.best_path_change_handler(ev)
+            count += 1
+
+            if self.args.rate:
+                delay = start + float(count) / self.args.rate - time.time()
+
+                if delay > 0:
+                    hub.sleep(delay)
+
+            elif count % 256 == 0:
+                hub.sleep(0)
+
+        return count
+
+    def setup_network(self):
+        self.topology.add_fabric(self.fabric)
+
+        for index, ip in enumerate(self.peers):
+            dpid, port_no = self.peer_ports[index]
+            mac = '02:01:00:00:%02x:%02x' % divmod(index, 256)
+            self.topology.add_host(mac, dpid, port_no, ip)
+
+        for index, ip in enumerate(self.hosts):
+            dpid, port_no = self.host_ports[index]
+            mac = '02:02:00:00:%02x:%02x' % divmod(index, 256)
+            self.topology.add_host(mac, dpid, port_no, ip)
+
+        self.wait_idle()
+
+    def run_routes(self, result):
+        prefixes = updates.generate_prefixes(self.args.prefixes, self.rng)
+        gc.collect()
+        rss_before = get_rss()
+        flow_mods = self.recorder.flow_mods
+        start = time.time()
+        count = self.feed(updates.announcements(prefixes, self.peers,
+                                                self.rng))
+        self.wait_recorded()
+        elapsed = time.time() - start
+        # after the writers drained, so queued messages are not counted
+        gc.collect()
+        rss_after = get_rss()
+        rss_growth = None
+
+        if rss_before is not None and rss_after is not None:
+            # includes memory the allocator keeps after the feed
+            rss_growth = (rss_after - rss_before) / float(1 << 20)
+
+        usage = self.hop_db.get_memory_usage()
+        prefix_flows = sum(self.sdnip.get_route_flow_counts().values())
+        occupancy = self.sdnip.get_table_occupancy()
+        result['announce'] = {
+            'updates': count,
+            'not_installed': len(self.recorder.pending),
+            'seconds': elapsed,
+            'routes_per_sec': count / elapsed,
+            'flow_mods_per_route':
+                (self.recorder.flow_mods - flow_mods) / float(count),
+            'rss_growth_mb': rss_growth,
+            'rib_bytes_per_prefix': usage['bytes_per_prefix'],
+            'rib_mb_per_100k_prefixes':
+                usage['bytes_per_prefix'] * 100000.0 / (1 << 20),
+            'fib_compression_ratio':
+                self.hop_db.get_installed_count() /
+                float(max(prefix_flows, 1)),
+            'max_switch_flows': max([0] + [sum(tables.values()) for tables
+                                           in occupancy.values()])
+        }
+        result['announce'].update(self.get_latencies())
+        return dict((prefix, self.hop_db.get_nexthop(prefix))
+                    for prefix in prefixes)
+
+    def run_churn(self, result, routes):
+        count = int(len(routes) * self.args.churn)
+
+        if not count:
+            return
+
+        self.recorder.pending.clear()
+        self.recorder.latencies = []
+        flow_mods = self.recorder.flow_mods
+        start = time.time()
+        count = self.feed(updates.churn(routes, count, self.peers, self.rng))
+        self.wait_recorded()
+        elapsed = time.time() - start
+        result['churn'] = {
+            'updates': count,
+            'not_installed': len(self.recorder.pending),
+            'seconds': elapsed,
+            'updates_per_sec': count / elapsed,
+            'flow_mods_per_update':
+                (self.recorder.flow_mods - flow_mods) / float(count)
+        }
+        result['churn'].update(self.get_latencies())
+
+    def build_packets(self, count):
+        '''
+        Internal hosts asking the gateway and sending to each other
+        return: list of (dpid, in port no, data)
+        '''
+        packets = []
+
+        for index in range(count):
+            src = self.rng.randrange(len(self.hosts))
+            dpid, port_no = self.host_ports[src]
+            src_mac = '02:02:00:00:%02x:%02x' % divmod(src, 256)
+            pkt = packet.Packet()
+
+            if index % 2:
+                pkt.add_protocol(ethernet.ethernet(
+                    ethertype=ether_types.ETH_TYPE_ARP,
+                    src=src_mac, dst='ff:ff:ff:ff:ff:ff'))
+                pkt.add_protocol(arp.arp(
+                    opcode=arp.ARP_REQUEST, src_mac=src_mac,
+                    src_ip=self.hosts[src], dst_mac='00:00:00:00:00:00',
+                    dst_ip=GATEWAY_IP))
+
+            else:
+                pkt.add_protocol(ethernet.ethernet(
+                    ethertype=ether_types.ETH_TYPE_IP,
+                    src=src_mac, dst=ROUTER_MAC))
+                pkt.add_protocol(ipv4.ipv4(
+                    src=self.hosts[src],
+                    dst=self.rng.choice(self.hosts), proto=17))
+
+            pkt.serialize()
+            packets.append((dpid, port_no, bytes(pkt.data)))
+
+        return packets
+
+    def run_packet_in(self, result):
+        packets = self.build_packets(self.args.packet_ins)
+
+        if not packets:
+            return
+
+        packet_outs = self.recorder.packet_outs
+        start = time.time()
+
+        for index, (dpid, port_no, data) in enumerate(packets):
+            self.topology.packet_in(dpid, port_no, data)
+
+            if index % 256 == 0:
+                hub.sleep(0)
+
+        self.wait_idle()
+        elapsed = time.time() - start
+        result['packet_in'] = {
+            'packets': len(packets),
+            'seconds': elapsed,
+            'packets_per_sec': len(packets) / elapsed,
+            'packet_outs': self.recorder.packet_outs - packet_outs
+        }
+
+    def run(self):
+        result = {
+            'fabric': self.fabric.name,
+            'switches': len(self.fabric.switches),
+            'links': len(self.fabric.links),
+            'peers': len(self.peers),
+            'options': {
+                'nexthop_table': CONF.sdn_ip_nexthop_table,
+                'ecmp': CONF.sdn_ip_ecmp,
+                'coalesce_window': CONF.sdn_ip_coalesce_window
+            }
+        }
+        self.setup_network()
+        routes = self.run_routes(result)
+        self.run_churn(result, routes)
+        self.run_packet_in(result)
+        os.unlink(self.cfg_file)
+        return result
+
+
+def print_result(result):
+    print('fabric %s, %d switches, %d links, %d peers' %
+          (result['fabric'], result['switches'], result['links'],
+           result['peers']))
+
+    for phase in ('announce', 'churn', 'packet_in'):
+        if phase not in result:
+            continue
+
+        print('%s:' % phase)
+
+        for key, value in sorted(result[phase].items()):
+            if isinstance(value, float):
+                value = '%.3f' % value
+
+            print('  %-26s %s' % (key, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline SDN-IP benchmark')
+    parser.add_argument('--fabric', choices=['leaf-spine', 'fat-tree'],
+                        default='leaf-spine')
+    parser.add_argument('--leaves', type=int, default=4)
+    parser.add_argument('--spines', type=int, default=2)
+    parser.add_argument('--hosts-per-leaf', type=int, default=8)
+    parser.add_argument('--k', type=int, default=4,
+                        help='ports per switch of fat tree')
+    parser.add_argument('--peers', type=int, default=4,
+                        help='BGP next hops')
+    parser.add_argument('--hosts', type=int, default=8,
+                        help='internal hosts sending packet-ins')
+    parser.add_argument('--prefixes', type=int, default=10000)
+    parser.add_argument('--churn', type=float, default=0.1,
+                        help='fraction of prefixes withdrawn or moved '
+                             'after the initial load')
+    parser.add_argument('--packet-ins', type=int, default=10000)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='route updates per second, 0 for no limit')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds to wait for each phase')
+    parser.add_argument('--json', help='also write results to this file')
+    args, ryu_args = parser.parse_known_args()
+    result = Bench(args, ryu_args).run()
+    print_result(result)
+
+    if args.json:
+        with open(args.json, 'w') as json_out:
+            json.dump(result, json_out, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
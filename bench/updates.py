@@ -0,0 +1,74 @@
+'''
+Synthetic BGP best path changes
+
+Prefix lengths roughly follow a global routing table, most are /24.
+'''
+from collections import namedtuple
+from sdnip.ip_utils import int_to_ipv4, prefix_len_to_mask
+
+# same fields SDNIP reads from the BGP speaker event
+BestPathChange = namedtuple('BestPathChange',
+                            ['prefix', 'nexthop', 'remote_as', 'is_withdraw'])
+
+PREFIX_LENGTHS = ((24, 60), (23, 8), (22, 12), (21, 5), (20, 5),
+                  (19, 4), (18, 2), (17, 2), (16, 2))
+# first octets of public unicast space, away from bench hosts
+FIRST_OCTETS = [octet for octet in range(1, 224)
+                if octet not in (10, 127, 169, 172, 192)]
+
+
+def _pick_prefix_len(rng):
+    value = rng.randrange(sum(weight for _, weight in PREFIX_LENGTHS))
+
+    for prefix_len, weight in PREFIX_LENGTHS:
+        if value < weight:
+            return prefix_len
+
+        value -= weight
+
+    return PREFIX_LENGTHS[0][0]
+
+
+def generate_prefixes(count, rng):
+    '''
+    return: list of unique prefix strings, e.g. '1.2.3.0/24'
+    '''
+    prefixes = set()
+
+    while len(prefixes) < count:
+        prefix_len = _pick_prefix_len(rng)
+        addr = (rng.choice(FIRST_OCTETS) << 24) | rng.getrandbits(24)
+        addr &= prefix_len_to_mask(prefix_len)
+        prefixes.add('%s/%d' % (int_to_ipv4(addr), prefix_len))
+
+    return sorted(prefixes)
+
+
+def announcements(prefixes, nexthops, rng, remote_as=65000):
+    '''
+    Announce every prefix once via a random next hop
+    '''
+    for prefix in prefixes:
+        yield BestPathChange(prefix, rng.choice(nexthops), remote_as, False)
+
+
+def churn(routes, count, nexthops, rng, withdraw_ratio=0.3,
+          remote_as=65000):
+    '''
+    Withdraw or move count distinct prefixes to another next hop
+    routes: prefix -> next hop, updated as the changes are made
+    '''
+    prefixes = rng.sample(sorted(routes), min(count, len(routes)))
+
+    for prefix in prefixes:
+        nexthop = routes[prefix]
+
+        if rng.random() < withdraw_ratio or len(nexthops) < 2:
+            del routes[prefix]
+            yield BestPathChange(prefix, nexthop, remote_as, True)
+            continue
+
+        new_nexthop = rng.choice([other for other in nexthops
+                                  if other != nexthop])
+        routes[prefix] = new_nexthop
+        yield BestPathChange(prefix, new_nexthop, remote_as, False)
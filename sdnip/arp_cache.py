@@ -0,0 +1,169 @@
+import time
+from collections import OrderedDict
+
+
+class ArpCache(object):
+    '''
+    IP to MAC cache with capacity limit and aging
+
+    Learned entries expire after ttl seconds unless confirmed again, the
+    least recently used one is evicted when the cache is full. Static
+    entries are pinned, they never expire and are not counted in
+    capacity. Learning is limited per port with a token bucket.
+    '''
+
+    def __init__(self, capacity=4096, ttl=300, learn_rate=10,
+                 clock=time.time):
+        super(ArpCache, self).__init__()
+        self.capacity = capacity
+        self.ttl = ttl
+        self.learn_rate = learn_rate
+        self.clock = clock
+        self.entries = OrderedDict()  # ip -> (mac, expire time), LRU first
+        self.static_entries = {}  # ip -> mac
+        self.learn_buckets = {}  # port -> (tokens, last update time)
+        self.stats = {'hits': 0,
+                      'misses': 0,
+                      'learned': 0,
+                      'refreshed': 0,
+                      'evicted': 0,
+                      'expired': 0,
+                      'rate_limited': 0}
+
+    def get(self, ip):
+        mac = self.static_entries.get(ip)
+
+        if mac is not None:
+            self.stats['hits'] += 1
+            return mac
+
+        entry = self.entries.get(ip)
+
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+
+        mac, expire_time = entry
+
+        if expire_time <= self.clock():
+            del self.entries[ip]
+            self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            return None
+
+        self._touch(ip)
+        self.stats['hits'] += 1
+        return mac
+
+    def learn(self, ip, mac, port=None):
+        '''
+        Add or update an entry
+        port: where the entry is learned, for rate limit
+        return: True if the entry is stored or refreshed
+        '''
+        if ip in self.static_entries:
+            return False
+
+        entry = self.entries.get(ip)
+
+        if entry is not None and entry[0] == mac:
+            return self.confirm(ip, mac)
+
+        if port is not None and not self._take_token(port):
+            self.stats['rate_limited'] += 1
+            return False
+
+        self.entries[ip] = (mac, self.clock() + self.ttl)
+        self._touch(ip)
+        self.stats['learned'] += 1
+
+        while len(self.entries) > self.capacity:
+            self._pop_lru()
+            self.stats['evicted'] += 1
+
+        return True
+
+    def confirm(self, ip, mac):
+        '''
+        Extend the lifetime of an entry if it still maps to mac
+        '''
+        entry = self.entries.get(ip)
+
+        if entry is None or entry[0] != mac:
+            return False
+
+        self.entries[ip] = (mac, self.clock() + self.ttl)
+        self._touch(ip)
+        self.stats['refreshed'] += 1
+        return True
+
+    def set_static_entries(self, static_entries):
+        '''
+        Replace all static entries, static_entries: ip -> mac
+        '''
+        self.static_entries = dict(static_entries)
+
+        for ip in self.static_entries:
+            self.entries.pop(ip, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.learn_buckets.clear()
+
+    def expire(self):
+        '''
+        Remove all expired entries
+        '''
+        now = self.clock()
+
+        for ip, (_, expire_time) in list(self.entries.items()):
+            if expire_time <= now:
+                del self.entries[ip]
+                self.stats['expired'] += 1
+
+    def items(self):
+        '''
+        return: list of (ip, mac, is static)
+        '''
+        now = self.clock()
+        result = [(ip, mac, True) for ip, mac in self.static_entries.items()]
+        result.extend((ip, mac, False)
+                      for ip, (mac, expire_time) in self.entries.items()
+                      if expire_time > now)
+        return result
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['size'] = len(self.entries)
+        stats['static'] = len(self.static_entries)
+        stats['capacity'] = self.capacity
+        return stats
+
+    def __len__(self):
+        return len(self.entries) + len(self.static_entries)
+
+    def _touch(self, ip):
+        # most recently used entries are at the end
+        self.entries[ip] = self.entries.pop(ip)
+
+    def _pop_lru(self):
+        self.entries.popitem(last=False)
+
+    def _take_token(self, port):
+
+        if not self.learn_rate:
+            # no limit
+            return True
+
+        now = self.clock()
+        tokens, last_time = self.learn_buckets.get(port,
+                                                   (self.learn_rate, now))
+        tokens = min(self.learn_rate,
+                     tokens + (now - last_time) * self.learn_rate)
+
+        if tokens < 1:
+            self.learn_buckets[port] = (tokens, now)
+            return False
+
+        self.learn_buckets[port] = (tokens - 1, now)
+        return True
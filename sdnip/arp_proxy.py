@@ -4,25 +4,57 @@ from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import MAIN_DISPATCHER, CONFIG_DISPATCHER
 from ryu.controller.handler import set_ev_cls
+from ryu.lib import hub
 from ryu.ofproto import ofproto_v1_0, ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
 from ryu.lib.packet import packet
 from ryu.lib.packet import ethernet
 from ryu.lib.packet import ipv4
 from ryu.lib.packet import ether_types
 from ryu.lib.packet import arp
-from ryu.lib.ofp_pktinfilter import packet_in_filter, RequiredTypeFilter
-from .conf_mgr import SDNIPConfigManager
+from .conf_mgr import SDNIPConfigService, EventConfigChange
 from .fwd import Fwd
+from .host_db import HostDB, EventHostUpdate, EventHostRemove
+from .packet_in import PacketInDispatcher
+from .packet_in import EventArpPacketIn, EventIPv4PacketIn, EventBGPPacketIn
+from .arp_cache import ArpCache
+from .cookies import COOKIE_ARP_RESPONDER, make_cookie
+from .ip_utils import ipv4_to_int
+from .metrics import REGISTRY, timed
 
 CONF = cfg.CONF
 CONF.register_cli_opts([
     cfg.StrOpt('static-arp-table',
                default=None,
-               help='location of SDN-IP config file')
+               help='location of SDN-IP config file'),
+    cfg.BoolOpt('sdn-ip-arp-responder',
+                default=False,
+                help='answer ARP for router and static ARP entries '
+                     'in switches'),
+    cfg.IntOpt('sdn-ip-arp-cache-size',
+               default=4096,
+               help='maximum learned ARP entries'),
+    cfg.IntOpt('sdn-ip-arp-cache-ttl',
+               default=300,
+               help='seconds before a learned ARP entry expires'),
+    cfg.IntOpt('sdn-ip-arp-learn-rate',
+               default=10,
+               help='ARP entries learned per second from each port, '
+                    '0 for unlimited')
 ])
 FAKE_IP = '0.0.0.0'
 FAKE_MAC = 'c0:ff:ee:c0:ff:ee'
 
+# above ARP punt rule of FwdBGP
+ARP_RESPONDER_PRIORITY = 2
+# internal hosts are always answered with the router mac
+INTERNAL_ARP_RESPONDER_PRIORITY = 3
+
+ARP_ENTRIES = REGISTRY.gauge('sdnip_arp_entries', 'ARP table entries',
+                             ['kind'])
+ARP_EVENTS = REGISTRY.counter('sdnip_arp_cache_events_total',
+                              'ARP cache lookups and updates', ['event'])
+
 # integrate with DragonKnight CLI
 with_dk = False
 try:
@@ -35,66 +67,262 @@ except ImportError as e:
 class ArpProxy(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
     _CONTEXTS = {
-        'fwd': Fwd
+        'cfg_service': SDNIPConfigService,
+        'fwd': Fwd,
+        'host_db': HostDB,
+        'pkt_dispatcher': PacketInDispatcher
     }
 
     def __init__(self, *args, **kwargs):
         super(ArpProxy, self).__init__(*args, **kwargs)
         self.fwd = kwargs['fwd']
-        self.cfg_mgr = SDNIPConfigManager()
-        self.arp_table = {}
+        self.host_db = kwargs['host_db']
+        self.cfg_mgr = kwargs['cfg_service'].config
+        self.router_mac = self.get_router_mac()  # mac in responders
+        self.arp_table = ArpCache(CONF.sdn_ip_arp_cache_size,
+                                  CONF.sdn_ip_arp_cache_ttl,
+                                  CONF.sdn_ip_arp_learn_rate)
+        self.static_arp_table = {}
+        self.arp_responder_hosts = set()  # internal host ip
+        self.load_static_arp_table()
+        hub.spawn(self.arp_aging_loop)
+        REGISTRY.add_collector(self.collect_metrics)
+
+        if with_dk:
+            dk_plugin.DynamicLoader.register_custom_cmd('arp-proxy:table', self.cmd_dump_arp_table)
+            dk_plugin.DynamicLoader.register_custom_cmd('arp-proxy:reload', self.cmd_reload_static)
+            dk_plugin.DynamicLoader.register_custom_cmd('arp-proxy:who-has', self.cmd_who_has)
+            dk_plugin.DynamicLoader.register_custom_cmd('arp-proxy:stats', self.cmd_arp_stats)
+
+    def load_static_arp_table(self):
 
         if CONF.static_arp_table is not None:
             # load static arp table
-            static_arp_table = json.load(open(CONF.static_arp_table, "r"))
+            with open(CONF.static_arp_table, "r") as static_arp_file:
+                static_arp_table = json.load(static_arp_file)
 
             for record in static_arp_table:
-                self.arp_table.setdefault(record['ip'], record['mac'])
+                self.static_arp_table.setdefault(record['ip'], record['mac'])
 
-        if with_dk:
-            dk_plugin.DynamicLoader.register_custom_cmd('arp-proxy:table', self.cmd_dump_arp_table)
-            dk_plugin.DynamicLoader.register_custom_cmd('arp-proxy:reload', self.cmd_reload_static)
-            dk_plugin.DynamicLoader.register_custom_cmd('arp-proxy:who-has', self.cmd_who_has)
+        self.arp_table.set_static_entries(self.static_arp_table)
+
+    def collect_metrics(self):
+        stats = self.arp_table.get_stats()
+        ARP_ENTRIES.set(stats.pop('size'), ('learned',))
+        ARP_ENTRIES.set(stats.pop('static'), ('static',))
+        stats.pop('capacity')
+
+        for name, value in stats.items():
+            ARP_EVENTS.set(value, (name,))
+
+    def arp_aging_loop(self):
+
+        while True:
+            hub.sleep(max(CONF.sdn_ip_arp_cache_ttl, 1))
+            self.arp_table.expire()
+
+    def get_router_mac(self):
+        speaker_ids = self.cfg_mgr.get_all_speaker_id()
+
+        if not speaker_ids:
+            return None
+
+        return self.cfg_mgr.get_speaker_mac(speaker_ids[0])
+
+    @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
+    def switch_features_handler(self, ev):
+
+        if CONF.sdn_ip_arp_responder:
+            self.install_arp_responders(ev.msg.datapath)
+
+    @set_ev_cls(EventHostUpdate)
+    def host_update_handler(self, ev):
+
+        if not CONF.sdn_ip_arp_responder:
+            return
+
+        router_mac = self.get_router_mac()
+
+        for ip in ev.ips:
+            if ip in self.arp_responder_hosts or router_mac is None or\
+               not self.cfg_mgr.is_internal_host(ip):
+                continue
+
+            self.arp_responder_hosts.add(ip)
+
+            for dp in self.fwd.get_all_datapaths():
+                self.add_arp_responder(dp, INTERNAL_ARP_RESPONDER_PRIORITY,
+                                       router_mac, sender_ip=ip)
+
+    @set_ev_cls(EventHostRemove)
+    def host_remove_handler(self, ev):
+        for ip in ev.ips:
+            if ip not in self.arp_responder_hosts:
+                continue
+
+            self.arp_responder_hosts.discard(ip)
+
+            for dp in self.fwd.get_all_datapaths():
+                self.delete_arp_responder(dp, INTERNAL_ARP_RESPONDER_PRIORITY,
+                                          sender_ip=ip)
+
+    @set_ev_cls(EventConfigChange)
+    def config_change_handler(self, ev):
+        '''
+        Update responders of internal hosts if the router mac or
+        internal networks changed
+        '''
+        if not CONF.sdn_ip_arp_responder:
+            return
+
+        router_mac = self.get_router_mac()
+        datapaths = self.fwd.get_all_datapaths()
+
+        for ip in list(self.arp_responder_hosts):
+            if router_mac is not None and self.cfg_mgr.is_internal_host(ip):
+                if router_mac != self.router_mac:
+                    for dp in datapaths:
+                        self.add_arp_responder(
+                            dp, INTERNAL_ARP_RESPONDER_PRIORITY,
+                            router_mac, sender_ip=ip)
+
+                continue
+
+            self.arp_responder_hosts.discard(ip)
 
-    @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
-    @packet_in_filter(RequiredTypeFilter, {'types': [ipv4.ipv4]})
+            for dp in datapaths:
+                self.delete_arp_responder(dp, INTERNAL_ARP_RESPONDER_PRIORITY,
+                                          sender_ip=ip)
+
+        self.router_mac = router_mac
+
+        if router_mac is None or not ev.added_networks:
+            return
+
+        for ip in self.host_db.get_all_ips():
+            if ip in self.arp_responder_hosts or\
+               not self.cfg_mgr.is_internal_host(ip):
+                continue
+
+            self.arp_responder_hosts.add(ip)
+
+            for dp in datapaths:
+                self.add_arp_responder(dp, INTERNAL_ARP_RESPONDER_PRIORITY,
+                                       router_mac, sender_ip=ip)
+
+    def install_arp_responders(self, datapath):
+        '''
+        Answer static ARP entries and ARP from learned internal hosts
+        in switch, other ARP still goes to controller
+        '''
+        for ip, mac in self.static_arp_table.items():
+            self.add_arp_responder(datapath, ARP_RESPONDER_PRIORITY, mac,
+                                   target_ip=ip)
+
+        router_mac = self.get_router_mac()
+
+        if router_mac is None:
+            return
+
+        for ip in self.arp_responder_hosts:
+            self.add_arp_responder(datapath, INTERNAL_ARP_RESPONDER_PRIORITY,
+                                   router_mac, sender_ip=ip)
+
+    def get_arp_responder_match(self, target_ip=None, sender_ip=None):
+        parser = ofproto_v1_3_parser
+
+        if target_ip is not None:
+            return parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP,
+                                   arp_op=arp.ARP_REQUEST,
+                                   arp_tpa=target_ip)
+
+        return parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP,
+                               arp_op=arp.ARP_REQUEST,
+                               arp_spa=sender_ip)
+
+    def add_arp_responder(self, datapath, priority, mac,
+                          target_ip=None, sender_ip=None):
+        '''
+        Reply ARP requests for target_ip, or any ARP request from
+        sender_ip, with mac; the request is turned into the reply in
+        place and sent back to in port
+        '''
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        match = self.get_arp_responder_match(target_ip, sender_ip)
+        actions = [
+            parser.NXActionRegMove(src_field='eth_src',
+                                   dst_field='eth_dst',
+                                   n_bits=48),
+            parser.OFPActionSetField(eth_src=mac),
+            parser.OFPActionSetField(arp_op=arp.ARP_REPLY),
+            parser.NXActionRegMove(src_field='arp_sha',
+                                   dst_field='arp_tha',
+                                   n_bits=48),
+            parser.OFPActionSetField(arp_sha=mac)
+            ]
+
+        if target_ip is not None:
+            ip = target_ip
+            actions.extend([
+                parser.NXActionRegMove(src_field='arp_spa',
+                                       dst_field='arp_tpa',
+                                       n_bits=32),
+                parser.OFPActionSetField(arp_spa=target_ip)
+                ])
+
+        else:
+            ip = sender_ip
+            actions.extend([
+                parser.NXActionRegMove(src_field='arp_tpa',
+                                       dst_field='arp_spa',
+                                       n_bits=32),
+                parser.OFPActionSetField(arp_tpa=sender_ip)
+                ])
+
+        actions.append(parser.OFPActionOutput(ofproto.OFPP_IN_PORT))
+        cookie = make_cookie(COOKIE_ARP_RESPONDER, ipv4_to_int(ip))
+        self.fwd.add_flow(datapath, priority, match, actions, cookie=cookie)
+
+    def delete_arp_responder(self, datapath, priority,
+                             target_ip=None, sender_ip=None):
+        match = self.get_arp_responder_match(target_ip, sender_ip)
+        self.fwd.delete_flow(datapath, match, strict=True, priority=priority)
+
+    @set_ev_cls([EventIPv4PacketIn, EventBGPPacketIn])
+    @timed
     def ipv4_packet_in_handler(self, ev):
-        msg = ev.msg
-        pkt = packet.Packet(msg.data)
-        eth_header = pkt.get_protocol(ethernet.ethernet)
-        ipv4_header = pkt.get_protocol(ipv4.ipv4)
-        self.arp_table.setdefault(ipv4_header.src, eth_header.src)
+        # eth_src may be a router, only confirm what ARP learned
+        self.arp_table.confirm(ev.src_ip, ev.eth_src)
+
+        # BGP peers and internal hosts are one hop away, eth_src is theirs
+        if isinstance(ev, EventBGPPacketIn) or\
+           self.cfg_mgr.is_internal_host(ev.src_ip):
+            self.host_db.learn_ip(ev.src_ip, ev.eth_src)
 
-    @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
-    @packet_in_filter(RequiredTypeFilter, {'types': [arp.arp]})
+    @set_ev_cls(EventArpPacketIn)
+    @timed
     def arp_packet_in_handler(self, ev):
         msg = ev.msg
         datapath = msg.datapath
         in_port = msg.match['in_port']
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
-        pkt = packet.Packet(msg.data)
-        arp_header = pkt.get_protocol(arp.arp)
-        src_ip = arp_header.src_ip
-        src_mac = arp_header.src_mac
-        dst_ip = arp_header.dst_ip
+        src_ip = ev.src_ip
+        src_mac = ev.src_mac
+        dst_ip = ev.dst_ip
         dst_mac = None
 
         if self.cfg_mgr.is_internal_host(src_ip):
             # if internal host sent arp request, reply router mac address
-            first_speaker_id = None
-
-            if self.cfg_mgr.get_all_speaker_id():
-                first_speaker_id = self.cfg_mgr.get_all_speaker_id()[0]
-
-            if first_speaker_id:
-                dst_mac = self.cfg_mgr.get_speaker_mac(first_speaker_id)
+            dst_mac = self.get_router_mac()
         else:
             dst_mac = self.arp_table.get(dst_ip)
 
-        self.arp_table.setdefault(src_ip, src_mac)
+        self.arp_table.learn(src_ip, src_mac, (datapath.id, in_port))
+        self.host_db.learn_ip(src_ip, src_mac)
 
-        if arp_header.opcode != arp.ARP_REQUEST:
+        if ev.opcode != arp.ARP_REQUEST:
             return
 
         if not dst_mac:
@@ -132,23 +360,38 @@ class ArpProxy(app_manager.RyuApp):
     def cmd_dump_arp_table(self):
         result = "{:<17}{:<17}\n".format("IP", "Mac")
 
-        for record in self.arp_table.items():
-            result = result + "{:<17}{:<17}\n".format(record[0], record[1])
+        for ip, mac, is_static in self.arp_table.items():
+            result = result + "{:<17}{:<17}{}\n".format(
+                ip, mac, "static" if is_static else "")
 
         return result
 
     def cmd_reload_static(self):
         result = ""
-        self.arp_table = {}
+        old_static_arp_table = self.static_arp_table
+        self.arp_table.clear()
+        self.static_arp_table = {}
+        self.load_static_arp_table()
 
-        if CONF.static_arp_table is not None:
-            # load static arp table
-            static_arp_table = json.load(open(CONF.static_arp_table, "r"))
+        if CONF.sdn_ip_arp_responder:
+            for dp in self.fwd.get_all_datapaths():
+                for ip in old_static_arp_table:
+                    if ip not in self.static_arp_table:
+                        self.delete_arp_responder(dp, ARP_RESPONDER_PRIORITY,
+                                                  target_ip=ip)
 
-            for record in static_arp_table:
-                self.arp_table.setdefault(record['ip'], record['mac'])
+                self.install_arp_responders(dp)
 
         result = "done"
+        return result
+
+    def cmd_arp_stats(self):
+        result = ""
+
+        for name, value in sorted(self.arp_table.get_stats().items()):
+            result = result + "{:<17}{}\n".format(name, value)
+
+        return result
 
     def cmd_who_has(self, *args):
 
@@ -1,15 +1,82 @@
 import json
+import numbers
+import os
+from bisect import bisect_right
 from ryu import cfg
-from netaddr import IPNetwork
+from ryu.base import app_manager
+from ryu.controller import event
+from ryu.lib import hub
+from ryu.ofproto import ofproto_v1_3
+from .ip_utils import IPV4_FULL_MASK
+from .ip_utils import ipv4_to_int, parse_prefix, prefix_id
+from .ip_utils import prefix_len_to_mask
 
 CONF = cfg.CONF
 
 CONF.register_cli_opts([
     cfg.StrOpt('sdn-ip-cfg-file',
                default="/usr/local/etc/ryu-sdn-ip/config.json",
-               help='location of SDN-IP config file')
+               help='location of SDN-IP config file'),
+    cfg.FloatOpt('sdn-ip-cfg-check-interval',
+                 default=5,
+                 help='seconds between checks of the config file for '
+                      'changes, 0 to disable')
 ])
 
+# integrate with DragonKnight CLI
+with_dk = False
+try:
+    from dragon_knight import dk_plugin
+    with_dk = True
+except ImportError as e:
+    pass
+
+
+class NetworkMatcher(object):
+    '''
+    Network list compiled to sorted integer intervals
+
+    Membership is a binary search over interval starts, exact network
+    check is a set lookup of prefix ids.
+    '''
+
+    def __init__(self, networks):
+        super(NetworkMatcher, self).__init__()
+        intervals = []
+        prefix_ids = set()
+
+        for network in networks:
+            addr, prefix_len = parse_prefix(network)
+            host_mask = IPV4_FULL_MASK ^ prefix_len_to_mask(prefix_len)
+            intervals.append((addr, addr | host_mask))
+            prefix_ids.add(prefix_id(addr, prefix_len))
+
+        # merge overlapping and adjacent intervals
+        starts = []
+        ends = []
+
+        for start, end in sorted(intervals):
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+
+            else:
+                starts.append(start)
+                ends.append(end)
+
+        self.starts = starts
+        self.ends = ends
+        self.prefix_ids = frozenset(prefix_ids)
+
+    def contains_ip(self, ip):
+        '''
+        ip: IPv4 address in integer
+        '''
+        index = bisect_right(self.starts, ip) - 1
+        return index >= 0 and ip <= self.ends[index]
+
+    def contains_network(self, addr, prefix_len):
+        return prefix_id(addr, prefix_len) in self.prefix_ids
+
 
 class SDNIPConfigManager(object):
 
@@ -20,40 +87,52 @@ class SDNIPConfigManager(object):
 
     def reload_config(self):
 
-        self.per_id = {}
-        self.per_dpid = {}
+        per_id = {}
+        per_dpid = {}
         speakers = []
         with open(self.config_file_path, 'r') as config_file:
             configs = json.load(config_file)
 
         speakers = configs['speakers']
         local_config = configs['local']
-        self.as_number = local_config.get('as_number', 65113)
-        self.router_id = local_config.get('router_id', '127.0.0.1')
-        self.listen_port = local_config.get('listen_port', 2000)
-        self.networks = local_config.get('networks', [])
+        networks = local_config.get('networks', [])
+        network_matcher = NetworkMatcher(networks)
 
         for speaker in speakers:
             dpid = speaker['dpid']
+
+            if not isinstance(dpid, numbers.Integral):
+                # hex string, e.g. "0000000000000002"
+                dpid = int(dpid, 16)
+
             port = speaker['port']
             mac = speaker['mac']
             speaker_ids = speaker['speaker_ids']
-            self.per_dpid.setdefault(dpid, [])
+            per_dpid.setdefault(dpid, [])
 
             for speaker_id in speaker_ids:
-                self.per_id.setdefault(speaker_id,
-                                       {'dpid': dpid,
-                                        'port': port,
-                                        'mac': mac})
-                self.per_dpid[dpid].append({'port': port,
-                                            'id': speaker_id,
-                                            'mac': mac})
+                per_id.setdefault(speaker_id,
+                                  {'dpid': dpid,
+                                   'port': port,
+                                   'mac': mac})
+                per_dpid[dpid].append({'port': port,
+                                       'id': speaker_id,
+                                       'mac': mac})
+
+        # everything is parsed, switch to the new config at once
+        self.per_id = per_id
+        self.per_dpid = per_dpid
+        self.as_number = local_config.get('as_number', 65113)
+        self.router_id = local_config.get('router_id', '127.0.0.1')
+        self.listen_port = local_config.get('listen_port', 2000)
+        self.networks = networks
+        self.network_matcher = network_matcher
 
     def get_speaker_connect_port(self, bgp_speaker_id):
         return self.per_id.get(bgp_speaker_id)
 
     def get_all_speaker_id(self):
-        return self.per_id.keys()
+        return list(self.per_id.keys())
 
     def get_all_speakers_by_dpid(self, dpid):
         return self.per_dpid[dpid]
@@ -62,13 +141,152 @@ class SDNIPConfigManager(object):
         return self.per_id.get(bgp_speaker_id)['mac']
 
     def is_internal_host(self, ip):
+        '''
+        ip: IPv4 address in string or integer
+        '''
+        if not isinstance(ip, numbers.Integral):
+            ip = ipv4_to_int(ip)
 
-        for network in self.networks:
-            nw = IPNetwork(network)
-            if ip in nw:
-                return True
+        return self.network_matcher.contains_ip(ip)
 
-        return False
+    def is_internal_network(self, prefix):
+        '''
+        True if prefix is exactly one of local networks
+        '''
+        return self.network_matcher.contains_network(*parse_prefix(prefix))
 
     def get_internal_networks(self):
         return self.networks
+
+
+class EventConfigChange(event.EventBase):
+    '''
+    Sent after the config file changed and was loaded again
+    added_speakers, removed_speakers: speaker ids
+    changed_speakers: speaker ids whose switch, port or mac changed
+    added_networks, removed_networks: internal networks
+    '''
+
+    def __init__(self, added_speakers, removed_speakers, changed_speakers,
+                 added_networks, removed_networks):
+        super(EventConfigChange, self).__init__()
+        self.added_speakers = added_speakers
+        self.removed_speakers = removed_speakers
+        self.changed_speakers = changed_speakers
+        self.added_networks = added_networks
+        self.removed_networks = removed_networks
+
+    def is_empty(self):
+        return not (self.added_speakers or self.removed_speakers or
+                    self.changed_speakers or self.added_networks or
+                    self.removed_networks)
+
+
+class SDNIPConfigService(app_manager.RyuApp):
+    '''
+    Config shared by SDN-IP apps
+
+    The config file is checked for changes by its stat, a changed file
+    is loaded again and apps get the difference in EventConfigChange.
+    '''
+    OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _EVENTS = [EventConfigChange]
+
+    def __init__(self, *args, **kwargs):
+        super(SDNIPConfigService, self).__init__(*args, **kwargs)
+        self.config = SDNIPConfigManager()
+        self.file_stat = self.get_file_stat()
+
+        if CONF.sdn_ip_cfg_check_interval > 0:
+            hub.spawn(self.watch_loop)
+
+        if with_dk:
+            dk_plugin.DynamicLoader.register_custom_cmd('sdn-ip:reload-config', self.cmd_reload_config)
+
+    def get_file_stat(self):
+        try:
+            stat = os.stat(self.config.config_file_path)
+
+        except OSError:
+            return None
+
+        return stat.st_ino, stat.st_size, stat.st_mtime
+
+    def watch_loop(self):
+
+        while True:
+            hub.sleep(CONF.sdn_ip_cfg_check_interval)
+            file_stat = self.get_file_stat()
+
+            if file_stat is None or file_stat == self.file_stat:
+                continue
+
+            self.file_stat = file_stat
+            self.reload()
+
+    def reload(self):
+        '''
+        Load the config file again and send what changed to apps
+        return: EventConfigChange, None if the file can't be loaded
+        '''
+        config = self.config
+        old_per_id = config.per_id
+        old_networks = set(config.networks)
+        old_local = (config.as_number, config.router_id, config.listen_port)
+
+        try:
+            config.reload_config()
+
+        except (IOError, ValueError, KeyError, TypeError,
+                AttributeError) as e:
+            # old config is kept
+            self.logger.error("Can't load config %s: %s",
+                              config.config_file_path, e)
+            return None
+
+        if old_local != (config.as_number, config.router_id,
+                         config.listen_port):
+            self.logger.warning("AS number, router id or listen port "
+                                "changed, restart SDN-IP to apply")
+
+        networks = set(config.networks)
+        ev = EventConfigChange(
+            [speaker_id for speaker_id in config.per_id
+             if speaker_id not in old_per_id],
+            [speaker_id for speaker_id in old_per_id
+             if speaker_id not in config.per_id],
+            [speaker_id for speaker_id, speaker in config.per_id.items()
+             if old_per_id.get(speaker_id, speaker) != speaker],
+            list(networks - old_networks),
+            list(old_networks - networks))
+
+        if ev.is_empty():
+            return ev
+
+        self.logger.info("config reloaded, speakers +%d -%d ~%d, "
+                         "networks +%d -%d",
+                         len(ev.added_speakers), len(ev.removed_speakers),
+                         len(ev.changed_speakers), len(ev.added_networks),
+                         len(ev.removed_networks))
+        self.send_event_to_observers(ev)
+        return ev
+
+    # commands
+    def cmd_reload_config(self):
+        self.file_stat = self.get_file_stat()
+        ev = self.reload()
+
+        if ev is None:
+            return "Failed to load config\n"
+
+        information = "Speakers added: {}\n" + \
+                      "Speakers removed: {}\n" + \
+                      "Speakers changed: {}\n" + \
+                      "Networks added: {}\n" + \
+                      "Networks removed: {}\n"
+
+        return information.format(', '.join(ev.added_speakers),
+                                  ', '.join(ev.removed_speakers),
+                                  ', '.join(ev.changed_speakers),
+                                  ', '.join(ev.added_networks),
+                                  ', '.join(ev.removed_networks))
@@ -0,0 +1,28 @@
+'''
+Flow cookies of SDN-IP
+
+The top byte tags the kind of flow, the rest carries its key, e.g. an
+IPv4 address in integer, so flows can be found and deleted by cookie.
+'''
+COOKIE_TYPE_SHIFT = 56
+COOKIE_TYPE_MASK = 0xff << COOKIE_TYPE_SHIFT
+COOKIE_VALUE_MASK = (1 << COOKIE_TYPE_SHIFT) - 1
+COOKIE_FULL_MASK = (1 << 64) - 1  # match one flow by its cookie
+
+COOKIE_PUNT = 0x01  # value: punt class
+COOKIE_INTERNAL_HOST = 0x02  # value: host IPv4 address
+COOKIE_ARP_RESPONDER = 0x03  # value: answered or asking IPv4 address
+COOKIE_ROUTE = 0x04  # value: prefix id
+COOKIE_NEXTHOP = 0x05  # value: next hop IPv4 address
+
+
+def make_cookie(cookie_type, value=0):
+    return (cookie_type << COOKIE_TYPE_SHIFT) | (value & COOKIE_VALUE_MASK)
+
+
+def get_cookie_type(cookie):
+    return cookie >> COOKIE_TYPE_SHIFT
+
+
+def get_cookie_value(cookie):
+    return cookie & COOKIE_VALUE_MASK
@@ -0,0 +1,135 @@
+from .ip_utils import parse_prefix, prefix_id
+
+
+class FibAggregator(object):
+    '''
+    Same next hop subsumption of the RIB
+
+    A route whose closest covering route has the same next hop needs no
+    flow of its own: without it, its traffic matches the covering flow
+    (or a suppressed covering route's own cover, with the same next hop
+    again). Routes inside it keep their own flows, so forwarding stays
+    the same. Only the changed route and the routes right below it can
+    change state when a route is added, moved or withdrawn.
+
+    The number of installed prefixes which are suppressed is counted per
+    next hop as suppression or install state changes, so flow counts
+    are read without walking the suppressed prefixes.
+    '''
+
+    def __init__(self, hop_db):
+        super(FibAggregator, self).__init__()
+        self.hop_db = hop_db
+        self.suppressed = {}  # next hop -> set of prefix id
+        self.installed_suppressed = {}  # next hop -> number of prefixes
+        hop_db.install_listener = self.install_changed
+
+    def is_suppressed(self, prefix, next_hop):
+        return prefix_id(*parse_prefix(prefix)) in\
+            self.suppressed.get(next_hop, ())
+
+    def update(self, prefix, old_next_hop=None):
+        '''
+        Update after the prefix was added, moved or withdrawn in HopDB
+        old_next_hop: next hop of the prefix before the change
+        return: list of (prefix, next hop, suppressed) of routes inside
+        the prefix whose state changed
+        '''
+        self._set(prefix_id(*parse_prefix(prefix)), old_next_hop, False)
+        next_hop = self.hop_db.get_nexthop(prefix)
+
+        if next_hop is not None:
+            self._set(prefix_id(*parse_prefix(prefix)), next_hop,
+                      self.hop_db.get_parent_nexthop(prefix) == next_hop)
+            parent_next_hop = next_hop
+
+        else:
+            parent_next_hop = self.hop_db.get_parent_nexthop(prefix)
+
+        changes = []
+
+        for child, child_next_hop in self.hop_db.get_child_routes(prefix):
+            suppressed = child_next_hop == parent_next_hop
+
+            if self._set(prefix_id(*parse_prefix(child)), child_next_hop,
+                         suppressed):
+                changes.append((child, child_next_hop, suppressed))
+
+        return changes
+
+    def rebuild(self):
+        self.suppressed = {}
+        self.installed_suppressed = {}
+
+        for prefix, next_hop, parent_next_hop in\
+                self.hop_db.get_parent_nexthops():
+            if next_hop == parent_next_hop:
+                self._set(prefix_id(*parse_prefix(prefix)), next_hop, True)
+
+    def get_suppressed_count(self):
+        return sum(len(prefix_ids) for prefix_ids in self.suppressed.values())
+
+    def get_flow_counts(self):
+        '''
+        return: next hop -> number of installed routes with their own
+        flow
+        '''
+        return dict((next_hop, len(prefix_ids) -
+                     self.installed_suppressed.get(next_hop, 0))
+                    for next_hop, prefix_ids
+                    in self.hop_db.installed_prefix.items())
+
+    def install_changed(self, _prefix_id, next_hop, installed):
+        '''
+        Called by HopDB when a prefix is installed or no longer installed
+        '''
+        if _prefix_id in self.suppressed.get(next_hop, ()):
+            self._count_installed(next_hop, 1 if installed else -1)
+
+    def _set(self, _prefix_id, next_hop, suppressed):
+        '''
+        return: True if the state changed
+        '''
+        if next_hop is None:
+            return False
+
+        prefix_ids = self.suppressed.get(next_hop)
+
+        if suppressed:
+            if prefix_ids is None:
+                prefix_ids = self.suppressed[next_hop] = set()
+
+            elif _prefix_id in prefix_ids:
+                return False
+
+            prefix_ids.add(_prefix_id)
+
+            if self._is_installed(_prefix_id, next_hop):
+                self._count_installed(next_hop, 1)
+
+            return True
+
+        if prefix_ids is None or _prefix_id not in prefix_ids:
+            return False
+
+        prefix_ids.discard(_prefix_id)
+
+        if not prefix_ids:
+            del self.suppressed[next_hop]
+
+        if self._is_installed(_prefix_id, next_hop):
+            self._count_installed(next_hop, -1)
+
+        return True
+
+    def _is_installed(self, _prefix_id, next_hop):
+        return _prefix_id in self.hop_db.installed_prefix.get(next_hop, ())
+
+    def _count_installed(self, next_hop, delta):
+        count = self.installed_suppressed.get(next_hop, 0) + delta
+
+        if count:
+            self.installed_suppressed[next_hop] = count
+
+        else:
+            del self.installed_suppressed[next_hop]
@@ -0,0 +1,331 @@
+import itertools
+from collections import deque
+from ryu.lib import hub
+from .metrics import REGISTRY
+
+FLOW_MESSAGES = REGISTRY.counter('sdnip_flow_messages_total',
+                                 'Flow messages queued for switches',
+                                 ['dpid', 'type'])
+
+
+class _DatapathQueue(object):
+
+    def __init__(self, dp):
+        super(_DatapathQueue, self).__init__()
+        self.dp = dp
+        self.dpid_label = '%016x' % dp.id
+        self.msgs = deque()
+        self.wakeup = hub.Event()
+        self.space = hub.Event()
+        self.space.set()
+        self.barriers = {}  # xid -> hub.Event
+        self.flushes = []  # _Flush
+        self.enqueued_seq = 0
+        self.sent_seq = 0  # last message of the last answered batch
+        # all messages up to this one are committed
+        self.committed_seq = 0
+        # first message of a batch the switch did not commit since
+        # clear_failures, 0 if none
+        self.failed_seq = 0
+        self.batch_xids = set()  # xids of the batch in flight
+        self.batch_error = None  # first error reply to the batch
+        self.bundle_id = None  # bundle of the batch in flight
+        self.bundle_committed = False
+        self.running = True
+        self.thread = None
+
+
+class _Flush(object):
+    '''
+    Returned by FlowWriter.flush, wait() returns True if all messages
+    sent before the flush are committed
+    '''
+
+    def __init__(self, seq):
+        super(_Flush, self).__init__()
+        self.seq = seq
+        self.event = hub.Event()
+        self.committed = True
+
+    def done(self, committed):
+        self.committed = committed
+        self.event.set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout=timeout)
+        return self.event.is_set() and self.committed
+
+
+class FlowWriter(object):
+    '''
+    Per datapath output pipeline for flow messages
+
+    Messages are sent in batches which end with a barrier request, or
+    are wrapped in an ONF bundle if use_bundle is set. Only one batch is
+    in flight for each datapath; when a datapath falls behind, send()
+    blocks until the queue drains below half of max_queue.
+
+    A batch is committed when its barrier reply, and the commit reply of
+    its bundle, arrive without an error reply to any of its messages.
+    Messages of a batch which is not committed are dropped and
+    on_failure is called with the datapath, so its flows can be
+    resynced.
+    '''
+
+    def __init__(self, logger, batch_size=64, max_queue=10000,
+                 use_bundle=False, barrier_timeout=5, on_failure=None):
+        super(FlowWriter, self).__init__()
+        self.logger = logger
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.use_bundle = use_bundle
+        self.barrier_timeout = barrier_timeout
+        self.on_failure = on_failure
+        self.queues = {}  # dpid -> _DatapathQueue
+        self._bundle_ids = itertools.count(1)
+
+    def send(self, dp, msg):
+        queue = self._get_queue(dp)
+
+        while len(queue.msgs) >= self.max_queue and queue.running:
+            # back-pressure, wait for the sender
+            queue.space.clear()
+            queue.space.wait()
+
+        queue.msgs.append(msg)
+        queue.enqueued_seq += 1
+        FLOW_MESSAGES.inc((queue.dpid_label, msg.__class__.__name__))
+        queue.wakeup.set()
+
+    def flush(self, dp):
+        '''
+        return: _Flush which is done when all messages sent to this
+        datapath so far are answered
+        '''
+        queue = self._get_queue(dp)
+        flush = _Flush(queue.enqueued_seq)
+
+        if queue.sent_seq >= flush.seq:
+            flush.done(self._is_committed(queue, flush.seq))
+
+        else:
+            queue.flushes.append(flush)
+
+        return flush
+
+    def clear_failures(self, dp):
+        '''
+        Forget batches which were not committed, e.g. after the flows of
+        the datapath were read again
+        '''
+        queue = self.queues.get(dp.id)
+
+        if queue is None:
+            return
+
+        queue.failed_seq = 0
+        queue.committed_seq = queue.sent_seq
+
+    def get_queue_length(self, dpid):
+        queue = self.queues.get(dpid)
+
+        if queue is None:
+            return 0
+
+        return len(queue.msgs)
+
+    def barrier_reply(self, msg):
+        queue = self.queues.get(msg.datapath.id)
+
+        if queue is None:
+            return
+
+        event = queue.barriers.pop(msg.xid, None)
+
+        if event is not None:
+            event.set()
+
+    def bundle_reply(self, msg):
+        queue = self.queues.get(msg.datapath.id)
+
+        if queue is None or msg.bundle_id != queue.bundle_id:
+            return
+
+        if msg.type == msg.datapath.ofproto.ONF_BCT_COMMIT_REPLY:
+            queue.bundle_committed = True
+
+    def error_reply(self, msg):
+        '''
+        return: True if the error is a reply to a message of the batch
+        in flight
+        '''
+        queue = self.queues.get(msg.datapath.id)
+
+        if queue is None or msg.xid not in queue.batch_xids:
+            return False
+
+        if queue.batch_error is None:
+            queue.batch_error = msg
+
+        return True
+
+    def remove_datapath(self, dpid):
+        queue = self.queues.pop(dpid, None)
+
+        if queue is None:
+            return
+
+        queue.running = False
+        queue.msgs.clear()
+        queue.wakeup.set()
+        queue.space.set()
+
+        for event in queue.barriers.values():
+            event.set()
+
+        for flush in queue.flushes:
+            flush.done(False)
+
+    def _get_queue(self, dp):
+        queue = self.queues.get(dp.id)
+
+        if queue is None:
+            queue = _DatapathQueue(dp)
+            queue.thread = hub.spawn(self._sender, queue)
+            self.queues[dp.id] = queue
+
+        elif queue.dp is not dp:
+            # switch reconnected
+            queue.dp = dp
+
+        return queue
+
+    def _sender(self, queue):
+
+        while queue.running:
+            if not queue.msgs:
+                queue.wakeup.clear()
+                queue.wakeup.wait()
+                continue
+
+            batch = []
+
+            while queue.msgs and len(batch) < self.batch_size:
+                batch.append(queue.msgs.popleft())
+
+            if len(queue.msgs) <= self.max_queue // 2:
+                queue.space.set()
+
+            first_seq = queue.sent_seq + 1
+            queue.sent_seq += len(batch)
+            dp = queue.dp
+
+            try:
+                committed = self._send_batch(queue, batch)
+
+            except Exception as e:
+                self.logger.error("Failed to send flows to %016x: %s",
+                                  dp.id, e)
+                committed = False
+
+            if not queue.running:
+                break
+
+            if committed:
+                if not queue.failed_seq:
+                    queue.committed_seq = queue.sent_seq
+
+            else:
+                self.logger.warning("%d flow messages to %016x are not "
+                                    "committed", len(batch), dp.id)
+
+                if not queue.failed_seq:
+                    queue.failed_seq = first_seq
+
+            self._notify_flushes(queue)
+
+            if not committed and self.on_failure is not None:
+                self.on_failure(dp)
+
+    def _send_batch(self, queue, batch):
+        '''
+        return: True if the switch committed the batch
+        '''
+        dp = queue.dp
+        ofproto = dp.ofproto
+        parser = dp.ofproto_parser
+        queue.batch_xids = set()
+        queue.batch_error = None
+        queue.bundle_id = None
+        queue.bundle_committed = False
+
+        if self.use_bundle and hasattr(parser, 'ONFBundleCtrlMsg'):
+            queue.bundle_id = next(self._bundle_ids) & 0xffffffff
+            flags = ofproto.ONF_BF_ATOMIC | ofproto.ONF_BF_ORDERED
+            self._send_msg(queue, parser.ONFBundleCtrlMsg(
+                dp, queue.bundle_id, ofproto.ONF_BCT_OPEN_REQUEST, flags,
+                []))
+
+            for msg in batch:
+                self._send_msg(queue, parser.ONFBundleAddMsg(
+                    dp, queue.bundle_id, flags, msg, []))
+
+            self._send_msg(queue, parser.ONFBundleCtrlMsg(
+                dp, queue.bundle_id, ofproto.ONF_BCT_COMMIT_REQUEST, flags,
+                []))
+
+        else:
+            for msg in batch:
+                self._send_msg(queue, msg)
+
+        # the switch answers in order, commit and error replies to the
+        # batch arrive before the barrier reply
+        barrier = parser.OFPBarrierRequest(dp)
+        dp.set_xid(barrier)
+        event = hub.Event()
+        queue.barriers[barrier.xid] = event
+        dp.send_msg(barrier)
+        replied = event.wait(timeout=self.barrier_timeout)
+        queue.barriers.pop(barrier.xid, None)
+        queue.batch_xids = set()
+
+        if not replied:
+            self.logger.warning("Barrier timeout on %016x", dp.id)
+            return False
+
+        if queue.batch_error is not None:
+            error = queue.batch_error
+            self.logger.warning("Error reply from %016x: type %d, code %d",
+                                dp.id, error.type, error.code)
+            return False
+
+        if queue.bundle_id is not None and not queue.bundle_committed:
+            self.logger.warning("Bundle %d not committed by %016x",
+                                queue.bundle_id, dp.id)
+            return False
+
+        return True
+
+    @staticmethod
+    def _send_msg(queue, msg):
+        if msg.xid is None:
+            queue.dp.set_xid(msg)
+
+        queue.batch_xids.add(msg.xid)
+        queue.dp.send_msg(msg)
+
+    @staticmethod
+    def _is_committed(queue, seq):
+        return not queue.failed_seq or queue.failed_seq > seq
+
+    def _notify_flushes(self, queue):
+        pending = []
+
+        for flush in queue.flushes:
+            if flush.seq <= queue.sent_seq:
+                flush.done(self._is_committed(queue, flush.seq))
+
+            else:
+                pending.append(flush)
+
+        queue.flushes = pending
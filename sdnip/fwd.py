@@ -1,9 +1,11 @@
 import networkx as nx
+from ryu import cfg
 from ryu.base import app_manager
+from ryu.controller import event
 from ryu.controller import ofp_event
 from ryu.controller.handler import MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
-from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
 from ryu.lib.ip import ipv4_to_bin
 from ryu.lib.mac import haddr_to_bin
 from ryu.lib.packet import packet
@@ -12,6 +14,83 @@ from ryu.lib.packet import ether_types
 from ryu.lib.packet import tcp, udp
 from ryu.lib.packet import ipv4, arp
 from ryu.topology import api as topo_api
+from ryu.topology import event as topo_event
+from .flow_writer import FlowWriter
+from .metrics import REGISTRY, timed
+
+CONF = cfg.CONF
+FULL_MASKS = ('255.255.255.255', 'ff:ff:ff:ff:ff:ff', 0xffffffffffffffff)
+CONF.register_cli_opts([
+    cfg.IntOpt('sdn-ip-flow-batch-size',
+               default=64,
+               help='max number of flow messages between two barriers'),
+    cfg.IntOpt('sdn-ip-flow-queue-size',
+               default=10000,
+               help='queued flow messages per switch before senders block'),
+    cfg.BoolOpt('sdn-ip-flow-bundle',
+                default=False,
+                help='send each flow batch as an ONF bundle'),
+    cfg.BoolOpt('sdn-ip-ecmp',
+                default=False,
+                help='spread traffic to BGP next hops over all equal-cost '
+                     'paths with select groups')
+])
+MAX_BUCKET_WEIGHT = 0xffff
+SWITCHES = REGISTRY.gauge('sdnip_switches', 'Connected switches')
+LINKS = REGISTRY.gauge('sdnip_links', 'Links between switches')
+FLOW_QUEUE_LENGTH = REGISTRY.gauge('sdnip_flow_queue_length',
+                                   'Flow messages waiting to be sent',
+                                   ['dpid'])
+
+
+def get_flow_key(table_id, priority, match):
+    '''
+    Identity of a flow entry in a switch, an exact mask is the same
+    as no mask
+    '''
+    fields = []
+
+    for field, value in match.items():
+        if isinstance(value, tuple) and value[1] in FULL_MASKS:
+            value = value[0]
+
+        fields.append((field, value))
+
+    return table_id, priority, tuple(sorted(fields))
+
+
+def get_instructions_key(instructions):
+    buf = bytearray()
+
+    for instruction in instructions:
+        instruction.serialize(buf, len(buf))
+
+    return bytes(buf)
+
+
+class EventTopologyChange(event.EventBase):
+    '''
+    Sent after the topology graph of Fwd is updated
+    removed_links: (dpid, port no) of links which went away
+    removed_dpids: switches which went away
+    '''
+
+    def __init__(self, version, removed_links=None, removed_dpids=None):
+        super(EventTopologyChange, self).__init__()
+        self.version = version
+        self.removed_links = removed_links or []
+        self.removed_dpids = removed_dpids or []
+
+
+class EventFlowCommitFailure(event.EventBase):
+    '''
+    Sent when a switch didn't commit a batch of flow messages, the
+    messages are dropped and the flows of the switch need a resync
+    '''
+
+    def __init__(self, datapath):
+        super(EventFlowCommitFailure, self).__init__()
+        self.datapath = datapath
 
 
 class Fwd(app_manager.RyuApp):
@@ -19,11 +98,144 @@ class Fwd(app_manager.RyuApp):
     Forward utilization
     '''
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _EVENTS = [EventTopologyChange, EventFlowCommitFailure]
 
     def __init__(self, *args, **kwargs):
         super(Fwd, self).__init__(*args, **kwargs)
         self.dps = {}
+        self.graph = nx.DiGraph()  # maintained by topology events
+        self.graph_version = 0
+        self.spt_cache = {}  # (dpid, port no) -> {dpid: out port no}
+        # (dpid, port no) -> {dpid: ((out port no, weight), ...)}
+        self.ecmp_cache = {}
+        self.groups = {}  # dpid -> {group id: buckets}
+        # groups read from switches under resync which are not set
+        # again yet, dpid -> {group id: buckets}
+        self.group_snapshots = {}
+        # flows read from switches under resync,
+        # dpid -> {flow key: (cookie, instructions key)}
+        self.flow_snapshots = {}
+        self.unconfirmed_flows = {}  # dpid -> set of flow key
+        self.writer = FlowWriter(self.logger,
+                                 batch_size=CONF.sdn_ip_flow_batch_size,
+                                 max_queue=CONF.sdn_ip_flow_queue_size,
+                                 use_bundle=CONF.sdn_ip_flow_bundle,
+                                 on_failure=self.flow_commit_failed)
+        REGISTRY.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        SWITCHES.set(len(self.dps))
+        LINKS.set(sum(len(ports) for _, _, ports
+                      in self.graph.edges(data='ports')))
+        FLOW_QUEUE_LENGTH.clear()
+
+        for dpid in self.dps:
+            FLOW_QUEUE_LENGTH.set(self.writer.get_queue_length(dpid),
+                                  ('%016x' % dpid,))
+
+    @set_ev_cls(topo_event.EventSwitchEnter)
+    def switch_enter_handler(self, ev):
+        dp = ev.switch.dp
+        self.dps[dp.id] = dp
+        self.graph.add_node(dp.id)
+        self.topology_changed()
+
+    @set_ev_cls(topo_event.EventSwitchLeave)
+    def switch_leave_handler(self, ev):
+        dpid = ev.switch.dp.id
+        self.dps.pop(dpid, None)
+        self.writer.remove_datapath(dpid)
+        self.groups.pop(dpid, None)
+        self.group_snapshots.pop(dpid, None)
+        self.flow_snapshots.pop(dpid, None)
+        self.unconfirmed_flows.pop(dpid, None)
+        removed_links = []
+
+        if dpid in self.graph:
+            # links toward the switch are removed with it
+            for prev_dpid in self.graph.pred[dpid]:
+                removed_links.extend(
+                    (prev_dpid, port_no)
+                    for port_no in self.graph[prev_dpid][dpid]['ports'])
+
+            self.graph.remove_node(dpid)
+
+        self.topology_changed(removed_links, [dpid])
+
+    @set_ev_cls(topo_event.EventLinkAdd)
+    def link_add_handler(self, ev):
+        link = ev.link
+
+        if not self.graph.has_edge(link.src.dpid, link.dst.dpid):
+            self.graph.add_edge(link.src.dpid, link.dst.dpid, ports={})
+
+        # parallel links between two switches share one edge
+        edge = self.graph[link.src.dpid][link.dst.dpid]
+        edge['ports'][link.src.port_no] = link.dst.port_no
+        self.set_edge_ports(edge)
+        self.topology_changed()
+
+    @set_ev_cls(topo_event.EventLinkDelete)
+    def link_delete_handler(self, ev):
+        link = ev.link
+
+        if not self.graph.has_edge(link.src.dpid, link.dst.dpid):
+            return
+
+        edge = self.graph[link.src.dpid][link.dst.dpid]
+
+        if edge['ports'].pop(link.src.port_no, None) is None:
+            return
+
+        if edge['ports']:
+            # keep the edge on a parallel link which is still up
+            self.set_edge_ports(edge)
+
+        else:
+            self.graph.remove_edge(link.src.dpid, link.dst.dpid)
+
+        self.topology_changed([(link.src.dpid, link.src.port_no)])
+
+    @staticmethod
+    def set_edge_ports(edge):
+        '''
+        Set src_port and dst_port of an edge to its lowest link, used by
+        single path forwarding
+        '''
+        edge['src_port'] = min(edge['ports'])
+        edge['dst_port'] = edge['ports'][edge['src_port']]
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def barrier_reply_handler(self, ev):
+        self.writer.barrier_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventONFBundleCtrlMsg, MAIN_DISPATCHER)
+    def bundle_reply_handler(self, ev):
+        self.writer.bundle_reply(ev.msg)
 
+    @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER)
+    def error_msg_handler(self, ev):
+        self.writer.error_reply(ev.msg)
+
+    def flow_commit_failed(self, datapath):
+
+        if datapath.id in self.flow_snapshots:
+            # flows replayed by a resync are not resynced again, so a
+            # flow the switch always rejects doesn't resync it forever
+            return
+
+        self.send_event_to_observers(EventFlowCommitFailure(datapath))
+
+    def topology_changed(self, removed_links=None, removed_dpids=None):
+        self.graph_version += 1
+        self.spt_cache = {}
+        self.ecmp_cache = {}
+        self.send_event_to_observers(
+            EventTopologyChange(self.graph_version,
+                                removed_links,
+                                removed_dpids))
+
+    @timed
     def setup_shortest_path(self,
                             from_dpid,
                             to_dpid,
@@ -55,36 +267,358 @@ class Fwd(app_manager.RyuApp):
             self.add_flow(dst_dp, 1, to_dst_match, pre_actions+actions)
 
             # packet out
-            port_no = nx_grapth.edge[path[0]][path[1]]['src_port']
+            port_no = nx_grapth[path[0]][path[1]]['src_port']
 
         return port_no
 
+    @timed
+    def setup_shortest_path_tree(self,
+                                 to_dpid,
+                                 to_port_no,
+                                 to_dst_match,
+                                 pre_actions=None,
+                                 priority=1,
+                                 only_dpids=None,
+                                 **kwargs):
+        '''
+        Install one flow on every switch which can reach to_dpid
+        only_dpids: install to these switches only, None for all
+        kwargs: passed to OFPFlowMod, e.g. table_id or cookie
+        '''
+        if pre_actions is None:
+            pre_actions = []
+
+        tree = self.get_shortest_path_tree(to_dpid, to_port_no)
+
+        for dpid, port_no in tree.items():
+            dp = self.dps.get(dpid)
+
+            if dp is None or (only_dpids is not None and
+                              dpid not in only_dpids):
+                continue
+
+            actions = [dp.ofproto_parser.OFPActionOutput(port_no)]
+            self.add_flow(dp, priority, to_dst_match, pre_actions+actions,
+                          **kwargs)
+
+        return tree
+
+    def update_shortest_path_tree(self,
+                                  old_tree,
+                                  to_dpid,
+                                  to_port_no,
+                                  to_dst_match,
+                                  pre_actions=None,
+                                  priority=1,
+                                  **kwargs):
+        '''
+        Move flows installed by setup_shortest_path_tree to the current
+        tree, only switches whose output port changed are updated.
+        old_tree: tree of the installed flows, None to install all
+        '''
+        tree = self.get_shortest_path_tree(to_dpid, to_port_no)
+
+        if old_tree is tree:
+            return tree
+
+        only_dpids = None
+
+        if old_tree is not None:
+            only_dpids = set(dpid for dpid, port_no in tree.items()
+                             if old_tree.get(dpid) != port_no)
+
+        self.setup_shortest_path_tree(to_dpid,
+                                      to_port_no,
+                                      to_dst_match,
+                                      pre_actions,
+                                      priority,
+                                      only_dpids=only_dpids,
+                                      **kwargs)
+        self.prune_tree(old_tree, tree, to_dst_match, priority,
+                        kwargs.get('table_id', 0))
+        return tree
+
+    def prune_tree(self, old_tree, tree, to_dst_match, priority, table_id=0):
+        '''
+        Delete flows on switches which can no longer reach the destination
+        '''
+        for dpid in (old_tree or {}):
+            dp = self.dps.get(dpid)
+
+            if dpid in tree or dp is None:
+                continue
+
+            self.delete_flow(dp, to_dst_match, strict=True,
+                             priority=priority,
+                             table_id=table_id)
+
+    def get_shortest_path_tree(self, to_dpid, to_port_no):
+        '''
+        Reverse BFS from the egress port, cached until topology changes
+        return: {dpid: out port no}
+        '''
+        key = (to_dpid, to_port_no)
+        tree = self.spt_cache.get(key)
+
+        if tree is not None:
+            return tree
+
+        tree = {}
+
+        if to_dpid in self.graph:
+            tree[to_dpid] = to_port_no
+            queue = [to_dpid]
+
+            for dpid in queue:
+                for prev_dpid in self.graph.pred[dpid]:
+                    if prev_dpid in tree:
+                        continue
+
+                    tree[prev_dpid] =\
+                        self.graph[prev_dpid][dpid]['src_port']
+                    queue.append(prev_dpid)
+
+        self.spt_cache[key] = tree
+        return tree
+
+    def get_ecmp_tree(self, to_dpid, to_port_no):
+        '''
+        Reverse BFS from the egress port which keeps every equal-cost
+        next hop, cached until topology changes
+        return: {dpid: ((out port no, weight), ...)}, weight is the
+        number of shortest paths to the egress through the port
+        '''
+        key = (to_dpid, to_port_no)
+        tree = self.ecmp_cache.get(key)
+
+        if tree is not None:
+            return tree
+
+        buckets = {}
+
+        if to_dpid in self.graph:
+            buckets[to_dpid] = [(to_port_no, 1)]
+            distances = {to_dpid: 0}
+            path_counts = {to_dpid: 1}
+            queue = [to_dpid]
+
+            # switches are visited by distance, so the path count of a
+            # switch is complete before its predecessors are visited
+            for dpid in queue:
+                distance = distances[dpid] + 1
+
+                for prev_dpid in self.graph.pred[dpid]:
+                    if prev_dpid not in distances:
+                        distances[prev_dpid] = distance
+                        path_counts[prev_dpid] = 0
+                        buckets[prev_dpid] = []
+                        queue.append(prev_dpid)
+
+                    if distances[prev_dpid] != distance:
+                        continue
+
+                    # every parallel link is an equal-cost next hop
+                    ports = self.graph[prev_dpid][dpid]['ports']
+                    path_counts[prev_dpid] += path_counts[dpid] * len(ports)
+                    buckets[prev_dpid].extend(
+                        (port_no, min(path_counts[dpid], MAX_BUCKET_WEIGHT))
+                        for port_no in ports)
+
+        tree = dict((dpid, tuple(sorted(dpid_buckets)))
+                    for dpid, dpid_buckets in buckets.items())
+        self.ecmp_cache[key] = tree
+        return tree
+
+    @timed
+    def setup_ecmp_tree(self,
+                        group_id,
+                        tree,
+                        to_dst_match,
+                        pre_actions=None,
+                        priority=1,
+                        only_dpids=None,
+                        **kwargs):
+        '''
+        Install one flow to the select group on every switch of tree,
+        groups are set by update_ecmp_groups
+        tree: from get_ecmp_tree
+        only_dpids: install to these switches only, None for all
+        '''
+        if pre_actions is None:
+            pre_actions = []
+
+        for dpid in tree:
+            dp = self.dps.get(dpid)
+
+            if dp is None or (only_dpids is not None and
+                              dpid not in only_dpids):
+                continue
+
+            actions = [dp.ofproto_parser.OFPActionGroup(group_id)]
+            self.add_flow(dp, priority, to_dst_match, pre_actions+actions,
+                          **kwargs)
+
+    def update_ecmp_tree(self,
+                         group_id,
+                         old_tree,
+                         to_dpid,
+                         to_port_no,
+                         to_dst_match,
+                         pre_actions=None,
+                         priority=1,
+                         **kwargs):
+        '''
+        Move flows installed by setup_ecmp_tree to the current equal-cost
+        tree, buckets of changed switches are updated in place, flows
+        are only added to switches which join the tree.
+        old_tree: tree of the installed flows, None to install all
+        '''
+        tree = self.get_ecmp_tree(to_dpid, to_port_no)
+
+        if old_tree is tree:
+            return tree
+
+        # groups first, new flows point to them
+        self.update_ecmp_groups(group_id, tree)
+        only_dpids = None
+
+        if old_tree is not None:
+            only_dpids = set(dpid for dpid in tree if dpid not in old_tree)
+
+        self.setup_ecmp_tree(group_id,
+                             tree,
+                             to_dst_match,
+                             pre_actions,
+                             priority,
+                             only_dpids=only_dpids,
+                             **kwargs)
+        self.prune_tree(old_tree, tree, to_dst_match, priority,
+                        kwargs.get('table_id', 0))
+        return tree
+
+    def update_ecmp_groups(self, group_id, tree):
+        '''
+        Make the select group on every switch match tree, only groups
+        whose buckets changed are sent
+        tree: from get_ecmp_tree, empty to delete the group everywhere
+        '''
+        for dpid, dp in self.dps.items():
+            groups = self.groups.setdefault(dpid, {})
+            buckets = tree.get(dpid)
+            snapshot = self.group_snapshots.get(dpid)
+
+            if snapshot is not None and group_id in snapshot:
+                # switch kept the group from before, reuse it
+                groups[group_id] = snapshot.pop(group_id)
+
+            old_buckets = groups.get(group_id)
+
+            if buckets == old_buckets:
+                continue
+
+            ofproto = dp.ofproto
+
+            if buckets is None:
+                # flows to the group are deleted with it
+                del groups[group_id]
+                self.send_group_mod(dp, ofproto.OFPGC_DELETE, group_id)
+                continue
+
+            command = ofproto.OFPGC_ADD if old_buckets is None\
+                else ofproto.OFPGC_MODIFY
+            groups[group_id] = buckets
+            self.send_group_mod(dp, command, group_id, buckets)
+
+    def start_group_resync(self, datapath, group_stats):
+        '''
+        Reconcile groups of a switch with groups it already has, missing
+        groups are added and changed ones modified. Groups not set since
+        the switch connected are kept until finish_group_resync, flows
+        of the last connection still point to them.
+        group_stats: OFPGroupDescStats of the switch
+        '''
+        ofproto = datapath.ofproto
+        groups = self.groups.setdefault(datapath.id, {})
+        snapshot = {}
+
+        for stats in group_stats:
+            snapshot[stats.group_id] = self.get_group_buckets(stats)
+
+        for group_id, buckets in groups.items():
+            if group_id not in snapshot:
+                self.send_group_mod(datapath, ofproto.OFPGC_ADD, group_id,
+                                    buckets)
+
+            elif snapshot.pop(group_id) != buckets:
+                self.send_group_mod(datapath, ofproto.OFPGC_MODIFY,
+                                    group_id, buckets)
+
+        self.group_snapshots[datapath.id] = snapshot
+
+    def finish_group_resync(self, datapath):
+        '''
+        Delete groups read by start_group_resync which are not set again
+        return: number of deleted groups
+        '''
+        snapshot = self.group_snapshots.pop(datapath.id, {})
+
+        for group_id in snapshot:
+            self.send_group_mod(datapath, datapath.ofproto.OFPGC_DELETE,
+                                group_id)
+
+        return len(snapshot)
+
+    @staticmethod
+    def get_group_buckets(stats):
+        '''
+        return: (out port no, weight) of buckets as send_group_mod takes
+        them, empty if the group is not a select group of output buckets
+        '''
+        if stats.type != ofproto_v1_3.OFPGT_SELECT:
+            return ()
+
+        buckets = []
+
+        for bucket in stats.buckets:
+            ports = [action.port for action in bucket.actions
+                     if isinstance(action,
+                                   ofproto_v1_3_parser.OFPActionOutput)]
+
+            if len(ports) != 1 or len(bucket.actions) != 1:
+                return ()
+
+            buckets.append((ports[0], bucket.weight))
+
+        return tuple(sorted(buckets))
+
+    def send_group_mod(self, datapath, command, group_id, buckets=()):
+        '''
+        buckets: (out port no, weight) of select group buckets
+        '''
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        group_buckets = [
+            parser.OFPBucket(weight=weight,
+                             watch_port=port_no,
+                             watch_group=ofproto.OFPG_ANY,
+                             actions=[parser.OFPActionOutput(port_no)])
+            for port_no, weight in buckets]
+        mod = parser.OFPGroupMod(datapath, command, ofproto.OFPGT_SELECT,
+                                 group_id, group_buckets)
+        self.writer.send(datapath, mod)
+
     def get_shortest_path(self, nx_graph, src_dpid, dst_dpid):
 
+        if src_dpid not in nx_graph or dst_dpid not in nx_graph:
+            return None
+
         if nx.has_path(nx_graph, src_dpid, dst_dpid):
             return nx.shortest_path(nx_graph, src_dpid, dst_dpid)
 
         return None
 
     def get_nx_graph(self):
-        graph = nx.DiGraph()
-        switches = topo_api.get_all_switch(self)
-        links = topo_api.get_all_link(self)
-
-        for switch in switches:
-            dpid = switch.dp.id
-            graph.add_node(dpid)
-
-        for link in links:
-            src_dpid = link.src.dpid
-            dst_dpid = link.dst.dpid
-            src_port = link.src.port_no
-            dst_port = link.dst.port_no
-            graph.add_edge(src_dpid,
-                           dst_dpid,
-                           src_port=src_port,
-                           dst_port=dst_port)
-        return graph
+        return self.graph
 
     def install_path(self, match, path, nx_graph, pre_actions=None):
         '''
@@ -95,22 +629,134 @@ class Fwd(app_manager.RyuApp):
         for index, dpid in enumerate(path[:-1]):
             # edge[path[index]][path[index + 1]]
             # => path[index] to path[index+1] port
-            port_no = nx_graph.edge[path[index]][path[index + 1]]['src_port']
+            port_no = nx_graph[path[index]][path[index + 1]]['src_port']
             dp = self.get_datapath(dpid)
             actions = [dp.ofproto_parser.OFPActionOutput(port_no)]
             self.add_flow(dp, 1, match, pre_actions+actions)
 
-    def add_flow(self, datapath, priority, match, actions):
+    def add_flow(self, datapath, priority, match, actions,
+                 instructions=None, **kwargs):
+        '''
+        actions: apply actions, None for no apply actions instruction
+        instructions: extra instructions, e.g. goto table
+        kwargs: passed to OFPFlowMod
+        '''
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        inst = []
+
+        if actions is not None:
+            inst.append(
+                parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
+                                             actions))
+
+        if instructions:
+            inst.extend(instructions)
+
+        snapshot = self.flow_snapshots.get(datapath.id)
+
+        if snapshot is not None:
+            key = get_flow_key(kwargs.get('table_id', 0), priority, match)
+            value = (kwargs.get('cookie', 0), get_instructions_key(inst))
+            self.unconfirmed_flows[datapath.id].discard(key)
+
+            if snapshot.get(key) == value:
+                # switch already has this flow
+                return
+
+            snapshot[key] = value
 
-        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
-                                             actions)]
         mod = parser.OFPFlowMod(datapath=datapath,
                                 priority=priority,
                                 match=match,
-                                instructions=inst)
-        datapath.send_msg(mod)
+                                instructions=inst,
+                                **kwargs)
+        self.writer.send(datapath, mod)
+
+    def delete_flow(self, datapath, match, strict=False, **kwargs):
+        '''
+        strict: only delete flow with the same match and priority
+        '''
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        command = ofproto.OFPFC_DELETE_STRICT if strict\
+            else ofproto.OFPFC_DELETE
+        kwargs.setdefault('out_port', ofproto.OFPP_ANY)
+        kwargs.setdefault('out_group', ofproto.OFPG_ANY)
+        snapshot = self.flow_snapshots.get(datapath.id)
+
+        if snapshot is not None and strict:
+            key = get_flow_key(kwargs.get('table_id', 0),
+                               kwargs.get('priority', 0),
+                               match)
+            snapshot.pop(key, None)
+            self.unconfirmed_flows[datapath.id].discard(key)
+
+        elif snapshot is not None:
+            # can't tell which flows are deleted, stop using the snapshot
+            self.finish_flow_resync(datapath, delete_unconfirmed=False)
+
+        mod = parser.OFPFlowMod(datapath=datapath,
+                                command=command,
+                                match=match,
+                                **kwargs)
+        self.writer.send(datapath, mod)
+
+    def start_flow_resync(self, datapath, flow_stats):
+        '''
+        Start to reconcile flows of a switch with flows it already has,
+        until finish_flow_resync, add_flow skips flows the switch has
+        flow_stats: OFPFlowStats of flows to reconcile
+        '''
+        snapshot = {}
+
+        for stats in flow_stats:
+            key = get_flow_key(stats.table_id, stats.priority, stats.match)
+            snapshot[key] = (stats.cookie,
+                             get_instructions_key(stats.instructions))
+
+        self.flow_snapshots[datapath.id] = snapshot
+        self.unconfirmed_flows[datapath.id] = set(snapshot.keys())
+        # flows which were not committed before are fixed by the resync
+        self.writer.clear_failures(datapath)
+
+    def finish_flow_resync(self, datapath, delete_unconfirmed=True):
+        '''
+        delete_unconfirmed: delete flows in the snapshot which are not
+        added again since start_flow_resync
+        return: number of deleted flows
+        '''
+        self.flow_snapshots.pop(datapath.id, None)
+        unconfirmed = self.unconfirmed_flows.pop(datapath.id, set())
+
+        if not delete_unconfirmed:
+            return 0
+
+        parser = datapath.ofproto_parser
+
+        for table_id, priority, fields in unconfirmed:
+            self.delete_flow(datapath, parser.OFPMatch(**dict(fields)),
+                             strict=True, priority=priority,
+                             table_id=table_id)
+
+        return len(unconfirmed)
+
+    def flush(self, datapaths=None):
+        '''
+        Wait until flows sent to datapaths are answered
+        datapaths: None for all datapaths
+        return: True if all of them are committed
+        '''
+        if datapaths is None:
+            datapaths = self.get_all_datapaths()
+
+        flushes = [self.writer.flush(dp) for dp in datapaths]
+        committed = True
+
+        for flush in flushes:
+            committed = flush.wait() and committed
+
+        return committed
 
     def get_datapath(self, dpid):
         if dpid not in self.dps:
@@ -121,14 +767,7 @@ class Fwd(app_manager.RyuApp):
         return self.dps[dpid]
 
     def get_all_datapaths(self):
-        switches = topo_api.get_all_switch(self)
-
-        for switch in switches:
-            dp = switch.dp
-            dpid = dp.id
-            self.dps[dpid] = dp
-
-        return self.dps.values()
+        return list(self.dps.values())
 
     def get_all_edge_port(self):
         edge_ports = set()
@@ -138,7 +777,9 @@ class Fwd(app_manager.RyuApp):
             not_edge_port.add(link.src)
             not_edge_port.add(link.dst)
 
-        for switch in topo_api.get_all_switch(self)
+        for switch in topo_api.get_all_switch(self):
             for port in switch.ports:
                 if port not in not_edge_port:
                     edge_ports.add(port)
+
+        return edge_ports
@@ -1,18 +1,68 @@
-import networkx as nx
+import time
+from collections import OrderedDict
+from ryu import cfg
 from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import MAIN_DISPATCHER, CONFIG_DISPATCHER
 from ryu.controller.handler import set_ev_cls
-from ryu.ofproto import ofproto_v1_0, ofproto_v1_3
-from ryu.lib.packet import packet
-from ryu.lib.packet import ethernet
+from ryu.lib import hub
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
 from ryu.lib.packet import in_proto
-from ryu.lib.packet import ipv4
-from ryu.lib.packet import tcp
 from ryu.lib.packet import ether_types
-from ryu.topology import api as topo_api
-from .conf_mgr import SDNIPConfigManager
-from .fwd import Fwd
+from .conf_mgr import SDNIPConfigService, EventConfigChange
+from .cookies import COOKIE_PUNT, COOKIE_TYPE_MASK
+from .cookies import make_cookie, get_cookie_value
+from .fwd import Fwd, EventTopologyChange
+from .host_db import HostDB, EventHostUpdate, EventHostRemove
+from .packet_in import PacketInDispatcher, EventBGPPacketIn, BGP_PORT
+from .ip_utils import int_to_ipv4, parse_prefix, prefix_len_to_mask
+from .metrics import timed
+
+CONF = cfg.CONF
+CONF.register_cli_opts([
+    cfg.IntOpt('sdn-ip-punt-arp-rate',
+               default=100,
+               help='ARP packets per second sent to controller, '
+                    '0 for unlimited'),
+    cfg.IntOpt('sdn-ip-punt-bgp-rate',
+               default=1000,
+               help='BGP packets per second sent to controller, '
+                    '0 for unlimited'),
+    cfg.IntOpt('sdn-ip-punt-ipv4-rate',
+               default=100,
+               help='IPv4 packets to internal networks per second sent to '
+                    'controller, 0 for unlimited')
+])
+
+# above routes and internal host paths of SDN-IP
+BGP_PRIORITY = 100
+
+# below all forwarding rules, only the table-miss drop rule is lower
+PUNT_PRIORITY = 1
+DROP_PRIORITY = 0
+
+# punt classes, each class uses the meter with the same id
+PUNT_DROP = 0
+PUNT_ARP = 1
+PUNT_BGP = 2
+PUNT_IPV4 = 3
+PUNT_CLASS_NAMES = {PUNT_DROP: 'unknown',
+                    PUNT_ARP: 'arp',
+                    PUNT_BGP: 'bgp',
+                    PUNT_IPV4: 'ipv4'}
+STATS_TIMEOUT = 5
+
+# peer seen in a BGP session with a speaker before it is a known host
+PEER_CANDIDATE_LIMIT = 1024
+PEER_CANDIDATE_TTL = 300
+
+# integrate with DragonKnight CLI
+with_dk = False
+try:
+    from dragon_knight import dk_plugin
+    with_dk = True
+except ImportError as e:
+    pass
 
 
 class FwdBGP(app_manager.RyuApp):
@@ -21,71 +71,269 @@ class FwdBGP(app_manager.RyuApp):
     '''
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
     _CONTEXTS = {
-        'fwd': Fwd
+        'cfg_service': SDNIPConfigService,
+        'fwd': Fwd,
+        'host_db': HostDB,
+        'pkt_dispatcher': PacketInDispatcher
     }
 
     def __init__(self, *args, **kwargs):
         super(FwdBGP, self).__init__(*args, **kwargs)
-        self.cfg_mgr = SDNIPConfigManager()
+        self.cfg_mgr = kwargs['cfg_service'].config
         self.fwd = kwargs['fwd']
+        self.host_db = kwargs['host_db']
+        self.bgp_paths = {}  # ip -> ((dpid, port no), tree)
+        # ip of known hosts seen in BGP sessions with speakers
+        self.bgp_peers = set()
+        # ip -> expire time, oldest first, promoted to bgp_peers when
+        # the host is learned
+        self.peer_candidates = OrderedDict()
+        self.clock = time.time
+        self.punt_rates = {PUNT_ARP: CONF.sdn_ip_punt_arp_rate,
+                           PUNT_BGP: CONF.sdn_ip_punt_bgp_rate,
+                           PUNT_IPV4: CONF.sdn_ip_punt_ipv4_rate}
+        self.waiters = {}
+
+        if with_dk:
+            dk_plugin.DynamicLoader.register_custom_cmd('sdn-ip:punt-stats', self.cmd_punt_stats)
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
-        datapath = ev.msg.datapath
+        self.install_punt_policy(ev.msg.datapath)
+
+    def install_punt_policy(self, datapath):
+        '''
+        Send only ARP, BGP and IPv4 to internal networks to controller,
+        each class is rate limited by its own meter; anything else is
+        dropped by the table-miss rule.
+        LLDP for topology discovery is punted by Ryu itself.
+        '''
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
-        match = parser.OFPMatch()
+        punt_matches = [
+            (PUNT_ARP, parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP))
+            ]
+
+        for bgp_match in ({'tcp_src': BGP_PORT}, {'tcp_dst': BGP_PORT}):
+            punt_matches.append(
+                (PUNT_BGP, parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP,
+                                           ip_proto=in_proto.IPPROTO_TCP,
+                                           **bgp_match)))
+
+        for network in self.cfg_mgr.get_internal_networks():
+            punt_matches.append((PUNT_IPV4, self.get_network_match(network)))
+
+        for punt_class, rate in self.punt_rates.items():
+            self.set_punt_meter(datapath, punt_class, rate)
+
+        for punt_class, match in punt_matches:
+            self.add_punt_flow(datapath, punt_class, match)
+
+        # no action, drop
+        self.add_flow(datapath, DROP_PRIORITY, parser.OFPMatch(), None,
+                      cookie=make_cookie(COOKIE_PUNT, PUNT_DROP))
+
+    def add_punt_flow(self, datapath, punt_class, match):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        instructions = []
+
+        if self.punt_rates[punt_class]:
+            instructions.append(parser.OFPInstructionMeter(punt_class))
+
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
                                           ofproto.OFPCML_NO_BUFFER)]
-        self.add_flow(datapath, 0, match, actions)
+        instructions.append(
+            parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
+                                         actions))
+        cookie = make_cookie(COOKIE_PUNT, punt_class)
+        self.add_flow(datapath, PUNT_PRIORITY, match, None,
+                      instructions, cookie=cookie)
 
-    @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
-    def packet_in_handler(self, ev):
+    def get_network_match(self, network):
+        parser = ofproto_v1_3_parser
+        addr, prefix_len = parse_prefix(network)
+        ipv4_dst = (int_to_ipv4(addr),
+                    int_to_ipv4(prefix_len_to_mask(prefix_len)))
+        return parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP,
+                               ipv4_dst=ipv4_dst)
+
+    def set_punt_meter(self, datapath, meter_id, rate):
+        '''
+        rate: packets per second, 0 to remove the meter
+        '''
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        # meter may remain from previous connection
+        self.fwd.writer.send(datapath, parser.OFPMeterMod(
+            datapath, command=ofproto.OFPMC_DELETE, meter_id=meter_id))
+
+        if not rate:
+            return
+
+        bands = [parser.OFPMeterBandDrop(rate=rate, burst_size=0)]
+        flags = ofproto.OFPMF_PKTPS | ofproto.OFPMF_STATS
+        self.fwd.writer.send(datapath, parser.OFPMeterMod(
+            datapath, command=ofproto.OFPMC_ADD, flags=flags,
+            meter_id=meter_id, bands=bands))
+
+    def get_punt_stats(self, datapath):
+        '''
+        return: {punt class name: {'matched': n, 'punted': n,
+                                   'dropped': n}}
+        '''
+        parser = datapath.ofproto_parser
+        stats = dict((name, {'matched': 0, 'punted': 0, 'dropped': 0})
+                     for name in PUNT_CLASS_NAMES.values())
+        flow_req = parser.OFPFlowStatsRequest(datapath,
+                                              cookie=make_cookie(COOKIE_PUNT),
+                                              cookie_mask=COOKIE_TYPE_MASK)
+
+        for flow in self.request_stats(datapath, flow_req):
+            punt_class = get_cookie_value(flow.cookie)
+            name = PUNT_CLASS_NAMES.get(punt_class)
+
+            if name is None:
+                continue
+
+            stats[name]['matched'] += flow.packet_count
+
+            if punt_class == PUNT_DROP:
+                stats[name]['dropped'] += flow.packet_count
+
+            else:
+                stats[name]['punted'] += flow.packet_count
+
+        meter_req = parser.OFPMeterStatsRequest(datapath, 0,
+                                                datapath.ofproto.OFPM_ALL)
+
+        for meter in self.request_stats(datapath, meter_req):
+            name = PUNT_CLASS_NAMES.get(meter.meter_id)
+
+            if name is None or meter.meter_id == PUNT_DROP:
+                continue
+
+            dropped = sum(band.packet_band_count
+                          for band in meter.band_stats)
+            stats[name]['dropped'] += dropped
+            stats[name]['punted'] -= dropped
+
+        return stats
+
+    def request_stats(self, datapath, req):
+        '''
+        Send a multipart request and wait for all replies
+        return: body of all replies
+        '''
+        datapath.set_xid(req)
+        lock = hub.Event()
+        msgs = []
+        self.waiters.setdefault(datapath.id, {})[req.xid] = (lock, msgs)
+        datapath.send_msg(req)
+        lock.wait(timeout=STATS_TIMEOUT)
+        self.waiters[datapath.id].pop(req.xid, None)
+        return [body for msg in msgs for body in msg.body]
+
+    @set_ev_cls([ofp_event.EventOFPFlowStatsReply,
+                 ofp_event.EventOFPMeterStatsReply], MAIN_DISPATCHER)
+    def stats_reply_handler(self, ev):
         msg = ev.msg
         dp = msg.datapath
-        dpid = dp.id
-        ofproto = dp.ofproto
 
-        pkt = packet.Packet(msg.data)
-        tcp_header = pkt.get_protocol(tcp.tcp)
+        if msg.xid not in self.waiters.get(dp.id, {}):
+            return
+
+        lock, msgs = self.waiters[dp.id][msg.xid]
+        msgs.append(msg)
 
-        if tcp_header is None or (tcp_header.src_port is not 179 and
-           tcp_header.dst_port is not 179):
-            # ignore non-BGP packet
+        if msg.flags & dp.ofproto.OFPMPF_REPLY_MORE:
             return
 
-        ipv4_header = pkt.get_protocol(ipv4.ipv4)
-        src_ip = ipv4_header.src
-        dst_ip = ipv4_header.dst
-        self.logger.info("BGP from %s to %s", src_ip, dst_ip)
+        del self.waiters[dp.id][msg.xid]
+        lock.set()
+
+    @set_ev_cls(EventTopologyChange)
+    def topology_change_handler(self, ev):
+        self.provision_bgp_paths()
 
-        # create a path from src to dst
-        hosts = topo_api.get_all_host(self)
-        src_host = None
-        dst_host = None
+    @set_ev_cls(EventHostUpdate)
+    def host_update_handler(self, ev):
+        for ip in ev.ips:
+            if self.pop_peer_candidate(ip):
+                self.bgp_peers.add(ip)
 
-        for host in hosts:
-            if src_ip in host.ipv4:
-                src_host = host
+            if ip in self.bgp_peers:
+                self.provision_bgp_path(ip)
 
-            elif dst_ip in host.ipv4:
-                dst_host = host
+    @set_ev_cls(EventConfigChange)
+    def config_change_handler(self, ev):
+        '''
+        Move BGP paths of changed speakers and punt IPv4 of changed
+        internal networks, other flows are kept
+        '''
+        for ip in ev.removed_speakers:
+            self.remove_bgp_path(ip)
 
-        if src_host is None or dst_host is None:
-            # can't find src or dst, drop it
+        for ip in ev.added_speakers + ev.changed_speakers:
+            self.bgp_peers.discard(ip)
+            self.peer_candidates.pop(ip, None)
+            self.provision_bgp_path(ip)
+
+        for dp in self.fwd.get_all_datapaths():
+            for network in ev.added_networks:
+                self.add_punt_flow(dp, PUNT_IPV4,
+                                   self.get_network_match(network))
+
+            for network in ev.removed_networks:
+                self.fwd.delete_flow(dp, self.get_network_match(network),
+                                     strict=True, priority=PUNT_PRIORITY)
+
+    @set_ev_cls(EventHostRemove)
+    def host_remove_handler(self, ev):
+        for ip in ev.ips:
+            if ip in self.bgp_peers:
+                self.bgp_peers.discard(ip)
+                self.remove_bgp_path(ip)
+
+    @set_ev_cls(EventBGPPacketIn)
+    @timed
+    def packet_in_handler(self, ev):
+        '''
+        Fallback for BGP sessions not provisioned yet, e.g. the first
+        session of an external peer. Only sessions with a speaker are
+        forwarded and a peer is only kept while it is a known host, so
+        BGP packets from anywhere else add no paths. A peer which is not
+        a known host yet is kept as candidate until HostDB learns it.
+        '''
+        msg = ev.msg
+        dp = msg.datapath
+        src_ip = ev.src_ip
+        dst_ip = ev.dst_ip
+        self.logger.info("BGP from %s to %s", src_ip, dst_ip)
+
+        if self.is_speaker(src_ip):
+            peer_ip = dst_ip
+
+        elif self.is_speaker(dst_ip):
+            peer_ip = src_ip
+
+        else:
+            # not a session of an internal speaker
             return
 
-        src_port = src_host.port
-        dst_port = dst_host.port
-        dst_mac = dst_host.mac
-        to_dst_match = dp.ofproto_parser.OFPMatch(eth_dst=dst_mac,
-                                                  ipv4_dst=dst_ip,
-                                                  eth_type=2048)
+        if not self.is_speaker(peer_ip):
+            if self.host_db.get_host_by_ip(peer_ip) is not None:
+                self.bgp_peers.add(peer_ip)
 
-        port_no = self.fwd.setup_shortest_path(src_port.dpid,
-                                               dst_port.dpid,
-                                               dst_port.port_no,
-                                               to_dst_match)
+            else:
+                self.add_peer_candidate(peer_ip)
+
+        for ip in (src_ip, dst_ip):
+            self.provision_bgp_path(ip)
+
+        _, tree = self.bgp_paths.get(dst_ip, (None, {}))
+        port_no = tree.get(dp.id)
 
         if port_no is None:
             # Can't find path to destination, ignore it.
@@ -93,6 +341,99 @@ class FwdBGP(app_manager.RyuApp):
 
         self.packet_out(dp, msg, port_no)
 
+    def add_peer_candidate(self, ip):
+        self.peer_candidates.pop(ip, None)
+        self.peer_candidates[ip] = self.clock() + PEER_CANDIDATE_TTL
+
+        while len(self.peer_candidates) > PEER_CANDIDATE_LIMIT:
+            self.peer_candidates.popitem(last=False)
+
+    def pop_peer_candidate(self, ip):
+        '''
+        return: True if ip was a candidate which has not expired
+        '''
+        expire_time = self.peer_candidates.pop(ip, None)
+        return expire_time is not None and expire_time > self.clock()
+
+    def provision_bgp_paths(self):
+        for ip in self.cfg_mgr.get_all_speaker_id():
+            self.provision_bgp_path(ip)
+
+        for ip in self.bgp_peers:
+            self.provision_bgp_path(ip)
+
+    def provision_bgp_path(self, ip):
+        '''
+        Install BGP forwarding toward a speaker or peer on every switch
+        '''
+        endpoint = self.get_bgp_endpoint(ip)
+
+        if endpoint is None:
+            return
+
+        old_endpoint, old_tree = self.bgp_paths.get(ip, (None, None))
+
+        if old_endpoint != endpoint:
+            old_tree = None
+
+        dpid, port_no = endpoint
+        tree = old_tree
+
+        for match in self.get_bgp_matches(ip):
+            tree = self.fwd.update_shortest_path_tree(old_tree,
+                                                      dpid,
+                                                      port_no,
+                                                      match,
+                                                      priority=BGP_PRIORITY)
+
+        self.bgp_paths[ip] = (endpoint, tree)
+
+    def remove_bgp_path(self, ip):
+        _, tree = self.bgp_paths.pop(ip, (None, None))
+
+        if tree is None:
+            return
+
+        for dpid in tree:
+            dp = self.fwd.dps.get(dpid)
+
+            if dp is None:
+                continue
+
+            for match in self.get_bgp_matches(ip):
+                self.fwd.delete_flow(dp, match, strict=True,
+                                     priority=BGP_PRIORITY)
+
+    def is_speaker(self, ip):
+        return self.cfg_mgr.get_speaker_connect_port(ip) is not None
+
+    def get_bgp_endpoint(self, ip):
+        '''
+        return: (dpid, port no) where ip is connected, None if unknown
+        '''
+        speaker = self.cfg_mgr.get_speaker_connect_port(ip)
+
+        if speaker is not None:
+            return speaker['dpid'], speaker['port']
+
+        host = self.host_db.get_host_by_ip(ip)
+
+        if host is None:
+            return None
+
+        return host.port.dpid, host.port.port_no
+
+    def get_bgp_matches(self, ip):
+        parser = ofproto_v1_3_parser
+        return [parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP,
+                                ip_proto=in_proto.IPPROTO_TCP,
+                                ipv4_dst=ip,
+                                tcp_src=BGP_PORT),
+                parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP,
+                                ip_proto=in_proto.IPPROTO_TCP,
+                                ipv4_dst=ip,
+                                tcp_dst=BGP_PORT)]
+
     def packet_out(self, dp, msg, out_port):
         ofproto = dp.ofproto
         actions = [dp.ofproto_parser.OFPActionOutput(out_port)]
@@ -102,14 +443,26 @@ class FwdBGP(app_manager.RyuApp):
             actions=actions, data=msg.data)
         dp.send_msg(out)
 
-    def add_flow(self, datapath, priority, match, actions):
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
+    def add_flow(self, datapath, priority, match, actions,
+                 instructions=None, **kwargs):
+        self.fwd.add_flow(datapath, priority, match, actions,
+                          instructions, **kwargs)
+
+    # commands
+    def cmd_punt_stats(self):
+        result = "{:<10}{:>12}{:>12}{:>12}\n".format("Class", "Matched",
+                                                     "Punted", "Dropped")
+        result = result + "=" * 46 + "\n"
+
+        for dp in self.fwd.get_all_datapaths():
+            result = result + "{:0>16}:\n".format(dp.id)
+            stats = self.get_punt_stats(dp)
+
+            for name in sorted(stats):
+                result = result + "{:<10}{:>12}{:>12}{:>12}\n".format(
+                    name,
+                    stats[name]['matched'],
+                    stats[name]['punted'],
+                    stats[name]['dropped'])
 
-        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
-                                             actions)]
-        mod = parser.OFPFlowMod(datapath=datapath,
-                                priority=priority,
-                                match=match,
-                                instructions=inst)
-        datapath.send_msg(mod)
+        return result
@@ -1,35 +1,568 @@
+import sys
+from .ip_utils import IPV4_BITS
+from .ip_utils import ipv4_to_int, parse_prefix, prefix_to_str
+from .ip_utils import prefix_len_to_mask, prefix_id, split_prefix_id
+
+
+_EMPTY_SET_SIZE = sys.getsizeof(set())
+
+
+def _get_set_entry_size():
+    '''
+    Average table space of an entry of a set grown one entry at a time,
+    over set sizes spread evenly on a log scale
+    '''
+    prefix_ids = set()
+    total = weights = 0
+
+    for count in range(1, 1 << 12):
+        prefix_ids.add(count)
+
+        if count >= 64:
+            size = (sys.getsizeof(prefix_ids) - _EMPTY_SET_SIZE) /\
+                float(count)
+            total += size / count
+            weights += 1.0 / count
+
+    return total / weights
+
+
+_SET_ENTRY_SIZE = _get_set_entry_size()
+
+
+def _bit(addr, index):
+    # index 0 is the most significant bit
+    return (addr >> (IPV4_BITS - 1 - index)) & 1
+
+
+def _covers(node, addr):
+    return (addr ^ node.addr) >> (IPV4_BITS - node.prefix_len) == 0
+
+
+def _common_len(addr_a, addr_b, limit):
+    diff = addr_a ^ addr_b
+
+    if diff == 0:
+        return limit
+
+    return min(limit, IPV4_BITS - diff.bit_length())
+
+
+class _TrieNode(object):
+    __slots__ = ('addr', 'prefix_len', 'left', 'right', 'next_hop', 'peer')
+
+    def __init__(self, addr, prefix_len):
+        self.addr = addr
+        self.prefix_len = prefix_len
+        self.left = None
+        self.right = None
+        self.next_hop = None  # None for glue nodes
+        self.peer = None  # BGP peer the route was learned from
+
 
 class HopDB(object):
+    '''
+    Route information base
+
+    Prefixes are stored in a path-compressed binary (Patricia) trie keyed
+    by integer address, install state is kept in sets of prefix ids.
+    Installed and uninstalled prefixes are grouped by next hop, so they
+    can be installed or moved together when the next hop changes, and
+    all prefixes are grouped by the BGP peer they were learned from.
+    '''
 
     def __init__(self):
         super(HopDB, self).__init__()
-        self.hops = {}  # prefix -> hop
-        self.installed_prefix = []
+        self._root = _TrieNode(0, 0)
+        self._node_count = 1
+        self._prefix_count = 0
+        self._next_hops = {}  # next hop -> interned next hop
+        self._next_hop_ids = {}  # next hop -> id
+        self._last_nexthop_id = 0
+        self.version = 0  # changed whenever routes or install state change
+        self.installed_prefix = {}  # next hop -> set of prefix id
+        self.uninstalled_prefix = {}  # next hop -> set of prefix id
+        self.peer_prefix = {}  # peer -> set of prefix id
+        self._installed_count = 0
+        self._peer_prefix_count = 0
+        # called with (prefix id, next hop, installed) when a prefix is
+        # installed or no longer installed
+        self.install_listener = None
+
+    def add_hop(self, prefix, next_hop, peer=None):
+        '''
+        peer: address of the BGP peer the route was learned from
+        '''
+        addr, prefix_len = parse_prefix(prefix)
+        node = self._insert(addr, prefix_len)
+        next_hop = self._next_hops.setdefault(next_hop, next_hop)
+        _prefix_id = prefix_id(addr, prefix_len)
+
+        if node.peer != peer:
+            if self._discard(self.peer_prefix, node.peer, _prefix_id):
+                self._peer_prefix_count -= 1
+
+            node.peer = peer
+
+            if peer is not None:
+                self.peer_prefix.setdefault(peer, set()).add(_prefix_id)
+                self._peer_prefix_count += 1
 
-    def add_hop(self, prefix, next_hop):
-        self.hops.setdefault(prefix, next_hop)
+        if node.next_hop is None:
+            self._prefix_count += 1
+
+        elif node.next_hop == next_hop:
+            return
+
+        else:
+            self._uninstall(node.next_hop, _prefix_id)
+            self._discard(self.uninstalled_prefix, node.next_hop, _prefix_id)
+
+        node.next_hop = next_hop
+        self.uninstalled_prefix.setdefault(next_hop, set()).add(_prefix_id)
+        self.version += 1
 
     def get_nexthop(self, prefix):
-        self.hops.get(prefix)
+        node = self._find(*parse_prefix(prefix))
+
+        if node is None:
+            return None
+
+        return node.next_hop
+
+    def get_peer(self, prefix):
+        node = self._find(*parse_prefix(prefix))
+
+        if node is None:
+            return None
+
+        return node.peer
+
+    def get_nexthop_id(self, next_hop):
+        '''
+        Small integer which stays the same for a next hop
+        '''
+        nexthop_id = self._next_hop_ids.get(next_hop)
+
+        if nexthop_id is None:
+            self._last_nexthop_id += 1
+            nexthop_id = self._last_nexthop_id
+            self._next_hop_ids[next_hop] = nexthop_id
+            self.version += 1
+
+        return nexthop_id
+
+    def lookup(self, ip):
+        '''
+        Longest prefix match, return (prefix, next hop) or None
+        '''
+        addr = ipv4_to_int(ip)
+        node = self._root
+        best = None
+
+        while node is not None and _covers(node, addr):
+            if node.next_hop is not None:
+                best = node
+
+            if node.prefix_len == IPV4_BITS:
+                break
+
+            node = node.right if _bit(addr, node.prefix_len) else node.left
+
+        if best is None:
+            return None
+
+        return prefix_to_str(best.addr, best.prefix_len), best.next_hop
 
     def is_prefix_installed(self, prefix):
-        return (prefix in self.installed_prefix)
+        addr, prefix_len = parse_prefix(prefix)
+        node = self._find(addr, prefix_len)
+
+        if node is None:
+            return False
+
+        return prefix_id(addr, prefix_len) in\
+            self.installed_prefix.get(node.next_hop, ())
+
+    def get_installed_count(self):
+        return self._installed_count
+
+    def get_pending_count(self):
+        return self._prefix_count - self._installed_count
+
+    def get_peer_prefixes(self, peer):
+        '''
+        Prefixes learned from a BGP peer
+        '''
+        return [prefix_to_str(*split_prefix_id(_prefix_id))
+                for _prefix_id in self.peer_prefix.get(peer, ())]
+
+    def get_nexthop_prefixes(self, next_hop):
+        '''
+        Installed and uninstalled prefixes behind a next hop
+        '''
+        return self.get_installed_prefixes(next_hop) +\
+            self.get_pending_prefixes(next_hop)
+
+    def has_installed_prefixes(self, next_hop):
+        return next_hop in self.installed_prefix
+
+    def has_prefixes(self, next_hop):
+        return next_hop in self.installed_prefix or\
+            next_hop in self.uninstalled_prefix
+
+    def get_installed_prefixes(self, next_hop):
+        return [prefix_to_str(*split_prefix_id(_prefix_id))
+                for _prefix_id in self.installed_prefix.get(next_hop, ())]
 
     def get_uninstalled_prefix_list(self):
-        result = [prefix for prefix in
-                  self.hops.keys() if (prefix not in self.installed_prefix)]
-        return result
+        return [prefix_to_str(*split_prefix_id(_prefix_id))
+                for prefix_ids in self.uninstalled_prefix.values()
+                for _prefix_id in prefix_ids]
+
+    def get_pending_nexthops(self):
+        '''
+        Next hops which still have uninstalled prefixes
+        '''
+        return list(self.uninstalled_prefix.keys())
+
+    def get_pending_prefixes(self, next_hop):
+        return [prefix_to_str(*split_prefix_id(_prefix_id))
+                for _prefix_id in self.uninstalled_prefix.get(next_hop, ())]
 
     def install_prefix(self, prefix):
-        self.installed_prefix.append(prefix)
+        addr, prefix_len = parse_prefix(prefix)
+        node = self._find(addr, prefix_len)
+
+        if node is None:
+            return
+
+        _prefix_id = prefix_id(addr, prefix_len)
+        self._discard(self.uninstalled_prefix, node.next_hop, _prefix_id)
+        prefix_ids = self.installed_prefix.setdefault(node.next_hop, set())
+
+        if _prefix_id not in prefix_ids:
+            prefix_ids.add(_prefix_id)
+            self._installed_count += 1
+
+            if self.install_listener is not None:
+                self.install_listener(_prefix_id, node.next_hop, True)
+
+        self.version += 1
+
+    def get_parent_nexthop(self, prefix):
+        '''
+        return: next hop of the longest route which covers the prefix,
+        the prefix itself excluded, None if no route covers it
+        '''
+        addr, prefix_len = parse_prefix(prefix)
+        node = self._root
+        next_hop = None
+
+        while node is not None and node.prefix_len < prefix_len and\
+                _covers(node, addr):
+            if node.next_hop is not None:
+                next_hop = node.next_hop
+
+            node = node.right if _bit(addr, node.prefix_len) else node.left
+
+        return next_hop
+
+    def get_child_routes(self, prefix):
+        '''
+        Routes inside the prefix with no other route between them and
+        the prefix, the prefix itself need not be a route
+        return: list of (prefix, next hop)
+        '''
+        addr, prefix_len = parse_prefix(prefix)
+        node = self._root
+
+        while node is not None and node.prefix_len < prefix_len:
+            if not _covers(node, addr):
+                return []
+
+            node = node.right if _bit(addr, node.prefix_len) else node.left
+
+        if node is None or\
+           (node.addr ^ addr) >> (IPV4_BITS - prefix_len) != 0:
+            return []
+
+        if node.prefix_len == prefix_len:
+            stack = [node.left, node.right]
+
+        else:
+            stack = [node]
+
+        routes = []
+
+        while stack:
+            node = stack.pop()
+
+            if node is None:
+                continue
+
+            if node.next_hop is not None:
+                routes.append((prefix_to_str(node.addr, node.prefix_len),
+                               node.next_hop))
+                continue
+
+            stack.append(node.left)
+            stack.append(node.right)
+
+        return routes
+
+    def get_parent_nexthops(self):
+        '''
+        return: list of (prefix, next hop, next hop of the longest route
+        covering the prefix or None)
+        '''
+        routes = []
+        stack = [(self._root, None)]
+
+        while stack:
+            node, parent_next_hop = stack.pop()
+
+            if node.next_hop is not None:
+                routes.append((prefix_to_str(node.addr, node.prefix_len),
+                               node.next_hop, parent_next_hop))
+                parent_next_hop = node.next_hop
+
+            for child in (node.left, node.right):
+                if child is not None:
+                    stack.append((child, parent_next_hop))
+
+        return routes
 
     def get_all_prefixes(self):
-        return self.hops.keys()
+        return [prefix_to_str(node.addr, node.prefix_len)
+                for node in self._iter_nodes()]
+
+    def get_prefix_count(self):
+        return self._prefix_count
 
     def withdraw(self, prefix):
+        addr, prefix_len = parse_prefix(prefix)
+        next_hop, peer = self._remove(addr, prefix_len)
+
+        if next_hop is None:
+            return
+
+        _prefix_id = prefix_id(addr, prefix_len)
+        self._prefix_count -= 1
+
+        if self._discard(self.peer_prefix, peer, _prefix_id):
+            self._peer_prefix_count -= 1
+
+        self._uninstall(next_hop, _prefix_id)
+        self._discard(self.uninstalled_prefix, next_hop, _prefix_id)
+        self.version += 1
+
+    def get_routes(self):
+        '''
+        return: list of (addr, prefix len, next hop, peer)
+        '''
+        return list(self.iter_routes())
+
+    def iter_routes(self):
+        '''
+        Generate (addr, prefix len, next hop, peer) of all routes, routes
+        changed while the generator is suspended may be missed or given
+        twice
+        '''
+        for node in self._iter_nodes():
+            yield node.addr, node.prefix_len, node.next_hop, node.peer
+
+    def get_nexthop_ids(self):
+        return dict(self._next_hop_ids)
+
+    def restore(self, routes, nexthop_ids):
+        '''
+        Load routes and next hop ids saved from get_routes and
+        get_nexthop_ids, next hop ids are kept so flows which match them
+        stay valid. Routes wait for their next hop like new routes and
+        are grouped by their peer again, so they are withdrawn if the
+        peer goes down.
+        '''
+        for next_hop, nexthop_id in nexthop_ids.items():
+            next_hop = self._next_hops.setdefault(next_hop, next_hop)
+            self._next_hop_ids[next_hop] = nexthop_id
+            self._last_nexthop_id = max(self._last_nexthop_id, nexthop_id)
+
+        for addr, prefix_len, next_hop, peer in routes:
+            self.add_hop(prefix_to_str(addr, prefix_len), next_hop, peer)
+
+    def get_memory_usage(self):
+        '''
+        Estimated size of trie and install state in bytes, from counters
+        only, so it is cheap to ask often
+        '''
+        int_size = sys.getsizeof(1 << IPV4_BITS)
+        node_size = sys.getsizeof(self._root) + int_size
+        groups = len(self.installed_prefix) + len(self.uninstalled_prefix) +\
+            len(self.peer_prefix)
+        # a prefix is in one install state group, and in a peer group if
+        # its peer is known
+        entries = self._prefix_count + self._peer_prefix_count
+        state_size = sys.getsizeof(self.installed_prefix) +\
+            sys.getsizeof(self.uninstalled_prefix) +\
+            sys.getsizeof(self.peer_prefix) +\
+            groups * _EMPTY_SET_SIZE +\
+            entries * (int_size + _SET_ENTRY_SIZE)
+        total = self._node_count * node_size + state_size
+
+        return {
+            'prefixes': self._prefix_count,
+            'nodes': self._node_count,
+            'bytes': total,
+            'bytes_per_prefix': total / float(max(self._prefix_count, 1))
+        }
+
+    def _uninstall(self, next_hop, _prefix_id):
+        if not self._discard(self.installed_prefix, next_hop, _prefix_id):
+            return
+
+        self._installed_count -= 1
+
+        if self.install_listener is not None:
+            self.install_listener(_prefix_id, next_hop, False)
+
+    @staticmethod
+    def _discard(prefix_groups, next_hop, _prefix_id):
+        '''
+        return: True if the prefix id was in the group
+        '''
+        prefix_ids = prefix_groups.get(next_hop)
+
+        if prefix_ids is None or _prefix_id not in prefix_ids:
+            return False
+
+        prefix_ids.discard(_prefix_id)
+
+        if not prefix_ids:
+            del prefix_groups[next_hop]
+
+        return True
+
+    def _iter_nodes(self):
+        stack = [self._root]
+
+        while stack:
+            node = stack.pop()
+
+            if node.next_hop is not None:
+                yield node
+
+            if node.right is not None:
+                stack.append(node.right)
+
+            if node.left is not None:
+                stack.append(node.left)
+
+    def _find(self, addr, prefix_len):
+        node = self._root
+
+        while node is not None and node.prefix_len < prefix_len:
+            if not _covers(node, addr):
+                return None
+
+            node = node.right if _bit(addr, node.prefix_len) else node.left
+
+        if node is None or node.prefix_len != prefix_len or\
+           node.addr != addr or node.next_hop is None:
+            return None
+
+        return node
+
+    def _insert(self, addr, prefix_len):
+        node = self._root
+
+        while node.prefix_len < prefix_len:
+            bit = _bit(addr, node.prefix_len)
+            child = node.right if bit else node.left
+
+            if child is None:
+                child = _TrieNode(addr, prefix_len)
+                self._set_child(node, bit, child)
+                self._node_count += 1
+                return child
+
+            common = _common_len(addr, child.addr,
+                                 min(prefix_len, child.prefix_len))
+
+            if common == child.prefix_len:
+                node = child
+                continue
+
+            new_node = _TrieNode(addr, prefix_len)
+
+            if common == prefix_len:
+                # new node is the parent of child
+                self._set_child(new_node, _bit(child.addr, common), child)
+                self._node_count += 1
+
+            else:
+                # split with a glue node
+                glue = _TrieNode(addr & prefix_len_to_mask(common), common)
+                self._set_child(glue, _bit(child.addr, common), child)
+                self._set_child(glue, _bit(addr, common), new_node)
+                self._node_count += 2
+                self._set_child(node, bit, glue)
+                return new_node
+
+            self._set_child(node, bit, new_node)
+            return new_node
+
+        return node
+
+    def _remove(self, addr, prefix_len):
+        '''
+        return: next hop and peer of the removed prefix, or (None, None)
+        '''
+        path = []
+        node = self._root
+
+        while node is not None and node.prefix_len < prefix_len:
+            if not _covers(node, addr):
+                return None, None
+
+            path.append(node)
+            node = node.right if _bit(addr, node.prefix_len) else node.left
+
+        if node is None or node.prefix_len != prefix_len or\
+           node.addr != addr or node.next_hop is None:
+            return None, None
+
+        next_hop, peer = node.next_hop, node.peer
+        node.next_hop = None
+        node.peer = None
+
+        # remove glue nodes which are no longer needed
+        while path and node.next_hop is None:
+            if node.left is not None and node.right is not None:
+                break
+
+            parent = path.pop()
+            child = node.left if node.left is not None else node.right
+
+            if parent.left is node:
+                parent.left = child
+
+            else:
+                parent.right = child
+
+            self._node_count -= 1
+
+            if child is not None:
+                break
+
+            node = parent
+
+        return next_hop, peer
 
-        if prefix in self.hops:
-            self.hops.pop(prefix)
+    @staticmethod
+    def _set_child(node, bit, child):
+        if bit:
+            node.right = child
 
-        if prefix in self.installed_prefix:
-            self.installed_prefix.remove(prefix)
+        else:
+            node.left = child
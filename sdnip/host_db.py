@@ -0,0 +1,167 @@
+import time
+from collections import OrderedDict
+from ryu.base import app_manager
+from ryu.controller import event
+from ryu.controller.handler import set_ev_cls
+from ryu.ofproto import ofproto_v1_3
+from ryu.topology import event as topo_event
+
+# IP seen from MAC which is not a known host yet
+UNKNOWN_IP_LIMIT = 4096
+UNKNOWN_IP_TTL = 300
+
+
+class EventHostUpdate(event.EventBase):
+    '''
+    Sent after a host is added, moved or one of its IP is learned
+    '''
+
+    def __init__(self, host, ips):
+        super(EventHostUpdate, self).__init__()
+        self.host = host
+        self.ips = ips
+
+
+class EventHostRemove(event.EventBase):
+    '''
+    Sent after a host is deleted
+    '''
+
+    def __init__(self, host, ips):
+        super(EventHostRemove, self).__init__()
+        self.host = host
+        self.ips = ips
+
+
+class HostDB(app_manager.RyuApp):
+    '''
+    Host index by IPv4 and MAC address
+
+    IP learned for a MAC which is not a known host is kept aside, in a
+    table bounded by UNKNOWN_IP_LIMIT where entries expire after
+    UNKNOWN_IP_TTL seconds, and indexed once the host is added.
+    '''
+    OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _EVENTS = [EventHostUpdate, EventHostRemove]
+
+    def __init__(self, *args, **kwargs):
+        super(HostDB, self).__init__(*args, **kwargs)
+        self.hosts = {}  # mac -> host
+        self.ip_to_mac = {}  # ip -> mac
+        self.mac_to_ips = {}  # mac -> set of ip
+        self.unknown_ips = OrderedDict()  # ip -> (mac, expire time)
+        self.unknown_macs = {}  # mac -> set of ip in unknown_ips
+        self.clock = time.time
+
+    @set_ev_cls(topo_event.EventHostAdd)
+    def host_add_handler(self, ev):
+        self.add_host(ev.host)
+
+    @set_ev_cls(topo_event.EventHostMove)
+    def host_move_handler(self, ev):
+        self.add_host(ev.dst)
+
+    @set_ev_cls(topo_event.EventHostDelete)
+    def host_delete_handler(self, ev):
+        self.delete_host(ev.host)
+
+    def add_host(self, host):
+        self.hosts[host.mac] = host
+        self._expire_unknown()
+
+        for ip in list(self.unknown_macs.get(host.mac, ())):
+            self._forget_unknown(ip)
+            self._index_ip(ip, host.mac)
+
+        for ip in host.ipv4:
+            self._forget_unknown(ip)
+            self._index_ip(ip, host.mac)
+
+        ips = list(self.mac_to_ips.get(host.mac, ()))
+        self.send_event_to_observers(EventHostUpdate(host, ips))
+
+    def delete_host(self, host):
+        self.hosts.pop(host.mac, None)
+        ips = []
+
+        for ip in self.mac_to_ips.pop(host.mac, ()):
+            if self.ip_to_mac.get(ip) == host.mac:
+                del self.ip_to_mac[ip]
+                ips.append(ip)
+
+        self.send_event_to_observers(EventHostRemove(host, ips))
+
+    def learn_ip(self, ip, mac):
+        '''
+        Ryu topology learns host IP without sending event, packet-in
+        handlers report IP they see from hosts here.
+        '''
+        host = self.hosts.get(mac)
+
+        if host is None:
+            self._remember_unknown(ip, mac)
+            return
+
+        if self.ip_to_mac.get(ip) == mac:
+            return
+
+        self._forget_unknown(ip)
+        self._index_ip(ip, mac)
+        self.send_event_to_observers(EventHostUpdate(host, [ip]))
+
+    def get_host_by_ip(self, ip):
+        mac = self.ip_to_mac.get(ip)
+
+        if mac is None:
+            return None
+
+        return self.hosts.get(mac)
+
+    def get_host_by_mac(self, mac):
+        return self.hosts.get(mac)
+
+    def get_all_ips(self):
+        return list(self.ip_to_mac.keys())
+
+    def _index_ip(self, ip, mac):
+        old_mac = self.ip_to_mac.get(ip)
+
+        if old_mac is not None and old_mac != mac:
+            self.mac_to_ips.get(old_mac, set()).discard(ip)
+
+        self.ip_to_mac[ip] = mac
+        self.mac_to_ips.setdefault(mac, set()).add(ip)
+
+    def _remember_unknown(self, ip, mac):
+        self._forget_unknown(ip)
+        self.unknown_ips[ip] = (mac, self.clock() + UNKNOWN_IP_TTL)
+        self.unknown_macs.setdefault(mac, set()).add(ip)
+        self._expire_unknown()
+
+        while len(self.unknown_ips) > UNKNOWN_IP_LIMIT:
+            self._forget_unknown(next(iter(self.unknown_ips)))
+
+    def _forget_unknown(self, ip):
+        entry = self.unknown_ips.pop(ip, None)
+
+        if entry is None:
+            return
+
+        mac = entry[0]
+        ips = self.unknown_macs[mac]
+        ips.discard(ip)
+
+        if not ips:
+            del self.unknown_macs[mac]
+
+    def _expire_unknown(self):
+        now = self.clock()
+
+        # every entry has the same ttl, so the oldest expire first
+        while self.unknown_ips:
+            ip = next(iter(self.unknown_ips))
+
+            if self.unknown_ips[ip][1] > now:
+                break
+
+            self._forget_unknown(ip)
@@ -0,0 +1,52 @@
+import socket
+import struct
+
+IPV4_BITS = 32
+IPV4_FULL_MASK = 0xffffffff
+_IPV4_STRUCT = struct.Struct('!I')
+_PREFIX_LEN_BITS = 6
+_PREFIX_LEN_MASK = (1 << _PREFIX_LEN_BITS) - 1
+
+
+def ipv4_to_int(ip):
+    return _IPV4_STRUCT.unpack(socket.inet_aton(ip))[0]
+
+
+def int_to_ipv4(value):
+    return socket.inet_ntoa(_IPV4_STRUCT.pack(value))
+
+
+def prefix_len_to_mask(prefix_len):
+    return (IPV4_FULL_MASK << (IPV4_BITS - prefix_len)) & IPV4_FULL_MASK
+
+
+def parse_prefix(prefix):
+    '''
+    '10.0.0.0/8' => (167772160, 8)
+    host bits are cleared, a prefix without length is a host route
+    '''
+    if '/' in prefix:
+        ip, prefix_len = prefix.split('/', 1)
+        prefix_len = int(prefix_len)
+    else:
+        ip, prefix_len = prefix, IPV4_BITS
+
+    if not 0 <= prefix_len <= IPV4_BITS:
+        raise ValueError('invalid prefix length: %s' % prefix)
+
+    return ipv4_to_int(ip) & prefix_len_to_mask(prefix_len), prefix_len
+
+
+def prefix_to_str(addr, prefix_len):
+    return '%s/%d' % (int_to_ipv4(addr), prefix_len)
+
+
+def prefix_id(addr, prefix_len):
+    '''
+    Pack a prefix into one integer
+    '''
+    return (addr << _PREFIX_LEN_BITS) | prefix_len
+
+
+def split_prefix_id(_prefix_id):
+    return _prefix_id >> _PREFIX_LEN_BITS, _prefix_id & _PREFIX_LEN_MASK
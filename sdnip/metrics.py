@@ -0,0 +1,247 @@
+import functools
+import numbers
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from ryu.base import app_manager
+from ryu.app.wsgi import ControllerBase, WSGIApplication, route
+from ryu.ofproto import ofproto_v1_3
+from webob import Response
+
+METRICS_INSTANCE_NAME = 'sdnip_metrics_registry'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds, from packet-in handlers to full route reprogramming
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(label_names, label_values, extra=''):
+    labels = ['%s="%s"' % (name, value)
+              for name, value in zip(label_names, label_values)]
+
+    if extra:
+        labels.append(extra)
+
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join(labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    if isinstance(value, numbers.Integral):
+        return str(value)
+
+    return repr(float(value))
+
+
+class _Metric(object):
+
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, label_names=()):
+        super(_Metric, self).__init__()
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}  # label values -> value
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def clear(self):
+        self.values = {}
+
+    def collect(self):
+        for labels, value in sorted(self.values.items()):
+            yield '%s%s %s' % (self.name,
+                               _format_labels(self.label_names, labels),
+                               _format_value(value))
+
+
+class Counter(_Metric):
+
+    metric_type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+
+    metric_type = 'gauge'
+
+
+class Histogram(_Metric):
+    '''
+    Bucket counts are kept per bucket and summed up when collected,
+    so an observation is one bisect and two additions
+    '''
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        # [count per bucket..., count above last bucket, sum]
+        data = self.values.get(labels)
+
+        if data is None:
+            data = [0] * (len(self.buckets) + 1) + [0.0]
+            self.values[labels] = data
+
+        data[bisect_left(self.buckets, value)] += 1
+        data[-1] += value
+
+    def collect(self):
+        bounds = self.buckets + (float('inf'),)
+
+        for labels, data in sorted(self.values.items()):
+            count = 0
+
+            for bound, bucket_count in zip(bounds, data):
+                count += bucket_count
+                yield '%s_bucket%s %d' % (
+                    self.name,
+                    _format_labels(self.label_names, labels,
+                                   'le="%s"' % _format_value(bound)),
+                    count)
+
+            label_text = _format_labels(self.label_names, labels)
+            yield '%s_sum%s %s' % (self.name, label_text,
+                                   _format_value(data[-1]))
+            yield '%s_count%s %d' % (self.name, label_text, count)
+
+
+class MetricsRegistry(object):
+    '''
+    Metrics of all SDN-IP apps
+
+    Hot paths only update numbers in dicts, values which already exist
+    in apps, e.g. RIB size, are read by collectors when scraped.
+    '''
+
+    def __init__(self):
+        super(MetricsRegistry, self).__init__()
+        self.metrics = OrderedDict()  # name -> metric
+        self.collectors = []
+
+    def counter(self, name, documentation, label_names=()):
+        return self._get_metric(Counter, name, documentation, label_names)
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._get_metric(Gauge, name, documentation, label_names)
+
+    def histogram(self, name, documentation, label_names=(),
+                  buckets=DEFAULT_BUCKETS):
+        metric = self.metrics.get(name)
+
+        if metric is None:
+            metric = Histogram(name, documentation, label_names, buckets)
+            self.metrics[name] = metric
+
+        return metric
+
+    def add_collector(self, collector):
+        '''
+        collector: called before metrics are rendered, to set gauges
+        '''
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def render(self):
+        '''
+        return: all metrics in Prometheus text format
+        '''
+        for collector in list(self.collectors):
+            collector()
+
+        lines = []
+
+        for metric in self.metrics.values():
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.metric_type))
+            lines.extend(metric.collect())
+
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _get_metric(self, metric_cls, name, documentation, label_names):
+        metric = self.metrics.get(name)
+
+        if metric is None:
+            metric = metric_cls(name, documentation, label_names)
+            self.metrics[name] = metric
+
+        return metric
+
+
+REGISTRY = MetricsRegistry()
+HANDLER_SECONDS = REGISTRY.histogram('sdnip_handler_seconds',
+                                     'Run time of SDN-IP handlers',
+                                     ['handler'])
+HANDLER_ERRORS = REGISTRY.counter('sdnip_handler_errors_total',
+                                  'Exceptions raised by SDN-IP handlers',
+                                  ['handler'])
+
+
+def timed(func):
+    '''
+    Record calls and run time of a handler, labeled with module and
+    function name, e.g. sdn_ip.install_best_path
+    '''
+    labels = ('%s.%s' % (func.__module__.rsplit('.', 1)[-1],
+                         func.__name__),)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+
+        try:
+            return func(*args, **kwargs)
+
+        except Exception:
+            HANDLER_ERRORS.inc(labels)
+            raise
+
+        finally:
+            HANDLER_SECONDS.observe(time.time() - start, labels)
+
+    return wrapper
+
+
+class MetricsController(ControllerBase):
+
+    def __init__(self, req, link, data, **config):
+        super(MetricsController, self).__init__(req, link, data, **config)
+        self.registry = data[METRICS_INSTANCE_NAME]
+
+    @route('sdnip_metrics', '/metrics', methods=['GET'])
+    def get_metrics(self, req, **kwargs):
+        body = self.registry.render().encode('utf-8')
+        return Response(body=body,
+                        headerlist=[('Content-Type', CONTENT_TYPE)])
+
+
+class SDNIPMetrics(app_manager.RyuApp):
+    '''
+    Serve metrics of SDN-IP apps at /metrics of the Ryu web server
+    '''
+    OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _CONTEXTS = {
+        'wsgi': WSGIApplication
+    }
+
+    def __init__(self, *args, **kwargs):
+        super(SDNIPMetrics, self).__init__(*args, **kwargs)
+        wsgi = kwargs['wsgi']
+        wsgi.register(MetricsController, {METRICS_INSTANCE_NAME: REGISTRY})
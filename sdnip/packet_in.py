@@ -0,0 +1,157 @@
+import binascii
+import socket
+import struct
+from ryu.base import app_manager
+from ryu.controller import event
+from ryu.controller import ofp_event
+from ryu.controller.handler import MAIN_DISPATCHER
+from ryu.controller.handler import set_ev_cls
+from ryu.lib.packet import ether_types
+from ryu.lib.packet import in_proto
+from ryu.ofproto import ofproto_v1_3
+from .metrics import timed
+
+BGP_PORT = 179
+_ETH_HEADER = struct.Struct('!6s6sH')
+_VLAN_TYPE = struct.Struct('!H')
+_ARP_HEADER = struct.Struct('!HHBBH6s4s6s4s')
+_IPV4_HEADER = struct.Struct('!BBHHHBBH4s4s')
+_TCP_PORTS = struct.Struct('!HH')
+_VLAN_TYPES = (ether_types.ETH_TYPE_8021Q, ether_types.ETH_TYPE_8021AD)
+_IPV4_FRAGMENT_OFFSET = 0x1fff
+
+
+def _mac_to_text(mac):
+    mac = binascii.hexlify(mac).decode('ascii')
+    return ':'.join(mac[i:i + 2] for i in range(0, 12, 2))
+
+
+class EventPacketInBase(event.EventBase):
+
+    def __init__(self, msg, eth_src, eth_dst):
+        super(EventPacketInBase, self).__init__()
+        self.msg = msg
+        self.eth_src = eth_src
+        self.eth_dst = eth_dst
+
+
+class EventArpPacketIn(EventPacketInBase):
+
+    def __init__(self, msg, eth_src, eth_dst,
+                 opcode, src_mac, src_ip, dst_mac, dst_ip):
+        super(EventArpPacketIn, self).__init__(msg, eth_src, eth_dst)
+        self.opcode = opcode
+        self.src_mac = src_mac
+        self.src_ip = src_ip
+        self.dst_mac = dst_mac
+        self.dst_ip = dst_ip
+
+
+class EventIPv4PacketIn(EventPacketInBase):
+    '''
+    IPv4 packet which is not BGP
+    '''
+
+    def __init__(self, msg, eth_src, eth_dst, src_ip, dst_ip, proto):
+        super(EventIPv4PacketIn, self).__init__(msg, eth_src, eth_dst)
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.proto = proto
+
+
+class EventBGPPacketIn(EventPacketInBase):
+    '''
+    IPv4 TCP packet from or to port 179
+
+    Ryu sends an event only to handlers of its exact class, so a BGP
+    packet is not seen by EventIPv4PacketIn handlers; handlers which
+    need every IPv4 packet observe both events.
+    '''
+
+    def __init__(self, msg, eth_src, eth_dst, src_ip, dst_ip,
+                 src_port, dst_port):
+        super(EventBGPPacketIn, self).__init__(msg, eth_src, eth_dst)
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.proto = in_proto.IPPROTO_TCP
+        self.src_port = src_port
+        self.dst_port = dst_port
+
+
+class PacketInDispatcher(app_manager.RyuApp):
+    '''
+    Decode each packet-in once and dispatch it to SDN-IP applications
+
+    Only fixed header fields are read, no packet objects are built.
+    ARP goes to EventArpPacketIn, BGP (TCP port 179) to EventBGPPacketIn
+    and other IPv4 to EventIPv4PacketIn, anything else is ignored. Each
+    packet is sent as exactly one event.
+    '''
+    OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _EVENTS = [EventArpPacketIn, EventIPv4PacketIn, EventBGPPacketIn]
+
+    def __init__(self, *args, **kwargs):
+        super(PacketInDispatcher, self).__init__(*args, **kwargs)
+
+    @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
+    @timed
+    def packet_in_handler(self, ev):
+        msg = ev.msg
+
+        try:
+            dispatch_ev = self.parse(msg)
+
+        except struct.error:
+            # truncated packet
+            return
+
+        if dispatch_ev is not None:
+            self.send_event_to_observers(dispatch_ev)
+
+    def parse(self, msg):
+        data = msg.data
+        eth_dst, eth_src, eth_type = _ETH_HEADER.unpack_from(data, 0)
+        offset = _ETH_HEADER.size
+
+        while eth_type in _VLAN_TYPES:
+            eth_type, = _VLAN_TYPE.unpack_from(data, offset + 2)
+            offset += 4
+
+        if eth_type == ether_types.ETH_TYPE_ARP:
+            _, _, _, _, opcode, src_mac, src_ip, dst_mac, dst_ip =\
+                _ARP_HEADER.unpack_from(data, offset)
+            return EventArpPacketIn(msg,
+                                    _mac_to_text(eth_src),
+                                    _mac_to_text(eth_dst),
+                                    opcode,
+                                    _mac_to_text(src_mac),
+                                    socket.inet_ntoa(src_ip),
+                                    _mac_to_text(dst_mac),
+                                    socket.inet_ntoa(dst_ip))
+
+        if eth_type != ether_types.ETH_TYPE_IP:
+            return None
+
+        ver_ihl, _, _, _, flags_offset, _, proto, _, src_ip, dst_ip =\
+            _IPV4_HEADER.unpack_from(data, offset)
+
+        if proto == in_proto.IPPROTO_TCP and\
+           not flags_offset & _IPV4_FRAGMENT_OFFSET:
+            src_port, dst_port = _TCP_PORTS.unpack_from(
+                data, offset + (ver_ihl & 0xf) * 4)
+
+            if src_port == BGP_PORT or dst_port == BGP_PORT:
+                return EventBGPPacketIn(msg,
+                                        _mac_to_text(eth_src),
+                                        _mac_to_text(eth_dst),
+                                        socket.inet_ntoa(src_ip),
+                                        socket.inet_ntoa(dst_ip),
+                                        src_port,
+                                        dst_port)
+
+        return EventIPv4PacketIn(msg,
+                                 _mac_to_text(eth_src),
+                                 _mac_to_text(eth_dst),
+                                 socket.inet_ntoa(src_ip),
+                                 socket.inet_ntoa(dst_ip),
+                                 proto)
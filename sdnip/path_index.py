@@ -0,0 +1,78 @@
+class PathIndex(object):
+    '''
+    Reverse index from links and switches to the shortest path trees
+    which use them
+
+    A tree maps dpid to output port, or to (port, weight) buckets of an
+    equal-cost tree, a link is keyed by its source (dpid, port no).
+    When links or switches go away, only keys of the trees crossing them
+    need to be recomputed.
+    '''
+
+    def __init__(self):
+        super(PathIndex, self).__init__()
+        self.trees = {}  # key -> tree
+        self.links = {}  # (dpid, port no) -> set of key
+        self.switches = {}  # dpid -> set of key
+
+    def update(self, key, tree):
+        old_tree = self.trees.get(key)
+
+        if old_tree is tree:
+            return
+
+        if old_tree is not None:
+            self._unlink(key, old_tree)
+
+        self.trees[key] = tree
+
+        for dpid, port_no in self._iter_links(tree):
+            self.links.setdefault((dpid, port_no), set()).add(key)
+            self.switches.setdefault(dpid, set()).add(key)
+
+    def remove(self, key):
+        old_tree = self.trees.pop(key, None)
+
+        if old_tree is not None:
+            self._unlink(key, old_tree)
+
+    def get_affected(self, links=(), dpids=()):
+        '''
+        return: keys whose tree uses any of links or dpids
+        '''
+        keys = set()
+
+        for link in links:
+            keys.update(self.links.get(link, ()))
+
+        for dpid in dpids:
+            keys.update(self.switches.get(dpid, ()))
+
+        return keys
+
+    def _unlink(self, key, tree):
+        for dpid, port_no in self._iter_links(tree):
+            self._discard(self.links, (dpid, port_no), key)
+            self._discard(self.switches, dpid, key)
+
+    @staticmethod
+    def _iter_links(tree):
+        for dpid, out in tree.items():
+            if isinstance(out, tuple):
+                for port_no, _ in out:
+                    yield dpid, port_no
+
+            else:
+                yield dpid, out
+
+    @staticmethod
+    def _discard(index, index_key, key):
+        keys = index.get(index_key)
+
+        if keys is None:
+            return
+
+        keys.discard(key)
+
+        if not keys:
+            del index[index_key]
@@ -1,22 +1,95 @@
 import json
-from netaddr import IPNetwork
+import os
+from collections import OrderedDict
+from ryu import cfg
 from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_0, ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
 from ryu.lib import hub
 from ryu.lib import ofctl_v1_3
 from ryu.lib.packet import packet
 from ryu.lib.packet import ethernet
 from ryu.lib.packet import ipv4
 from ryu.lib.packet import ether_types
-from ryu.topology import api as topo_api
 from ryu.services.protocols.bgp.bgpspeaker import BGPSpeaker
-from ryu.lib.ofp_pktinfilter import packet_in_filter, RequiredTypeFilter
-from .conf_mgr import SDNIPConfigManager
-from .fwd import Fwd
+from eventlet import tpool
+from .conf_mgr import SDNIPConfigService, EventConfigChange
+from .fwd import Fwd, EventTopologyChange, EventFlowCommitFailure
 from .hop_db import HopDB
+from .host_db import HostDB, EventHostUpdate, EventHostRemove
+from .packet_in import PacketInDispatcher, EventIPv4PacketIn
+from .packet_in import EventBGPPacketIn
+from .ip_utils import int_to_ipv4, parse_prefix, prefix_len_to_mask
+from .ip_utils import ipv4_to_int, prefix_id
+from .path_index import PathIndex
+from .fib_aggregator import FibAggregator
+from .snapshot import read_snapshot, pack_snapshot, save_snapshot
+from .metrics import REGISTRY, timed
+from .cookies import COOKIE_INTERNAL_HOST, COOKIE_ROUTE, COOKIE_NEXTHOP
+from .cookies import COOKIE_TYPE_MASK, COOKIE_FULL_MASK
+from .cookies import make_cookie, get_cookie_type, get_cookie_value
+
+CONF = cfg.CONF
+CONF.register_cli_opts([
+    cfg.BoolOpt('sdn-ip-nexthop-table',
+                default=False,
+                help='match prefixes in one table and forward to next hops '
+                     'from a second table'),
+    cfg.FloatOpt('sdn-ip-coalesce-window',
+                 default=0.1,
+                 help='seconds to merge BGP updates of the same prefix'),
+    cfg.IntOpt('sdn-ip-host-idle-timeout',
+               default=0,
+               help='idle timeout in seconds of internal host flows, '
+                    '0 for no timeout'),
+    cfg.FloatOpt('sdn-ip-resync-delay',
+                 default=10,
+                 help='seconds to wait for topology and routes after a '
+                      'switch connects before its flows are reconciled'),
+    cfg.BoolOpt('sdn-ip-fib-compression',
+                default=False,
+                help='install no flow for prefixes whose closest covering '
+                     'prefix has the same next hop'),
+    cfg.StrOpt('sdn-ip-snapshot-file',
+               default=None,
+               help='file to save the RIB to and restore it from on '
+                    'start'),
+    cfg.FloatOpt('sdn-ip-snapshot-interval',
+                 default=30,
+                 help='seconds between RIB snapshots, only written when '
+                      'the RIB changed'),
+    cfg.FloatOpt('sdn-ip-stale-time',
+                 default=300,
+                 help='seconds restored routes are kept without being '
+                      'announced again by BGP')
+])
+SNAPSHOT_CHUNK = 1000  # routes between two yields while saving
+PREFIX_TABLE = 0
+NEXTHOP_TABLE = 1
+NEXTHOP_METADATA_MASK = 0xffffffff
+NEXTHOP_PRIORITY = 1
+ROUTE_PRIORITY = 10  # plus prefix length, longest prefix wins
+INTERNAL_HOST_PRIORITY = ROUTE_PRIORITY + 33
+FLOW_STATS_TIMEOUT = 30
+RESYNC_MAX_ROUNDS = 6
+RESYNC_COOKIE_TYPES = (COOKIE_ROUTE, COOKIE_NEXTHOP, COOKIE_INTERNAL_HOST)
+RIB_PREFIXES = REGISTRY.gauge('sdnip_rib_prefixes', 'Prefixes in RIB',
+                              ['state'])
+RIB_BYTES = REGISTRY.gauge('sdnip_rib_bytes', 'Estimated RIB memory')
+ROUTE_UPDATES = REGISTRY.counter('sdnip_route_updates_total',
+                                 'BGP best path changes', ['result'])
+ROUTE_QUEUE_LENGTH = REGISTRY.gauge('sdnip_route_queue_length',
+                                    'Route updates waiting to be processed')
+FIB_FLOWS = REGISTRY.gauge('sdnip_fib_flows',
+                           'Prefix flows needed by installed routes')
+FIB_COMPRESSION = REGISTRY.gauge('sdnip_fib_compression_ratio',
+                                 'Installed routes per prefix flow')
+SWITCH_FLOWS = REGISTRY.gauge('sdnip_switch_flows',
+                              'SDN-IP flows in switch tables',
+                              ['dpid', 'table'])
 
 # integrate with DragonKnight CLI
 with_dk = False
@@ -31,16 +104,45 @@ class SDNIP(app_manager.RyuApp):
 
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
     _CONTEXTS = {
+        'cfg_service': SDNIPConfigService,
         'fwd': Fwd,
-        'hop_db': HopDB
+        'hop_db': HopDB,
+        'host_db': HostDB,
+        'pkt_dispatcher': PacketInDispatcher
     }
 
     def __init__(self, *args, **kwargs):
         super(SDNIP, self).__init__(*args, **kwargs)
         self.fwd = kwargs['fwd']
         self.hop_db = kwargs['hop_db']
-        self.cfg_mgr = SDNIPConfigManager()
+        self.host_db = kwargs['host_db']
+        self.cfg_mgr = kwargs['cfg_service'].config
         self.waiters = {}
+        self.nexthop_paths = {}  # next hop -> (mac, tree)
+        self.route_paths = {}  # next hop -> (mac, tree)
+        self.internal_host_paths = {}  # ip -> (mac, tree of installed flows)
+        self.nexthop_index = PathIndex()  # trees of next hops
+        self.internal_host_index = PathIndex()
+        # prefix -> (nexthop, withdraw, peer)
+        self.route_updates = OrderedDict()
+        self.route_update_event = hub.Event()
+        self.route_stats = {'received': 0,
+                            'absorbed': 0,
+                            'installed': 0,
+                            'withdrawn': 0}
+        self.stale_prefixes = set()  # restored, not announced again yet
+        # dpid -> datapath to resync again after the running resync
+        self.resync_requests = {}
+        # internal network -> (nexthop, peer) of its ignored best path
+        self.internal_network_routes = {}
+        self.fib = None
+
+        if CONF.sdn_ip_fib_compression:
+            self.fib = FibAggregator(self.hop_db)
+
+        if CONF.sdn_ip_snapshot_file:
+            self.restore_snapshot(CONF.sdn_ip_snapshot_file)
+
         self.bgp_speaker =\
             BGPSpeaker(self.cfg_mgr.as_number,
                        str(self.cfg_mgr.router_id),
@@ -56,46 +158,301 @@ class SDNIP(app_manager.RyuApp):
                                           self.cfg_mgr.as_number,
                                           is_next_hop_self=True)
 
-        hub.spawn(self.prefix_check_loop)
+        hub.spawn(self.route_update_loop)
+
+        if CONF.sdn_ip_snapshot_file:
+            hub.spawn(self.snapshot_loop, CONF.sdn_ip_snapshot_file)
+
+        REGISTRY.add_collector(self.collect_metrics)
 
         if with_dk:
             dk_plugin.DynamicLoader.register_custom_cmd('sdn-ip:info', self.cmd_self_info)
             dk_plugin.DynamicLoader.register_custom_cmd('sdn-ip:routes', self.cmd_list_routes)
             dk_plugin.DynamicLoader.register_custom_cmd('sdn-ip:flows', self.cmd_get_flows)
+            dk_plugin.DynamicLoader.register_custom_cmd('sdn-ip:rib-usage', self.cmd_rib_usage)
+            dk_plugin.DynamicLoader.register_custom_cmd('sdn-ip:route-stats', self.cmd_route_stats)
+            dk_plugin.DynamicLoader.register_custom_cmd('sdn-ip:fib', self.cmd_fib)
+
+    def collect_metrics(self):
+        installed = self.hop_db.get_installed_count()
+        pending = self.hop_db.get_pending_count()
+        RIB_PREFIXES.set(installed, ('installed',))
+        RIB_PREFIXES.set(pending, ('pending',))
+        RIB_BYTES.set(self.hop_db.get_memory_usage()['bytes'])
+        ROUTE_QUEUE_LENGTH.set(len(self.route_updates))
+
+        for name, value in self.route_stats.items():
+            ROUTE_UPDATES.set(value, (name,))
+
+        flows = sum(self.get_route_flow_counts().values())
+        FIB_FLOWS.set(flows)
+        FIB_COMPRESSION.set(installed / float(max(flows, 1)))
+        SWITCH_FLOWS.clear()
+
+        for dpid, tables in self.get_table_occupancy().items():
+            for table_id, count in tables.items():
+                SWITCH_FLOWS.set(count, ('%016x' % dpid, table_id))
 
+    @timed
     def best_path_change_handler(self, ev):
-        self.logger.info('best path changed:')
-        self.logger.info('remote_as: %d', ev.remote_as)
-        self.logger.info('route_dist: %s', ev.route_dist)
-        self.logger.info('prefix: %s', ev.prefix)
-        self.logger.info('nexthop: %s', ev.nexthop)
-        self.logger.info('label: %s', ev.label)
-        self.logger.info('is_withdraw: %s', ev.is_withdraw)
-        self.logger.info('')
+        self.logger.debug('best path changed: prefix %s, nexthop %s, '
+                          'remote_as %d, is_withdraw %s', ev.prefix,
+                          ev.nexthop, ev.remote_as, ev.is_withdraw)
+        self.route_stats['received'] += 1
+
+        if ev.prefix in self.route_updates:
+            # only the last update of a prefix in the window is programmed
+            self.route_stats['absorbed'] += 1
+
+        self.route_updates[ev.prefix] = (ev.nexthop, ev.is_withdraw,
+                                         self.get_path_peer(ev))
+        self.route_update_event.set()
+
+    @staticmethod
+    def get_path_peer(ev):
+        '''
+        return: address of the BGP peer which sent the path, None if
+        unknown
+        '''
+        source = getattr(getattr(ev, 'path', None), 'source', None)
+        return getattr(source, 'ip_address', None)
+
+    def route_update_loop(self):
+
+        while True:
+            self.route_update_event.wait()
+            # let a burst of updates collect
+            hub.sleep(CONF.sdn_ip_coalesce_window)
+            self.route_update_event.clear()
+            updates = self.route_updates
+            self.route_updates = OrderedDict()
+
+            for prefix, (nexthop, is_withdraw, peer) in updates.items():
+                try:
+                    self.process_route_update(prefix, nexthop, is_withdraw,
+                                              peer)
+
+                except Exception:
+                    self.logger.exception('Failed to process %s', prefix)
+
+            self.logger.info('%d route updates processed, %d absorbed '
+                             'since start', len(updates),
+                             self.route_stats['absorbed'])
+
+    @timed
+    def process_route_update(self, prefix, nexthop, is_withdraw,
+                             peer=None):
+        self.stale_prefixes.discard(prefix)
 
         # Ignore internal network
-        prefix_nw = IPNetwork(ev.prefix)
+        if self.cfg_mgr.is_internal_network(prefix):
+            self.logger.info('Internal network, ignored.')
+
+            if is_withdraw:
+                self.internal_network_routes.pop(prefix, None)
 
-        for internal_network in self.cfg_mgr.get_internal_networks():
-            int_nw = IPNetwork(internal_network)
+            else:
+                # installed if the network is removed from the config
+                self.internal_network_routes[prefix] = (nexthop, peer)
 
-            if int_nw == prefix_nw:
-                self.logger.info('Internal network, ignored.')
+            return
+
+        current_nexthop = self.hop_db.get_nexthop(prefix)
+
+        if is_withdraw:
+            if current_nexthop is None:
+                # announced and withdrawn in the same window
+                self.route_stats['absorbed'] += 1
                 return
 
-        if ev.is_withdraw:
-            self.hop_db.withdraw(ev.prefix)
-            self.uninstall_best_path(ev.prefix, ev.nexthop)
+            self.withdraw_route(prefix, current_nexthop)
+            self.route_stats['withdrawn'] += 1
+
+        elif current_nexthop == nexthop:
+            # withdrawn and announced again, nothing to program
+            self.hop_db.add_hop(prefix, nexthop, peer)
+            self.route_stats['absorbed'] += 1
 
         else:
-            self.hop_db.add_hop(ev.prefix, ev.nexthop)
-            self.install_best_path(ev.prefix, ev.nexthop)
+            old_dpids = set()
+
+            if current_nexthop is not None:
+                old_dpids = self.get_prefix_dpids(prefix, current_nexthop)
+
+            self.hop_db.add_hop(prefix, nexthop, peer)
+            fib_changes = self.update_fib(prefix, current_nexthop)
+            self.install_best_path(prefix, nexthop)
+            self.apply_fib_changes(fib_changes)
+            self.route_stats['installed'] += 1
+            old_dpids -= self.get_prefix_dpids(prefix, nexthop)
+
+            if old_dpids:
+                # switches which are not on the path to the new next hop
+                self.uninstall_best_path(prefix, current_nexthop, old_dpids)
+
+            if current_nexthop is not None:
+                self.release_route_path(current_nexthop)
+                self.release_nexthop_path(current_nexthop)
+
+    def withdraw_route(self, prefix, nexthop):
+        dpids = self.get_prefix_dpids(prefix, nexthop)
+        self.hop_db.withdraw(prefix)
+        # routes inside the prefix take over before its flow goes
+        self.apply_fib_changes(self.update_fib(prefix, nexthop))
+        self.uninstall_best_path(prefix, nexthop, dpids)
+        self.release_route_path(nexthop)
+        self.release_nexthop_path(nexthop)
+
+    def update_fib(self, prefix, old_nexthop):
+        '''
+        return: routes inside the prefix whose flows are now covered or
+        needed again, empty without FIB compression
+        '''
+        if self.fib is None:
+            return []
+
+        return self.fib.update(prefix, old_nexthop)
+
+    def apply_fib_changes(self, changes):
+        for prefix, nexthop, suppressed in changes:
+            if not self.hop_db.is_prefix_installed(prefix):
+                # installed later when its next hop is found
+                continue
+
+            if suppressed:
+                self.uninstall_best_path(prefix, nexthop,
+                                         self.get_route_dpids(nexthop))
+
+            else:
+                self.install_best_path(prefix, nexthop)
+
+    def is_route_suppressed(self, prefix, nexthop):
+        return self.fib is not None and\
+            self.fib.is_suppressed(prefix, nexthop)
+
+    def restore_snapshot(self, path):
+        '''
+        Load the RIB saved before a restart, prefixes are installed as
+        soon as their next hops are found while BGP converges again
+        '''
+        if not os.path.exists(path):
+            return
+
+        try:
+            routes, nexthop_ids = read_snapshot(path)
+
+        except (IOError, OSError, ValueError) as e:
+            self.logger.warning("Can't restore RIB from %s: %s", path, e)
+            return
+
+        self.hop_db.restore(routes, nexthop_ids)
+
+        if self.fib is not None:
+            self.fib.rebuild()
+
+        self.stale_prefixes = set(self.hop_db.get_all_prefixes())
+        self.logger.info("%d routes restored from %s, %d of unknown peer",
+                         len(routes), path,
+                         sum(1 for route in routes if route[3] is None))
+
+        if self.stale_prefixes:
+            hub.spawn(self.stale_route_sweep)
+
+    def stale_route_sweep(self):
+        '''
+        Withdraw restored routes which BGP didn't announce again
+        '''
+        hub.sleep(CONF.sdn_ip_stale_time)
+        stale_prefixes = self.stale_prefixes
+        self.stale_prefixes = set()
+        withdrawn = 0
+
+        for prefix in stale_prefixes:
+            nexthop = self.hop_db.get_nexthop(prefix)
+
+            if nexthop is None or prefix in self.route_updates:
+                continue
+
+            self.route_updates[prefix] = (nexthop, True, None)
+            withdrawn += 1
+
+        self.logger.info("%d stale routes withdrawn", withdrawn)
+        self.route_update_event.set()
+
+    def snapshot_loop(self, path):
+        saved_version = self.hop_db.version
+
+        while True:
+            hub.sleep(CONF.sdn_ip_snapshot_interval)
+
+            if self.hop_db.version == saved_version:
+                continue
+
+            saved_version = self.hop_db.version
+            data = pack_snapshot(self.iter_snapshot_routes(),
+                                 self.hop_db.get_nexthop_ids())
+
+            try:
+                # file I/O in a native thread, handlers keep running
+                tpool.execute(save_snapshot, path, data)
+
+            except (IOError, OSError) as e:
+                self.logger.error("Failed to save RIB to %s: %s", path, e)
+                continue
+
+            self.logger.debug("RIB saved to %s, %d bytes", path, len(data))
+
+    def iter_snapshot_routes(self):
+        '''
+        Routes of the RIB for a snapshot, other greenthreads run between
+        chunks of routes, so a full table doesn't stall them
+        '''
+        for index, route in enumerate(self.hop_db.iter_routes()):
+            if index % SNAPSHOT_CHUNK == 0:
+                hub.sleep(0)
+
+            yield route
 
     def peer_down_handler(self, remote_ip, remote_as):
         self.logger.info('peer down:')
         self.logger.info('remote_as: %d', remote_as)
         self.logger.info('remote ip: %s', remote_ip)
         self.logger.info('')
+        self.withdraw_peer_routes(remote_ip)
+
+    def withdraw_peer_routes(self, peer):
+        '''
+        Queue withdrawals of all routes learned from a peer or via it as
+        next hop, they are programmed in one round of route updates.
+        Best paths via other peers which BGP announces meanwhile replace
+        the withdrawals in the queue, so those prefixes are moved once.
+        '''
+        prefixes = set(self.hop_db.get_peer_prefixes(peer))
+        prefixes.update(self.hop_db.get_nexthop_prefixes(peer))
+
+        for prefix, (nexthop, _, source) in\
+                list(self.route_updates.items()):
+            if nexthop == peer or source == peer:
+                prefixes.add(prefix)
+
+            elif prefix in prefixes:
+                # newer path from another peer
+                prefixes.discard(prefix)
+
+        for prefix in prefixes:
+            nexthop = self.hop_db.get_nexthop(prefix)
+            self.route_updates[prefix] = (nexthop, True, peer)
+
+        for network, (nexthop, source) in\
+                list(self.internal_network_routes.items()):
+            if nexthop == peer or source == peer:
+                del self.internal_network_routes[network]
+
+        self.logger.info("%d routes of peer %s withdrawn", len(prefixes),
+                         peer)
+
+        if prefixes:
+            self.route_update_event.set()
 
     def peer_up_handler(self, remote_ip, remote_as):
         self.logger.info('peer up:')
@@ -103,117 +460,761 @@ class SDNIP(app_manager.RyuApp):
         self.logger.info('remote ip: %s', remote_ip)
         self.logger.info('')
 
+    @set_ev_cls(EventConfigChange)
+    def config_change_handler(self, ev):
+        '''
+        Apply speakers and internal networks changed in the config file,
+        the BGP speaker keeps running and only affected routes and
+        internal host paths are updated
+        '''
+        for speaker_id in ev.removed_speakers:
+            self.bgp_speaker.neighbor_del(speaker_id)
+
+        for speaker_id in ev.added_speakers:
+            self.bgp_speaker.neighbor_add(speaker_id,
+                                          self.cfg_mgr.as_number,
+                                          is_next_hop_self=True)
+
+        for network in ev.added_networks:
+            # routes to internal networks are not programmed
+            nexthop = self.hop_db.get_nexthop(network)
+
+            if nexthop is not None:
+                self.internal_network_routes[network] =\
+                    (nexthop, self.hop_db.get_peer(network))
+                self.withdraw_route(network, nexthop)
+
+        for network in ev.removed_networks:
+            # the best path BGP announced meanwhile is programmed now
+            route = self.internal_network_routes.pop(network, None)
+
+            if route is not None and network not in self.route_updates:
+                nexthop, peer = route
+                self.route_updates[network] = (nexthop, False, peer)
+                self.route_update_event.set()
+
+        if not ev.added_networks and not ev.removed_networks:
+            return
+
+        for ip in list(self.internal_host_paths.keys()):
+            if not self.cfg_mgr.is_internal_host(ip):
+                self.uninstall_internal_host_path(ip)
+
+        for ip in self.host_db.get_all_ips():
+            if ip not in self.internal_host_paths and\
+               self.cfg_mgr.is_internal_host(ip):
+                self.install_internal_host_path(ip)
+
     def get_host(self, ip):
-        hosts = topo_api.get_all_host(self)
+        return self.host_db.get_host_by_ip(ip)
 
-        for host in hosts:
-            if ip in host.ipv4:
-                return host
+    def install_pending_prefixes(self, nexthops=None):
+        '''
+        Install prefixes which wait for their next hop, the next hop
+        host is looked up once for all prefixes behind it
+        '''
+        if nexthops is None:
+            nexthops = self.hop_db.get_pending_nexthops()
 
-        return None
+        for nexthop in nexthops:
+            prefixes = self.hop_db.get_pending_prefixes(nexthop)
 
-    def prefix_check_loop(self):
+            if not prefixes:
+                continue
 
-        while True:
-            prefixs_to_install = self.hop_db.get_uninstalled_prefix_list()
-            self.logger.debug("prefix to install: %s", str(prefixs_to_install))
+            nexthop_host = self.get_host(nexthop)
 
-            for prefix in prefixs_to_install:
-                nexthop = self.hop_db.get_nexthop(prefix)
-                self.install_best_path(prefix, nexthop)
+            if nexthop_host is None:
+                continue
+
+            self.logger.debug("install %d prefixes via %s",
+                              len(prefixes), nexthop)
+
+            for prefix in prefixes:
+                self.install_best_path(prefix, nexthop, nexthop_host)
+
+    @set_ev_cls(EventHostUpdate)
+    def host_update_handler(self, ev):
+        for ip in ev.ips:
+            if ip in self.nexthop_paths:
+                # next hop moved
+                self.install_nexthop_path(ip, ev.host)
+
+            if ip in self.route_paths:
+                self.install_route_path(ip, ev.host)
+
+            if self.cfg_mgr.is_internal_host(ip):
+                self.install_internal_host_path(ip, ev.host)
+
+        self.install_pending_prefixes(ev.ips)
+
+    @set_ev_cls(EventHostRemove)
+    def host_remove_handler(self, ev):
+        for ip in ev.ips:
+            self.uninstall_internal_host_path(ip)
+
+    @set_ev_cls(EventTopologyChange)
+    def topology_change_handler(self, ev):
+
+        if ev.removed_links or ev.removed_dpids:
+            # only paths crossing removed links or switches can change
+            nexthops = self.nexthop_index.get_affected(ev.removed_links,
+                                                       ev.removed_dpids)
+            internal_hosts = self.internal_host_index.get_affected(
+                ev.removed_links, ev.removed_dpids)
+
+        else:
+            nexthops = set(self.nexthop_paths.keys()) |\
+                set(self.route_paths.keys())
+            internal_hosts = list(self.internal_host_paths.keys())
+
+        self.install_pending_prefixes()
+
+        for nexthop in nexthops:
+            nexthop_host = self.get_host(nexthop)
 
-            hub.sleep(3)
+            if nexthop_host is None:
+                continue
 
-    def install_best_path(self, prefix, nexthop):
+            if nexthop in self.nexthop_paths:
+                self.install_nexthop_path(nexthop, nexthop_host)
+
+            if nexthop in self.route_paths:
+                self.install_route_path(nexthop, nexthop_host)
+
+        for ip in internal_hosts:
+            self.install_internal_host_path(ip)
+
+    @timed
+    def install_best_path(self, prefix, nexthop, nexthop_host=None,
+                          only_dpids=None):
+        '''
+        only_dpids: install to these switches only, None for all
+        '''
+        if nexthop_host is None:
+            nexthop_host = self.get_host(nexthop)
 
-        nexthop_host = self.get_host(nexthop)
         self.logger.debug("nexthop host: %s", str(nexthop_host))
         if nexthop_host is None:
-            self.logger.debug("Can't find nexthop host: %s", str(nexthop_host))
+            # wait until the next hop host is discovered
+            self.logger.debug("Can't find nexthop host: %s", nexthop)
+            return
+
+        if self.is_route_suppressed(prefix, nexthop):
+            # covered by the flow of a route with the same next hop
+            self.hop_db.install_prefix(prefix)
             return
 
         nexthop_port = nexthop_host.port
-        nexthop_mac = nexthop_host.mac
-        nexthop_dpid = nexthop_port.dpid
-        nexthop_port_no = nexthop_port.port_no
-        prefix_ip = str(IPNetwork(prefix).ip)
-        prefix_mask = str(IPNetwork(prefix).netmask)
+        nexthop_match, priority, cookie = self.get_route_flow(prefix)
 
-        for dp in self.fwd.get_all_datapaths():
-            from_dpid = dp.id
-            nexthop_match =\
-                dp.ofproto_parser.OFPMatch(ipv4_dst=(prefix_ip, prefix_mask),
-                                           eth_type=2048)
+        if CONF.sdn_ip_nexthop_table:
+            # prefix only points to the next hop, the same flow
+            # is used on every switch
+            nexthop_id = self.install_nexthop_path(nexthop, nexthop_host)
+            inst = [
+                ofproto_v1_3_parser.OFPInstructionWriteMetadata(
+                    nexthop_id, NEXTHOP_METADATA_MASK),
+                ofproto_v1_3_parser.OFPInstructionGotoTable(NEXTHOP_TABLE)
+                ]
+
+            for dp in self.fwd.get_all_datapaths():
+                if only_dpids is not None and dp.id not in only_dpids:
+                    continue
+
+                self.fwd.add_flow(dp, priority, nexthop_match, None, inst,
+                                  table_id=PREFIX_TABLE, cookie=cookie)
+
+        else:
             pre_actions = [
-                dp.ofproto_parser.OFPActionSetField(eth_dst=nexthop_mac)
+                ofproto_v1_3_parser.OFPActionSetField(eth_dst=nexthop_host.mac)
                 ]
 
-            self.fwd.setup_shortest_path(from_dpid,
-                                         nexthop_dpid,
-                                         nexthop_port_no,
+            # one flow per switch, prefixes behind the same next hop share
+            # the cached shortest path tree
+            self.install_route_path(nexthop, nexthop_host)
+
+            if CONF.sdn_ip_ecmp:
+                _, tree = self.route_paths[nexthop]
+                self.fwd.setup_ecmp_tree(self.hop_db.get_nexthop_id(nexthop),
+                                         tree,
                                          nexthop_match,
-                                         pre_actions)
+                                         pre_actions,
+                                         priority,
+                                         only_dpids=only_dpids,
+                                         cookie=cookie)
+
+            else:
+                self.fwd.setup_shortest_path_tree(nexthop_port.dpid,
+                                                  nexthop_port.port_no,
+                                                  nexthop_match,
+                                                  pre_actions,
+                                                  priority,
+                                                  only_dpids=only_dpids,
+                                                  cookie=cookie)
 
         self.hop_db.install_prefix(prefix)
 
-    def uninstall_best_path(self, prefix, nexthop):
+    def get_route_flow(self, prefix):
+        '''
+        return: match, priority and cookie of the prefix flow
+        '''
+        addr, prefix_len = parse_prefix(prefix)
+        prefix_ip = int_to_ipv4(addr)
+        prefix_mask = int_to_ipv4(prefix_len_to_mask(prefix_len))
+        match = ofproto_v1_3_parser.OFPMatch(ipv4_dst=(prefix_ip, prefix_mask),
+                                             eth_type=2048)
+        priority = ROUTE_PRIORITY + prefix_len
+        cookie = make_cookie(COOKIE_ROUTE, prefix_id(addr, prefix_len))
+        return match, priority, cookie
 
-        prefix_ip = str(IPNetwork(prefix).ip)
-        prefix_mask = str(IPNetwork(prefix).netmask)
+    def install_route_path(self, nexthop, nexthop_host):
+        '''
+        Move prefix flows behind a next hop to its current shortest path
+        tree, only switches whose output changed are updated.
+        Used when prefixes are not matched in a separate next hop table.
+        '''
+        nexthop_port = nexthop_host.port
+        old_mac, old_tree = self.route_paths.get(nexthop, (None, None))
 
-        # remove all flow rule for this prefix
-        for dp in self.fwd.get_all_datapaths():
-            match =\
-                dp.ofproto_parser.OFPMatch(ipv4_dst=(prefix_ip, prefix_mask),
-                                       eth_type=2048)
-            flow_del = dp.ofproto_parser.OFPFlowMod(datapath=dp,
-                                    command=OFPFC_DELETE,
-                                    match=match)
-            dp.send_msg(flow_del)
+        if CONF.sdn_ip_ecmp:
+            tree = self.fwd.get_ecmp_tree(nexthop_port.dpid,
+                                          nexthop_port.port_no)
+
+            if tree is not old_tree:
+                self.fwd.update_ecmp_groups(
+                    self.hop_db.get_nexthop_id(nexthop), tree)
+
+        else:
+            tree = self.fwd.get_shortest_path_tree(nexthop_port.dpid,
+                                                   nexthop_port.port_no)
+
+        self.route_paths[nexthop] = (nexthop_host.mac, tree)
+        self.nexthop_index.update(nexthop, tree)
+
+        if old_tree is None or\
+           (old_mac == nexthop_host.mac and old_tree is tree):
+            return
 
-    def install_internal_host_path(self, ip):
-        host = self.get_host(ip)
+        changed_dpids = None
+
+        if old_mac == nexthop_host.mac and CONF.sdn_ip_ecmp:
+            # flows point to the group, only new switches need them
+            changed_dpids = set(dpid for dpid in tree
+                                if dpid not in old_tree)
+
+        elif old_mac == nexthop_host.mac:
+            changed_dpids = set(dpid for dpid, port_no in tree.items()
+                                if old_tree.get(dpid) != port_no)
+
+        removed_dpids = [dpid for dpid in old_tree
+                         if dpid not in tree and dpid in self.fwd.dps]
+
+        if changed_dpids is not None and not changed_dpids and\
+           not removed_dpids:
+            return
+
+        prefixes = [prefix for prefix
+                    in self.hop_db.get_installed_prefixes(nexthop)
+                    if not self.is_route_suppressed(prefix, nexthop)]
+        self.logger.info("reroute %d prefixes via %s", len(prefixes),
+                         nexthop)
+
+        for prefix in prefixes:
+            self.install_best_path(prefix, nexthop, nexthop_host,
+                                   changed_dpids)
+            self.uninstall_best_path(prefix, nexthop, removed_dpids)
+
+    def release_route_path(self, nexthop):
+        '''
+        Forget the tree of a next hop without installed prefixes
+        '''
+        if nexthop not in self.route_paths or\
+           self.hop_db.has_installed_prefixes(nexthop):
+            return
+
+        del self.route_paths[nexthop]
+        self.nexthop_index.remove(nexthop)
+
+        if CONF.sdn_ip_ecmp:
+            self.fwd.update_ecmp_groups(self.hop_db.get_nexthop_id(nexthop),
+                                        {})
+
+    def get_nexthop_flow(self, nexthop, nexthop_host):
+        '''
+        return: match, pre actions and flow mod arguments of the next
+        hop table flow
+        '''
+        match = self.get_nexthop_match(nexthop)
+        pre_actions = [
+            ofproto_v1_3_parser.OFPActionSetField(eth_dst=nexthop_host.mac)
+            ]
+        kwargs = {'table_id': NEXTHOP_TABLE,
+                  'cookie': make_cookie(COOKIE_NEXTHOP,
+                                        ipv4_to_int(nexthop))}
+        return match, pre_actions, kwargs
+
+    def get_nexthop_match(self, nexthop):
+        nexthop_id = self.hop_db.get_nexthop_id(nexthop)
+        return ofproto_v1_3_parser.OFPMatch(
+            metadata=(nexthop_id, NEXTHOP_METADATA_MASK))
+
+    def install_nexthop_path(self, nexthop, nexthop_host):
+        '''
+        Install forwarding toward a next hop to the next hop table,
+        only switches whose output changed are updated
+        return: next hop id
+        '''
+        nexthop_id = self.hop_db.get_nexthop_id(nexthop)
+        nexthop_port = nexthop_host.port
+        old_mac, old_tree = self.nexthop_paths.get(nexthop, (None, None))
+
+        if old_mac != nexthop_host.mac:
+            old_tree = None
+
+        match, pre_actions, kwargs = self.get_nexthop_flow(nexthop,
+                                                           nexthop_host)
+
+        if CONF.sdn_ip_ecmp:
+            tree = self.fwd.update_ecmp_tree(nexthop_id,
+                                             old_tree,
+                                             nexthop_port.dpid,
+                                             nexthop_port.port_no,
+                                             match,
+                                             pre_actions,
+                                             NEXTHOP_PRIORITY,
+                                             **kwargs)
+
+        else:
+            tree = self.fwd.update_shortest_path_tree(old_tree,
+                                                      nexthop_port.dpid,
+                                                      nexthop_port.port_no,
+                                                      match,
+                                                      pre_actions,
+                                                      NEXTHOP_PRIORITY,
+                                                      **kwargs)
+
+        self.nexthop_paths[nexthop] = (nexthop_host.mac, tree)
+        self.nexthop_index.update(nexthop, tree)
+        return nexthop_id
+
+    def release_nexthop_path(self, nexthop):
+        '''
+        Delete the next hop table flows and the group of a next hop
+        without prefixes
+        '''
+        if nexthop not in self.nexthop_paths or\
+           self.hop_db.has_prefixes(nexthop):
+            return
+
+        _, tree = self.nexthop_paths.pop(nexthop)
+        self.nexthop_index.remove(nexthop)
+        match = self.get_nexthop_match(nexthop)
+        cookie = make_cookie(COOKIE_NEXTHOP, ipv4_to_int(nexthop))
+
+        for dpid in tree:
+            dp = self.fwd.dps.get(dpid)
+
+            if dp is None:
+                continue
+
+            self.fwd.delete_flow(dp, match, strict=True,
+                                 priority=NEXTHOP_PRIORITY,
+                                 table_id=NEXTHOP_TABLE, cookie=cookie,
+                                 cookie_mask=COOKIE_FULL_MASK)
+
+        if CONF.sdn_ip_ecmp:
+            # flows are gone, the group can go too
+            self.fwd.update_ecmp_groups(self.hop_db.get_nexthop_id(nexthop),
+                                        {})
+
+    def get_route_dpids(self, nexthop):
+        '''
+        return: set of dpid of switches which hold the flows of prefixes
+        installed via the next hop
+        '''
+        if CONF.sdn_ip_nexthop_table:
+            # prefix flows are installed on every switch
+            return set(self.fwd.dps.keys())
+
+        _, tree = self.route_paths.get(nexthop, (None, {}))
+        return set(tree)
+
+    def get_prefix_dpids(self, prefix, nexthop):
+        '''
+        return: set of dpid of switches which hold the prefix flow
+        '''
+        if not self.hop_db.is_prefix_installed(prefix) or\
+           self.is_route_suppressed(prefix, nexthop):
+            return set()
+
+        return self.get_route_dpids(nexthop)
+
+    def get_route_flow_counts(self):
+        '''
+        return: next hop -> number of prefix flows of installed routes
+        '''
+        if self.fib is not None:
+            return self.fib.get_flow_counts()
+
+        return dict((nexthop, len(prefix_ids)) for nexthop, prefix_ids
+                    in self.hop_db.installed_prefix.items())
+
+    def get_table_occupancy(self):
+        '''
+        return: dpid -> table id -> number of SDN-IP flows, read from
+        counters per next hop and switch, not per route or host
+        '''
+        occupancy = dict((dpid, {}) for dpid in self.fwd.dps)
+        flows = []  # (dpids, table id, number of flows)
+
+        for nexthop, count in self.get_route_flow_counts().items():
+            flows.append((self.get_route_dpids(nexthop), PREFIX_TABLE, count))
+
+        for _, tree in self.nexthop_paths.values():
+            flows.append((tree, NEXTHOP_TABLE, 1))
+
+        # one internal host flow on each switch of its tree
+        for dpid, ips in self.internal_host_index.switches.items():
+            flows.append(((dpid,), PREFIX_TABLE, len(ips)))
+
+        for dpids, table_id, count in flows:
+            for dpid in dpids:
+                if dpid not in occupancy or not count:
+                    continue
+
+                tables = occupancy[dpid]
+                tables[table_id] = tables.get(table_id, 0) + count
+
+        return occupancy
+
+    @timed
+    def uninstall_best_path(self, prefix, nexthop, dpids=None):
+        '''
+        Delete the prefix flow by its cookie, only from switches which
+        hold it
+        dpids: switches to delete from, None for all switches of the
+        next hop if the prefix flow is installed
+        '''
+        if dpids is None:
+            dpids = self.get_prefix_dpids(prefix, nexthop)
+
+        match, priority, cookie = self.get_route_flow(prefix)
+
+        for dpid in dpids:
+            dp = self.fwd.dps.get(dpid)
+
+            if dp is None:
+                continue
+
+            self.fwd.delete_flow(dp, match, strict=True,
+                                 priority=priority, table_id=PREFIX_TABLE,
+                                 cookie=cookie, cookie_mask=COOKIE_FULL_MASK)
+
+    def get_internal_host_flow(self, ip, host):
+        '''
+        return: match, pre actions and flow mod arguments of the
+        internal host flow
+        '''
+        match = ofproto_v1_3_parser.OFPMatch(ipv4_dst=ip, eth_type=2048)
+        pre_actions = [
+            ofproto_v1_3_parser.OFPActionSetField(eth_dst=host.mac)
+            ]
+        kwargs = {'cookie': make_cookie(COOKIE_INTERNAL_HOST,
+                                        ipv4_to_int(ip)),
+                  'idle_timeout': CONF.sdn_ip_host_idle_timeout,
+                  'flags': ofproto_v1_3.OFPFF_SEND_FLOW_REM}
+        return match, pre_actions, kwargs
+
+    def install_internal_host_path(self, ip, host=None):
+        '''
+        Install forwarding toward an internal host on every switch,
+        switches which already have the flow are skipped
+        '''
+        if host is None:
+            host = self.get_host(ip)
 
         if host is None:
             return
 
-        for dp in self.fwd.get_all_datapaths():
-            from_dpid = dp.id
-            host_match =\
-                dp.ofproto_parser.OFPMatch(ipv4_dst=ip, eth_type=2048)
-            pre_actions = [
-                dp.ofproto_parser.OFPActionSetField(eth_dst=host.mac)
-                ]
+        old_mac, old_tree = self.internal_host_paths.get(ip, (None, None))
+
+        if old_mac != host.mac:
+            old_tree = None
+
+        match, pre_actions, kwargs = self.get_internal_host_flow(ip, host)
+        tree = self.fwd.update_shortest_path_tree(old_tree,
+                                                  host.port.dpid,
+                                                  host.port.port_no,
+                                                  match,
+                                                  pre_actions,
+                                                  INTERNAL_HOST_PRIORITY,
+                                                  **kwargs)
+        self.internal_host_paths[ip] = (host.mac, tree)
+        self.internal_host_index.update(ip, tree)
+
+    def uninstall_internal_host_path(self, ip):
+        '''
+        Delete the internal host flow by its cookie, only from switches
+        which hold it
+        '''
+        _, tree = self.internal_host_paths.pop(ip, (None, None))
+
+        if tree is None:
+            return
+
+        self.internal_host_index.remove(ip)
+        match = ofproto_v1_3_parser.OFPMatch(ipv4_dst=ip, eth_type=2048)
+        cookie = make_cookie(COOKIE_INTERNAL_HOST, ipv4_to_int(ip))
+
+        for dpid in tree:
+            dp = self.fwd.dps.get(dpid)
+
+            if dp is None:
+                continue
 
-            self.fwd.setup_shortest_path(from_dpid,
-                                         host.port.dpid,
-                                         host.port.port_no,
-                                         host_match,
-                                         pre_actions)
+            self.fwd.delete_flow(dp, match, strict=True,
+                                 priority=INTERNAL_HOST_PRIORITY,
+                                 cookie=cookie, cookie_mask=COOKIE_FULL_MASK)
 
-    @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
-    @packet_in_filter(RequiredTypeFilter, {'types': [ipv4.ipv4]})
+    @set_ev_cls([EventIPv4PacketIn, EventBGPPacketIn])
+    @timed
     def internal_host_route_handler(self, ev):
         '''
-        Handle internal network host routing
+        Handle internal network host routing, paths are installed when
+        hosts are learned, this only covers hosts seen before their
+        flows are installed or after the flows expired
         '''
+        dst_ip = ev.dst_ip
+
+        if not self.cfg_mgr.is_internal_host(dst_ip):
+            return
+
+        self.install_internal_host_path(dst_ip)
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def flow_removed_handler(self, ev):
         msg = ev.msg
-        dp = msg.datapath
+        dpid = msg.datapath.id
+
+        if get_cookie_type(msg.cookie) != COOKIE_INTERNAL_HOST:
+            return
+
+        ip = int_to_ipv4(get_cookie_value(msg.cookie))
+        mac, tree = self.internal_host_paths.get(ip, (None, None))
+
+        if tree is None or dpid not in tree:
+            return
+
+        # flow is gone on this switch, install it again on next request
+        tree = dict(tree)
+        del tree[dpid]
+        self.internal_host_paths[ip] = (mac, tree)
+        self.internal_host_index.update(ip, tree)
+
+    @set_ev_cls(ofp_event.EventOFPStateChange, MAIN_DISPATCHER)
+    def switch_connect_handler(self, ev):
+        self.request_resync(ev.datapath)
+
+    @set_ev_cls(EventFlowCommitFailure)
+    def flow_commit_failure_handler(self, ev):
+        self.logger.info("%016x didn't commit flows, resync",
+                         ev.datapath.id)
+        self.request_resync(ev.datapath)
+
+    def request_resync(self, dp):
+        if dp.id in self.resync_requests:
+            # resync again when the running one is done
+            self.resync_requests[dp.id] = dp
+            return
+
+        self.resync_requests[dp.id] = None
+        hub.spawn(self.resync_loop, dp)
+
+    def resync_loop(self, dp):
         dpid = dp.id
-        ofproto = dp.ofproto
 
-        pkt = packet.Packet(msg.data)
-        ipv4_header = pkt.get_protocol(ipv4.ipv4)
+        try:
+            while dp is not None:
+                self.resync_datapath(dp)
+                dp = self.resync_requests[dpid]
+                self.resync_requests[dpid] = None
 
-        src_ip = ipv4_header.src
-        dst_ip = ipv4_header.dst
+        finally:
+            del self.resync_requests[dpid]
 
-        if not self.cfg_mgr.is_internal_host(dst_ip):
+    def resync_datapath(self, dp):
+        '''
+        Reconcile SDN-IP flows and ECMP groups of a connected switch with
+        what it has, only missing, stale or extra ones are sent
+        '''
+        # flows in flight are in the switch before it is read, those it
+        # didn't commit are fixed by the resync
+        if not self.fwd.flush([dp]):
+            self.logger.info("%016x didn't commit all flows before resync",
+                             dp.id)
+
+        flow_stats = []
+
+        for cookie_type in RESYNC_COOKIE_TYPES:
+            stats = self.get_flow_stats(dp, cookie_type)
+
+            if stats is None:
+                self.logger.warning("Can't read flows of %016x, "
+                                    "resync skipped", dp.id)
+                return
+
+            flow_stats.extend(stats)
+
+        self.fwd.start_flow_resync(dp, flow_stats)
+
+        if CONF.sdn_ip_ecmp:
+            group_stats = self.get_group_descs(dp)
+
+            if group_stats is None:
+                self.logger.warning("Can't read groups of %016x, stale "
+                                    "groups are kept", dp.id)
+                group_stats = []
+
+            self.fwd.start_group_resync(dp, group_stats)
+
+        # wait for topology and for routes learned again after a
+        # restart, flows added meanwhile are only sent if missing
+        received = None
+
+        for _ in range(RESYNC_MAX_ROUNDS):
+            if received == self.route_stats['received']:
+                break
+
+            received = self.route_stats['received']
+            hub.sleep(CONF.sdn_ip_resync_delay)
+
+        if self.fwd.dps.get(dp.id) is not dp:
+            # switch left or connected again
             return
 
-        self.install_internal_host_path(dst_ip)
+        self.replay_flows(dp)
 
-    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+        if not self.fwd.flush([dp]):
+            # not resynced again, see Fwd.flow_commit_failed
+            self.logger.warning("%016x didn't commit all flows of the "
+                                "resync", dp.id)
+
+        deleted = self.fwd.finish_flow_resync(dp)
+        # after flows, a group is only deleted when no flow needs it
+        deleted_groups = self.fwd.finish_group_resync(dp)
+        self.logger.info("%016x resynced, %d flows read, %d deleted, "
+                         "%d groups deleted", dp.id, len(flow_stats),
+                         deleted, deleted_groups)
+
+    def replay_flows(self, dp):
+        '''
+        Add all SDN-IP flows of a switch again
+        '''
+        only_dpids = set([dp.id])
+        nexthop_hosts = {}
+
+        if CONF.sdn_ip_ecmp:
+            # groups before the flows which point to them
+            for nexthop, (_, tree) in list(self.route_paths.items()) +\
+                    list(self.nexthop_paths.items()):
+                self.fwd.update_ecmp_groups(
+                    self.hop_db.get_nexthop_id(nexthop), tree)
+
+        for nexthop, (mac, tree) in list(self.nexthop_paths.items()):
+            nexthop_host = self.get_host(nexthop)
+
+            if nexthop_host is None:
+                continue
+
+            nexthop_hosts[nexthop] = nexthop_host
+            match, pre_actions, kwargs = self.get_nexthop_flow(nexthop,
+                                                               nexthop_host)
+
+            if CONF.sdn_ip_ecmp:
+                self.fwd.setup_ecmp_tree(self.hop_db.get_nexthop_id(nexthop),
+                                         tree,
+                                         match,
+                                         pre_actions,
+                                         NEXTHOP_PRIORITY,
+                                         only_dpids=only_dpids,
+                                         **kwargs)
+                continue
+
+            self.fwd.setup_shortest_path_tree(nexthop_host.port.dpid,
+                                              nexthop_host.port.port_no,
+                                              match,
+                                              pre_actions,
+                                              NEXTHOP_PRIORITY,
+                                              only_dpids=only_dpids,
+                                              **kwargs)
+
+        for prefix in self.hop_db.get_all_prefixes():
+            if not self.hop_db.is_prefix_installed(prefix):
+                continue
+
+            nexthop = self.hop_db.get_nexthop(prefix)
+
+            if nexthop not in nexthop_hosts:
+                nexthop_hosts[nexthop] = self.get_host(nexthop)
+
+            if nexthop_hosts[nexthop] is None:
+                continue
+
+            self.install_best_path(prefix, nexthop, nexthop_hosts[nexthop],
+                                   only_dpids)
+
+        for ip in list(self.internal_host_paths.keys()):
+            host = self.get_host(ip)
+
+            if host is None:
+                continue
+
+            match, pre_actions, kwargs = self.get_internal_host_flow(ip, host)
+            self.fwd.setup_shortest_path_tree(host.port.dpid,
+                                              host.port.port_no,
+                                              match,
+                                              pre_actions,
+                                              INTERNAL_HOST_PRIORITY,
+                                              only_dpids=only_dpids,
+                                              **kwargs)
+
+    def get_flow_stats(self, dp, cookie_type):
+        '''
+        Read flows of a cookie type from all tables
+        return: list of OFPFlowStats, None if the switch doesn't reply
+        '''
+        ofproto = dp.ofproto
+        parser = dp.ofproto_parser
+        req = parser.OFPFlowStatsRequest(dp,
+                                         table_id=ofproto.OFPTT_ALL,
+                                         cookie=make_cookie(cookie_type),
+                                         cookie_mask=COOKIE_TYPE_MASK)
+        return self.request_stats(dp, req)
+
+    def get_group_descs(self, dp):
+        '''
+        return: list of OFPGroupDescStats, None if the switch doesn't
+        reply
+        '''
+        req = dp.ofproto_parser.OFPGroupDescStatsRequest(dp)
+        return self.request_stats(dp, req)
+
+    def request_stats(self, dp, req):
+        dp.set_xid(req)
+        lock = hub.Event()
+        msgs = []
+        self.waiters.setdefault(dp.id, {})[req.xid] = (lock, msgs)
+        dp.send_msg(req)
+
+        if not lock.wait(timeout=FLOW_STATS_TIMEOUT):
+            self.waiters[dp.id].pop(req.xid, None)
+            return None
+
+        return [stats for msg in msgs for stats in msg.body]
+
+    @set_ev_cls([ofp_event.EventOFPFlowStatsReply,
+                 ofp_event.EventOFPGroupDescStatsReply], MAIN_DISPATCHER)
     def flow_status_reply_handler(self, ev):
         msg = ev.msg
         dp = msg.datapath
@@ -253,7 +1254,7 @@ class SDNIP(app_manager.RyuApp):
 
         for prefix in prefix_list:
             result = result + "{:<20}".format(prefix)
-            _next_hop = self.hop_db.hops.get(prefix)
+            _next_hop = self.hop_db.get_nexthop(prefix)
 
             if _next_hop is None:
                 _next_hop = "None"
@@ -264,6 +1265,49 @@ class SDNIP(app_manager.RyuApp):
 
         return result
 
+    def cmd_rib_usage(self):
+        usage = self.hop_db.get_memory_usage()
+        information = "Prefixes: {}\n" + \
+                      "Trie nodes: {}\n" + \
+                      "Memory: {} bytes\n" + \
+                      "Memory per prefix: {:.1f} bytes\n"
+
+        return information.format(usage['prefixes'],
+                                  usage['nodes'],
+                                  usage['bytes'],
+                                  usage['bytes_per_prefix'])
+
+    def cmd_route_stats(self):
+        information = "Received: {}\n" + \
+                      "Absorbed: {}\n" + \
+                      "Installed: {}\n" + \
+                      "Withdrawn: {}\n" + \
+                      "Queued: {}\n"
+
+        return information.format(self.route_stats['received'],
+                                  self.route_stats['absorbed'],
+                                  self.route_stats['installed'],
+                                  self.route_stats['withdrawn'],
+                                  len(self.route_updates))
+
+    def cmd_fib(self):
+        installed = self.hop_db.get_installed_count()
+        flows = sum(self.get_route_flow_counts().values())
+        information = "Installed routes: {}\n" + \
+                      "Prefix flows: {}\n" + \
+                      "Compression ratio: {:.2f}\n"
+        result = information.format(installed, flows,
+                                    installed / float(max(flows, 1)))
+        result = result + "{:<18}{:<8}{}\n".format("Switch", "Table", "Flows")
+        result = result + "=" * 32 + "\n"
+
+        for dpid, tables in sorted(self.get_table_occupancy().items()):
+            for table_id, count in sorted(tables.items()):
+                result = result + "{:0>16}  {:<8}{}\n".format(
+                    '%x' % dpid, table_id, count)
+
+        return result
+
     def cmd_get_flows(self):
         result = ""
         for dp in self.fwd.get_all_datapaths():
@@ -0,0 +1,29 @@
+from sdnip.cookies import COOKIE_TYPE_MASK, COOKIE_VALUE_MASK
+from sdnip.cookies import COOKIE_INTERNAL_HOST, COOKIE_ROUTE, COOKIE_NEXTHOP
+from sdnip.cookies import make_cookie, get_cookie_type, get_cookie_value
+from sdnip.ip_utils import ipv4_to_int, prefix_id
+
+
+def test_round_trip():
+    values = [0, 1, ipv4_to_int('255.255.255.255'),
+              prefix_id(ipv4_to_int('10.1.0.0'), 16), COOKIE_VALUE_MASK]
+
+    for cookie_type in (COOKIE_INTERNAL_HOST, COOKIE_ROUTE, COOKIE_NEXTHOP):
+        for value in values:
+            cookie = make_cookie(cookie_type, value)
+            assert get_cookie_type(cookie) == cookie_type
+            assert get_cookie_value(cookie) == value
+            assert cookie < 1 << 64
+
+
+def test_value_does_not_change_type():
+    cookie = make_cookie(COOKIE_ROUTE, COOKIE_TYPE_MASK | 5)
+    assert get_cookie_type(cookie) == COOKIE_ROUTE
+    assert get_cookie_value(cookie) == 5
+
+
+def test_type_mask_selects_type():
+    route = make_cookie(COOKIE_ROUTE, 7)
+    next_hop = make_cookie(COOKIE_NEXTHOP, 7)
+    assert route & COOKIE_TYPE_MASK == make_cookie(COOKIE_ROUTE)
+    assert next_hop & COOKIE_TYPE_MASK != make_cookie(COOKIE_ROUTE)
@@ -0,0 +1,91 @@
+import random
+import pytest
+from sdnip.fib_aggregator import FibAggregator
+from sdnip.hop_db import HopDB
+from .test_hop_db import NEXT_HOPS, random_prefix
+
+
+def expected_suppressed(hop_db):
+    return sorted(prefix for prefix, next_hop, parent_next_hop
+                  in hop_db.get_parent_nexthops()
+                  if next_hop == parent_next_hop)
+
+
+def suppressed(aggregator, hop_db):
+    return sorted(prefix for prefix in hop_db.get_all_prefixes()
+                  if aggregator.is_suppressed(prefix,
+                                              hop_db.get_nexthop(prefix)))
+
+
+def expected_flow_counts(aggregator, hop_db):
+    counts = {}
+
+    for next_hop in hop_db.installed_prefix:
+        counts[next_hop] = len(
+            [prefix for prefix in hop_db.get_installed_prefixes(next_hop)
+             if not aggregator.is_suppressed(prefix, next_hop)])
+
+    return counts
+
+
+def test_same_next_hop_is_suppressed():
+    hop_db = HopDB()
+    aggregator = FibAggregator(hop_db)
+    hop_db.add_hop('10.0.0.0/8', NEXT_HOPS[0])
+    aggregator.update('10.0.0.0/8')
+    hop_db.add_hop('10.1.0.0/16', NEXT_HOPS[0])
+    aggregator.update('10.1.0.0/16')
+    hop_db.add_hop('10.1.1.0/24', NEXT_HOPS[1])
+    aggregator.update('10.1.1.0/24')
+    assert aggregator.is_suppressed('10.1.0.0/16', NEXT_HOPS[0])
+    assert not aggregator.is_suppressed('10.1.1.0/24', NEXT_HOPS[1])
+
+    # the /16 now differs from its cover, the /24 below it is unchanged
+    hop_db.add_hop('10.1.0.0/16', NEXT_HOPS[1])
+    changes = aggregator.update('10.1.0.0/16', NEXT_HOPS[0])
+    assert not aggregator.is_suppressed('10.1.0.0/16', NEXT_HOPS[1])
+    assert changes == [('10.1.1.0/24', NEXT_HOPS[1], True)]
+
+    # without the /16 the /24 needs its own flow again
+    hop_db.withdraw('10.1.0.0/16')
+    changes = aggregator.update('10.1.0.0/16', NEXT_HOPS[1])
+    assert changes == [('10.1.1.0/24', NEXT_HOPS[1], False)]
+    assert aggregator.get_suppressed_count() == 0
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_incremental_matches_rebuild(seed):
+    rng = random.Random(seed)
+    hop_db = HopDB()
+    aggregator = FibAggregator(hop_db)
+    next_hops = NEXT_HOPS[:2]
+
+    for step in range(400):
+        prefixes = hop_db.get_all_prefixes()
+
+        if prefixes and rng.random() < 0.3:
+            prefix = rng.choice(sorted(prefixes))
+            old_next_hop = hop_db.get_nexthop(prefix)
+            hop_db.withdraw(prefix)
+
+        else:
+            prefix = random_prefix(rng)
+            old_next_hop = hop_db.get_nexthop(prefix)
+            hop_db.add_hop(prefix, rng.choice(next_hops))
+
+            if rng.random() < 0.7:
+                hop_db.install_prefix(prefix)
+
+        aggregator.update(prefix, old_next_hop)
+
+        if step % 40:
+            continue
+
+        assert suppressed(aggregator, hop_db) == expected_suppressed(hop_db)
+        assert aggregator.get_flow_counts() ==\
+            expected_flow_counts(aggregator, hop_db)
+
+    rebuilt = FibAggregator(hop_db)
+    rebuilt.rebuild()
+    assert rebuilt.suppressed == aggregator.suppressed
+    assert rebuilt.get_flow_counts() == aggregator.get_flow_counts()
@@ -0,0 +1,177 @@
+import logging
+from ryu.lib import hub
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
+from sdnip.flow_writer import FlowWriter
+
+ofproto = ofproto_v1_3
+parser = ofproto_v1_3_parser
+WAIT = 5
+
+
+class FakeReply(object):
+
+    def __init__(self, datapath, xid):
+        super(FakeReply, self).__init__()
+        self.datapath = datapath
+        self.xid = xid
+
+
+class FakeDatapath(object):
+    '''
+    Answers barriers and bundle commits at once, FlowMods whose match
+    has bad_in_port get an error reply
+    '''
+
+    def __init__(self, writer, dpid=1, bad_in_port=None, commit=True,
+                 answer=True):
+        super(FakeDatapath, self).__init__()
+        self.id = dpid
+        self.ofproto = ofproto
+        self.ofproto_parser = parser
+        self.writer = writer
+        self.bad_in_port = bad_in_port
+        self.commit = commit
+        self.answer = answer
+        self.xid = 0
+        self.sent = []
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg):
+        self.sent.append(msg)
+        inner = getattr(msg, 'message', msg)
+
+        if isinstance(inner, parser.OFPFlowMod) and\
+           inner.match.get('in_port') == self.bad_in_port:
+            error = parser.OFPErrorMsg(
+                self, type_=ofproto.OFPET_FLOW_MOD_FAILED,
+                code=ofproto.OFPFMFC_TABLE_FULL)
+            error.xid = msg.xid
+            self.writer.error_reply(error)
+
+        if isinstance(msg, parser.ONFBundleCtrlMsg) and self.commit and\
+           msg.type == ofproto.ONF_BCT_COMMIT_REQUEST:
+            self.writer.bundle_reply(parser.ONFBundleCtrlMsg(
+                self, msg.bundle_id, ofproto.ONF_BCT_COMMIT_REPLY,
+                msg.flags, []))
+
+        if isinstance(msg, parser.OFPBarrierRequest) and self.answer:
+            self.writer.barrier_reply(FakeReply(self, msg.xid))
+
+    def flow_mods(self):
+        return [msg for msg in self.sent
+                if isinstance(msg, parser.OFPFlowMod)]
+
+
+def make_writer(**kwargs):
+    failures = []
+    writer = FlowWriter(logging.getLogger(__name__), batch_size=10,
+                        max_queue=25, barrier_timeout=0.1,
+                        on_failure=lambda dp: failures.append(dp.id),
+                        **kwargs)
+    return writer, failures
+
+
+def send_flows(writer, dp, count=30):
+    for in_port in range(count):
+        writer.send(dp, parser.OFPFlowMod(
+            dp, match=parser.OFPMatch(in_port=in_port), instructions=[]))
+
+
+def queue_state(writer, dp):
+    queue = writer.queues[dp.id]
+    return queue.sent_seq, queue.committed_seq, queue.failed_seq
+
+
+def test_committed():
+    writer, failures = make_writer()
+    dp = FakeDatapath(writer)
+    send_flows(writer, dp)
+    assert writer.flush(dp).wait(WAIT)
+    assert queue_state(writer, dp) == (30, 30, 0)
+    assert len(dp.flow_mods()) == 30
+    assert failures == []
+    # nothing sent since, done at once
+    assert writer.flush(dp).wait(0)
+
+
+def test_error_reply_fails_batch():
+    writer, failures = make_writer()
+    dp = FakeDatapath(writer, bad_in_port=15)
+    send_flows(writer, dp)
+    assert not writer.flush(dp).wait(WAIT)
+    # first batch committed, the second failed, the third is sent but
+    # does not advance committed_seq past the failure
+    assert queue_state(writer, dp) == (30, 10, 11)
+    assert failures == [dp.id]
+
+
+def test_barrier_timeout():
+    writer, failures = make_writer()
+    dp = FakeDatapath(writer, answer=False)
+    send_flows(writer, dp, 5)
+    assert not writer.flush(dp).wait(WAIT)
+    assert queue_state(writer, dp) == (5, 0, 1)
+    assert failures == [dp.id]
+
+
+def test_bundle_committed():
+    writer, failures = make_writer(use_bundle=True)
+    dp = FakeDatapath(writer)
+    send_flows(writer, dp)
+    assert writer.flush(dp).wait(WAIT)
+    assert queue_state(writer, dp) == (30, 30, 0)
+    assert len([msg for msg in dp.sent
+                if isinstance(msg, parser.ONFBundleAddMsg)]) == 30
+    assert failures == []
+
+
+def test_bundle_not_committed():
+    writer, failures = make_writer(use_bundle=True)
+    dp = FakeDatapath(writer, commit=False)
+    send_flows(writer, dp, 5)
+    assert not writer.flush(dp).wait(WAIT)
+    assert queue_state(writer, dp) == (5, 0, 1)
+    assert failures == [dp.id]
+
+
+def test_bundle_error_reply():
+    writer, failures = make_writer(use_bundle=True)
+    dp = FakeDatapath(writer, bad_in_port=3)
+    send_flows(writer, dp, 5)
+    assert not writer.flush(dp).wait(WAIT)
+    assert failures == [dp.id]
+
+
+def test_clear_failures():
+    writer, failures = make_writer()
+    dp = FakeDatapath(writer, bad_in_port=0)
+    send_flows(writer, dp, 5)
+    assert not writer.flush(dp).wait(WAIT)
+
+    writer.clear_failures(dp)
+    assert writer.flush(dp).wait(0)
+    assert queue_state(writer, dp) == (5, 5, 0)
+
+    send_flows(writer, dp, 5)
+    assert not writer.flush(dp).wait(WAIT)
+    dp.bad_in_port = None
+    writer.clear_failures(dp)
+    send_flows(writer, dp, 5)
+    assert writer.flush(dp).wait(WAIT)
+    assert queue_state(writer, dp) == (15, 15, 0)
+
+
+def test_remove_datapath():
+    writer, failures = make_writer()
+    dp = FakeDatapath(writer, answer=False)
+    writer.barrier_timeout = WAIT
+    send_flows(writer, dp, 5)
+    flush = writer.flush(dp)
+    hub.sleep(0)
+    writer.remove_datapath(dp.id)
+    assert not flush.wait(WAIT)
+    assert dp.id not in writer.queues
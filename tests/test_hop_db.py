@@ -0,0 +1,153 @@
+import random
+import pytest
+from sdnip.hop_db import HopDB
+from sdnip.ip_utils import IPV4_BITS, ipv4_to_int, int_to_ipv4
+from sdnip.ip_utils import parse_prefix, prefix_len_to_mask, prefix_to_str
+
+NEXT_HOPS = ['192.168.1.%d' % i for i in range(1, 5)]
+PEERS = ['192.168.2.1', '192.168.2.2', None]
+
+
+def random_prefix(rng):
+    # few top bits so routes nest and share trie nodes
+    addr = rng.choice([0x0a000000, 0x0a800000, 0xc0a80000]) |\
+        rng.getrandbits(16) << rng.choice([0, 8])
+    prefix_len = rng.choice([8, 9, 12, 16, 17, 20, 24, 25, 30, 32])
+    return prefix_to_str(addr & prefix_len_to_mask(prefix_len), prefix_len)
+
+
+def covers(prefix, addr, prefix_len=IPV4_BITS):
+    route_addr, route_len = parse_prefix(prefix)
+    return route_len <= prefix_len and\
+        addr & prefix_len_to_mask(route_len) == route_addr
+
+
+def oracle_lookup(routes, ip):
+    addr = ipv4_to_int(ip)
+    matches = [prefix for prefix in routes if covers(prefix, addr)]
+
+    if not matches:
+        return None
+
+    best = max(matches, key=lambda prefix: parse_prefix(prefix)[1])
+    return best, routes[best]
+
+
+def oracle_parent(routes, prefix):
+    addr, prefix_len = parse_prefix(prefix)
+    parents = [route for route in routes
+               if covers(route, addr, prefix_len - 1)]
+
+    if not parents:
+        return None
+
+    return routes[max(parents, key=lambda route: parse_prefix(route)[1])]
+
+
+def random_ips(rng, routes, count):
+    ips = [int_to_ipv4(rng.getrandbits(32)) for _ in range(count)]
+
+    for prefix in rng.sample(sorted(routes), min(count, len(routes))):
+        addr, prefix_len = parse_prefix(prefix)
+        host_bits = IPV4_BITS - prefix_len
+        ips.append(int_to_ipv4(addr | rng.getrandbits(host_bits)
+                               if host_bits else addr))
+
+    return ips
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_against_oracle(seed):
+    rng = random.Random(seed)
+    hop_db = HopDB()
+    routes = {}  # prefix -> next hop
+    peers = {}  # prefix -> peer
+
+    for step in range(600):
+        prefix = random_prefix(rng)
+
+        if routes and rng.random() < 0.3:
+            prefix = rng.choice(sorted(routes))
+            hop_db.withdraw(prefix)
+            del routes[prefix]
+            del peers[prefix]
+
+        else:
+            routes[prefix] = rng.choice(NEXT_HOPS)
+            peers[prefix] = rng.choice(PEERS)
+            hop_db.add_hop(prefix, routes[prefix], peers[prefix])
+
+        if step % 50:
+            continue
+
+        assert sorted(hop_db.get_all_prefixes()) == sorted(routes)
+        assert hop_db.get_prefix_count() == len(routes)
+
+        for ip in random_ips(rng, routes, 50):
+            assert hop_db.lookup(ip) == oracle_lookup(routes, ip)
+
+        for prefix in routes:
+            assert hop_db.get_nexthop(prefix) == routes[prefix]
+            assert hop_db.get_peer(prefix) == peers[prefix]
+            assert hop_db.get_parent_nexthop(prefix) ==\
+                oracle_parent(routes, prefix)
+
+        parents = dict((prefix, parent) for prefix, _, parent
+                       in hop_db.get_parent_nexthops())
+        assert parents == dict((prefix, oracle_parent(routes, prefix))
+                               for prefix in routes)
+
+        for peer in PEERS[:-1]:
+            assert sorted(hop_db.get_peer_prefixes(peer)) ==\
+                sorted(prefix for prefix in routes if peers[prefix] == peer)
+
+
+def test_withdraw_missing_prefix():
+    hop_db = HopDB()
+    hop_db.add_hop('10.0.0.0/8', NEXT_HOPS[0])
+    hop_db.withdraw('10.0.0.0/16')
+    hop_db.withdraw('11.0.0.0/8')
+    assert hop_db.get_all_prefixes() == ['10.0.0.0/8']
+    assert hop_db.lookup('10.1.2.3') == ('10.0.0.0/8', NEXT_HOPS[0])
+
+
+def test_install_state():
+    hop_db = HopDB()
+    hop_db.add_hop('10.0.0.0/8', NEXT_HOPS[0])
+    hop_db.add_hop('10.1.0.0/16', NEXT_HOPS[0])
+    assert hop_db.get_pending_count() == 2
+
+    hop_db.install_prefix('10.0.0.0/8')
+    assert hop_db.is_prefix_installed('10.0.0.0/8')
+    assert hop_db.get_installed_count() == 1
+    assert hop_db.get_pending_prefixes(NEXT_HOPS[0]) == ['10.1.0.0/16']
+
+    # a moved route waits for its new next hop
+    hop_db.add_hop('10.0.0.0/8', NEXT_HOPS[1])
+    assert not hop_db.is_prefix_installed('10.0.0.0/8')
+    assert hop_db.get_installed_count() == 0
+    assert hop_db.get_pending_prefixes(NEXT_HOPS[1]) == ['10.0.0.0/8']
+
+    hop_db.install_prefix('10.0.0.0/8')
+    hop_db.withdraw('10.0.0.0/8')
+    assert hop_db.get_installed_count() == 0
+    assert not hop_db.has_prefixes(NEXT_HOPS[1])
+    assert hop_db.get_pending_count() == 1
+
+
+def test_restore_round_trip():
+    rng = random.Random(1)
+    hop_db = HopDB()
+
+    for _ in range(200):
+        hop_db.add_hop(random_prefix(rng), rng.choice(NEXT_HOPS),
+                       rng.choice(PEERS))
+
+    for next_hop in NEXT_HOPS:
+        hop_db.get_nexthop_id(next_hop)
+
+    restored = HopDB()
+    restored.restore(hop_db.get_routes(), hop_db.get_nexthop_ids())
+    assert sorted(restored.get_routes()) == sorted(hop_db.get_routes())
+    assert restored.get_nexthop_ids() == hop_db.get_nexthop_ids()
+    assert restored.get_installed_count() == 0
@@ -0,0 +1,87 @@
+import os
+import struct
+import pytest
+from sdnip.ip_utils import ipv4_to_int
+from sdnip.snapshot import MAGIC, VERSION, NO_PEER
+from sdnip.snapshot import pack_snapshot, read_snapshot, write_snapshot
+
+ROUTES = [(ipv4_to_int('10.0.0.0'), 8, '192.168.1.1', '192.168.2.1'),
+          (ipv4_to_int('10.1.0.0'), 16, '192.168.1.2', None),
+          (ipv4_to_int('172.16.1.1'), 32, '192.168.1.1', '192.168.2.2')]
+NEXTHOP_IDS = {'192.168.1.1': 3, '192.168.1.3': 7}
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('rib.snap'))
+
+
+def test_round_trip(path):
+    size = write_snapshot(path, iter(ROUTES), NEXTHOP_IDS)
+    assert size == os.path.getsize(path)
+    assert not os.path.exists(path + '.tmp')
+
+    routes, nexthop_ids = read_snapshot(path)
+    assert routes == ROUTES
+    # next hops without id are stored with 0 and not returned
+    assert nexthop_ids == NEXTHOP_IDS
+
+
+def test_empty(path):
+    write_snapshot(path, [], {})
+    assert read_snapshot(path) == ([], {})
+
+
+def write_bytes(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_bad_magic_or_version(path):
+    data = pack_snapshot(ROUTES, NEXTHOP_IDS)
+    write_bytes(path, b'NOTARIB!' + bytes(data[len(MAGIC):]))
+
+    with pytest.raises(ValueError):
+        read_snapshot(path)
+
+    data[len(MAGIC):len(MAGIC) + 2] = struct.pack('!H', VERSION + 1)
+    write_bytes(path, bytes(data))
+
+    with pytest.raises(ValueError):
+        read_snapshot(path)
+
+
+def test_truncated(path):
+    data = bytes(pack_snapshot(ROUTES, NEXTHOP_IDS))
+
+    for size in (0, 5, len(data) - 1):
+        write_bytes(path, data[:size])
+
+        with pytest.raises(ValueError):
+            read_snapshot(path)
+
+    write_bytes(path, data + b'\0')
+
+    with pytest.raises(ValueError):
+        read_snapshot(path)
+
+
+def test_bad_index(path):
+    data = pack_snapshot(ROUTES[:1], {})
+    # next hop index of the only route, which starts at the last 13 bytes
+    data[-9:-5] = struct.pack('!I', 1)
+    write_bytes(path, bytes(data))
+
+    with pytest.raises(ValueError):
+        read_snapshot(path)
+
+    data = pack_snapshot(ROUTES[:1], {})
+    data[-5:-1] = struct.pack('!I', 1)
+    write_bytes(path, bytes(data))
+
+    with pytest.raises(ValueError):
+        read_snapshot(path)
+
+    data[-5:-1] = struct.pack('!I', NO_PEER)
+    write_bytes(path, bytes(data))
+    assert read_snapshot(path)[0] == [ROUTES[0][:3] + (None,)]